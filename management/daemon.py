@@ -11,12 +11,6 @@ from mailconfig import get_mail_users, get_mail_users_ex, get_admins, add_mail_u
 from mailconfig import get_mail_user_privileges, add_remove_mail_user_privilege
 from mailconfig import get_mail_aliases, get_mail_aliases_ex, get_mail_domains, add_mail_alias, remove_mail_alias
 
-# Create a worker pool for the status checks. The pool should
-# live across http requests so we don't baloon the system with
-# processes.
-import multiprocessing.pool
-pool = multiprocessing.pool.Pool(processes=10)
-
 env = utils.load_environment()
 
 auth_service = auth.KeyAuthService()
@@ -212,9 +206,16 @@ def dns_zones():
 @app.route('/dns/update', methods=['POST'])
 @authorized_personnel_only
 def dns_update():
-	from dns_update import do_dns_update
+	# With dry_run=1, nothing is changed and the records that would change in
+	# each zone are returned. With format=json (implied by dry_run=1), the
+	# response also breaks down how long each stage of the update took.
+	from dns_update import do_dns_update, do_dns_update_ex
 	try:
-		return do_dns_update(env, force=request.form.get('force', '') == '1')
+		force = request.form.get('force', '') == '1'
+		dry_run = request.form.get('dry_run', '') == '1'
+		if dry_run or request.form.get('format', '') == 'json':
+			return json_response(do_dns_update_ex(env, force=force, dry_run=dry_run))
+		return do_dns_update(env, force=force)
 	except Exception as e:
 		return (str(e), 500)
 
@@ -248,18 +249,70 @@ def dns_get_records(qname=None, rtype=None):
 		and (not qname or r[0] == qname)
 		and (not rtype or r[1] == rtype) ])
 
+@app.route('/dns/custom/batch', methods=['POST'])
+@authorized_personnel_only
+def dns_set_records_batch():
+	# Apply many changes at once with a single rebuild of the affected zones.
+	# The request body is a JSON array of objects with the keys "action"
+	# ("add", "set", or "remove", which work like POST, PUT, and DELETE
+	# below), "qname", "rtype" (defaults to "A"), and "value".
+	from dns_update import do_dns_update, set_custom_dns_records, normalize_custom_dns_record
+	try:
+		try:
+			changes = json.loads(request.stream.read().decode("utf8"))
+		except ValueError:
+			return ("The request body must be a JSON array.", 400)
+		if not isinstance(changes, list) or not all(isinstance(c, dict) for c in changes):
+			return ("The request body must be a JSON array of objects.", 400)
+
+		records = []
+		for change in changes:
+			action = change.get("action")
+			rtype = str(change.get("rtype", "A")).upper()
+
+			# Normalize the same way as for a single record below.
+			qname, value = normalize_custom_dns_record(str(change.get("qname", "")), str(change.get("value") or ""))
+
+			if action in ("add", "set"):
+				# There is a default value for A/AAAA records.
+				if rtype in ("A", "AAAA") and value == "":
+					value = request.environ.get("HTTP_X_FORWARDED_FOR") # normally REMOTE_ADDR but we're behind nginx as a reverse proxy
+
+				# Cannot add empty records.
+				if not value:
+					return ("No value for the %s record on %s provided." % (rtype, qname), 400)
+
+			elif action == "remove":
+				if value == '':
+					# Delete all records for this qname-type pair.
+					value = None
+
+			else:
+				return ("Invalid action: %s" % action, 400)
+
+			records.append((qname, rtype, value, action))
+
+		zones = set_custom_dns_records(records, env)
+		if zones is None or len(zones) > 0:
+			return do_dns_update(env, zones=zones) or "Something isn't right."
+		return "OK"
+
+	except ValueError as e:
+		return (str(e), 400)
+
 @app.route('/dns/custom/<qname>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 @app.route('/dns/custom/<qname>/<rtype>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 @authorized_personnel_only
 def dns_set_record(qname, rtype="A"):
-	from dns_update import do_dns_update, set_custom_dns_record
+	from dns_update import do_dns_update, set_custom_dns_record, normalize_custom_dns_record
 	try:
 		# Normalize.
 		rtype = rtype.upper()
 
 		# Read the record value from the request BODY, which must be
 		# ASCII-only. Not used with GET.
-		value = request.stream.read().decode("ascii", "ignore").strip()
+		value = request.stream.read().decode("ascii", "ignore")
+		qname, value = normalize_custom_dns_record(qname, value)
 
 		if request.method == "GET":
 			# Get the existing records matching the qname and rtype.
@@ -315,6 +368,26 @@ def ssl_get_csr(domain):
 	ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env)
 	return create_csr(domain, ssl_key, env)
 
+@app.route('/ssl/csr/batch', methods=['POST'])
+@authorized_personnel_only
+def ssl_get_csrs():
+	# Get the CSRs for many domains at once. The request body is a JSON object
+	# with "domains", an array, and optionally "multi_domain": true to get a
+	# single CSR for all of the domains (using the first domain's private key).
+	# Returns a JSON array of objects with the "domains" and the "csr".
+	from web_update import create_csrs
+	try:
+		try:
+			req = json.loads(request.stream.read().decode("utf8"))
+		except ValueError:
+			return ("The request body must be a JSON object.", 400)
+		if not isinstance(req, dict) or not isinstance(req.get("domains"), list):
+			return ("The request body must be a JSON object with a domains array.", 400)
+		csrs = create_csrs([str(d) for d in req["domains"]], env, multi_domain=req.get("multi_domain") is True)
+		return json_response([{ "domains": domains, "csr": csr } for domains, csr in csrs])
+	except ValueError as e:
+		return (str(e), 400)
+
 @app.route('/ssl/install', methods=['POST'])
 @authorized_personnel_only
 def ssl_install_cert():
@@ -324,6 +397,25 @@ def ssl_install_cert():
 	ssl_chain = request.form.get('chain')
 	return install_cert(domain, ssl_cert, ssl_chain, env)
 
+@app.route('/ssl/install/batch', methods=['POST'])
+@authorized_personnel_only
+def ssl_install_certs():
+	# Install many certificates at once, with a single DNS, mail and web
+	# update. The request body is a JSON array of objects with the keys
+	# "domain", "cert", and "chain" (optional), like POST /ssl/install. If
+	# any certificate has a problem, none are installed.
+	from web_update import install_certs
+	try:
+		try:
+			certs = json.loads(request.stream.read().decode("utf8"))
+		except ValueError:
+			return ("The request body must be a JSON array.", 400)
+		if not isinstance(certs, list) or not all(isinstance(c, dict) for c in certs):
+			return ("The request body must be a JSON array of objects.", 400)
+		return install_certs([(str(c.get("domain", "")), str(c.get("cert", "")), str(c.get("chain") or "")) for c in certs], env)
+	except ValueError as e:
+		return (str(e), 400)
+
 # WEB
 
 @app.route('/web/domains')
@@ -332,10 +424,30 @@ def web_get_domains():
 	from web_update import get_web_domains_info
 	return json_response(get_web_domains_info(env))
 
+@app.route('/web/domains/stream')
+@authorized_personnel_only
+def web_get_domains_stream():
+	# The same information as /web/domains, but sent as it becomes available
+	# so the control panel can show the domains before the certificate checks
+	# are done. The response is one JSON value per line: first the list of
+	# domains without their certificate status, then an object with the
+	# "domain" and "ssl_certificate" status for each domain as its check finishes.
+	from web_update import get_web_domains_info, iter_web_domains_ssl_status
+	def generate():
+		domains = get_web_domains_info(env, with_ssl_status=False)
+		yield json.dumps(domains) + "\n"
+		for domain, status in iter_web_domains_ssl_status([d["domain"] for d in domains], env):
+			yield json.dumps({ "domain": domain, "ssl_certificate": status }) + "\n"
+	# Tell nginx not to buffer the response, which would hold back each line.
+	return Response(generate(), status=200, mimetype='application/x-ndjson', headers={ "X-Accel-Buffering": "no" })
+
 @app.route('/web/update', methods=['POST'])
 @authorized_personnel_only
 def web_update():
-	from web_update import do_web_update
+	from web_update import do_web_update, get_web_custom_settings
+	problems = get_web_custom_settings(env).problems
+	if len(problems) > 0:
+		return ("There is a problem with www/custom.yaml:\n" + "\n".join(problems), 400)
 	return do_web_update(env)
 
 # System
@@ -358,9 +470,63 @@ def system_status():
 		def print_line(self, message, monospace=False):
 			self.items[-1]["extra"].append({ "text": message, "monospace": monospace })
 	output = WebOutput()
-	run_checks(False, env, output, pool)
+	run_checks(False, env, output, use_cache=True, force=get_status_checks_to_force())
 	return json_response(output.items)
 
+@app.route('/system/status/stream', methods=["POST"])
+@authorized_personnel_only
+def system_status_stream():
+	# The same checks as /system/status, but sent as server-sent events so
+	# the control panel can show each heading and result as soon as it and
+	# everything before it is ready. Each event's data is a heading or
+	# result like those of /system/status, or an object with "type"
+	# "extra" holding a line to add to the one before it. The last event
+	# is named "done".
+	import queue, threading
+	from status_checks import run_checks
+	events = queue.Queue()
+	class StreamOutput:
+		def add_heading(self, heading):
+			events.put({ "type": "heading", "text": heading, "extra": [] })
+		def print_ok(self, message):
+			events.put({ "type": "ok", "text": message, "extra": [] })
+		def print_error(self, message):
+			events.put({ "type": "error", "text": message, "extra": [] })
+		def print_warning(self, message):
+			events.put({ "type": "warning", "text": message, "extra": [] })
+		def print_line(self, message, monospace=False):
+			events.put({ "type": "extra", "text": message, "monospace": monospace })
+
+	force = get_status_checks_to_force()
+	def run():
+		try:
+			run_checks(False, env, StreamOutput(), use_cache=True, force=force)
+		except Exception as e:
+			events.put({ "type": "error", "text": "The status checks could not be completed: " + str(e), "extra": [] })
+			raise
+		finally:
+			events.put(None)
+	threading.Thread(target=run, daemon=True).start()
+
+	def generate():
+		while True:
+			event = events.get()
+			if event is None:
+				break
+			yield "data: " + json.dumps(event) + "\n\n"
+		yield "event: done\ndata: \n\n"
+	# Tell nginx not to buffer the response, which would hold back each event.
+	return Response(generate(), status=200, mimetype='text/event-stream', headers={ "X-Accel-Buffering": "no" })
+
+def get_status_checks_to_force():
+	# Saved results are shown for checks that were run recently. Pass
+	# "force" to run some checks again now: "all", or a comma-separated
+	# list of check ids (e.g. "ssl-certificate") and domains.
+	force = request.form.get("force", "")
+	if force == "all":
+		return True
+	return set(f.strip() for f in force.split(",") if f.strip() != "")
+
 @app.route('/system/updates')
 @authorized_personnel_only
 def show_updates():
@@ -4,13 +4,13 @@
 # and mail aliases and restarts nsd.
 ########################################################################
 
-import sys, os, os.path, urllib.parse, datetime, re, hashlib, base64
+import sys, os, os.path, urllib.parse, datetime, re, hashlib, base64, glob, io, struct
 import ipaddress
 import rtyaml
 import dns.resolver
 
 from mailconfig import get_mail_domains
-from utils import shell, load_env_vars_from_file, safe_domain_name, sort_domains
+from utils import shell, load_env_vars_from_file, safe_domain_name, sort_domains, file_cache_key, timed
 
 def get_dns_domains(env):
 	# Add all domain names in use by email users and mail aliases and ensure
@@ -50,85 +50,146 @@ def get_dns_zones(env):
 
 	return zonefiles
 
-def do_dns_update(env, force=False):
-	# What domains (and their zone filenames) should we build?
-	domains = get_dns_domains(env)
-	zonefiles = get_dns_zones(env)
-
-	# Custom records to add to zones.
-	additional_records = list(get_custom_dns_config(env))
-	from web_update import get_default_www_redirects
-	www_redirect_domains = get_default_www_redirects(env)
-
-	# Write zone files.
-	os.makedirs('/etc/nsd/zones', exist_ok=True)
-	updated_domains = []
-	for i, (domain, zonefile) in enumerate(zonefiles):
-		# Build the records to put in the zone.
-		records = build_zone(domain, domains, additional_records, www_redirect_domains, env)
-
-		# See if the zone has changed, and if so update the serial number
-		# and write the zone file.
-		if not write_nsd_zone(domain, "/etc/nsd/zones/" + zonefile, records, env, force):
-			# Zone was not updated. There were no changes.
-			continue
-
-		# If this is a .justtesting.email domain, then post the update.
-		try:
-			justtestingdotemail(domain, records)
-		except:
-			# Hmm. Might be a network issue. If we stop now, will we end
-			# up in an inconsistent state? Let's just continue.
-			pass
-
-		# Mark that we just updated this domain.
-		updated_domains.append(domain)
-
-		# Sign the zone.
-		#
-		# Every time we sign the zone we get a new result, which means
-		# we can't sign a zone without bumping the zone's serial number.
-		# Thus we only sign a zone if write_nsd_zone returned True
-		# indicating the zone changed, and thus it got a new serial number.
-		# write_nsd_zone is smart enough to check if a zone's signature
-		# is nearing expiration and if so it'll bump the serial number
-		# and return True so we get a chance to re-sign it.
-		sign_zone(domain, zonefile, env)
-
-	# Now that all zones are signed (some might not have changed and so didn't
-	# just get signed now, but were before) update the zone filename so nsd.conf
-	# uses the signed file.
-	for i in range(len(zonefiles)):
-		zonefiles[i][1] += ".signed"
-
-	# Write the main nsd.conf file.
-	if write_nsd_conf(zonefiles, additional_records, env):
-		# Make sure updated_domains contains *something* if we wrote an updated
-		# nsd.conf so that we know to restart nsd.
-		if len(updated_domains) == 0:
-			updated_domains.append("DNS configuration")
-
-	# Kick nsd if anything changed.
-	if len(updated_domains) > 0:
-		shell('check_call', ["/usr/sbin/service", "nsd", "restart"])
-
-	# Write the OpenDKIM configuration tables.
-	if write_opendkim_tables(domains, env):
-		# Settings changed. Kick opendkim.
-		shell('check_call', ["/usr/sbin/service", "opendkim", "restart"])
-		if len(updated_domains) == 0:
-			# If this is the only thing that changed?
-			updated_domains.append("OpenDKIM configuration")
-
+def do_dns_update(env, force=False, zones=None):
+	# Update DNS and return a short summary of what changed.
+	updated_domains = do_dns_update_ex(env, force=force, zones=zones)["updated"]
 	if len(updated_domains) == 0:
 		# if nothing was updated (except maybe OpenDKIM's files), don't show any output
 		return ""
 	else:
 		return "updated DNS: " + ",".join(updated_domains) + "\n"
 
+def do_dns_update_ex(env, force=False, zones=None, dry_run=False):
+	# Update DNS and return a report of what changed: the record-level changes
+	# in each zone and how long each stage took, overall and per zone, in
+	# seconds. With dry_run, nothing is written, signed, or restarted and the
+	# report says what would have changed.
+	report = {
+		"dry_run": dry_run,
+		"updated": [],
+		"zones": { },
+		"timings": { },
+	}
+	timings = report["timings"]
+	updated_domains = report["updated"]
+
+	with timed(timings, "total"):
+		with timed(timings, "prepare"):
+			# What domains (and their zone filenames) should we build? If `zones`
+			# is given, only those zones are rebuilt and the others are left as is.
+			domains = get_dns_domains(env)
+			zonefiles = get_dns_zones(env)
+
+			# Custom records to add to zones.
+			additional_records = get_custom_dns_config(env)
+			from web_update import get_default_www_redirects
+			www_redirect_domains = get_default_www_redirects(env)
+			tlsa_records = get_web_tlsa_records(env)
+
+		# Write zone files.
+		if not dry_run:
+			os.makedirs('/etc/nsd/zones', exist_ok=True)
+
+		# The DNSSEC keys are loaded when the first zone needs signing, and
+		# shared by all of the zones.
+		dnssec_keys = None
+		try:
+			for i, (domain, zonefile) in enumerate(zonefiles):
+				if zones is not None and domain not in zones:
+					continue
+
+				zone_report = { "changed": False, "timings": { } }
+				report["zones"][domain] = zone_report
+
+				# Build the records to put in the zone.
+				with timed(zone_report["timings"], "build"), timed(timings, "build"):
+					records = build_zone(domain, domains, additional_records, www_redirect_domains, tlsa_records, env)
+
+				# See what records change, against the zone file as it is before
+				# it's rewritten.
+				with timed(zone_report["timings"], "diff"), timed(timings, "diff"):
+					diff = diff_nsd_zone("/etc/nsd/zones/" + zonefile, records)
+
+				# See if the zone has changed, and if so update the serial number
+				# and write the zone file.
+				with timed(zone_report["timings"], "write"), timed(timings, "write"):
+					zone_report["changed"] = write_nsd_zone(domain, "/etc/nsd/zones/" + zonefile, records, env, force, dry_run=dry_run)
+				if zone_report["changed"]:
+					zone_report.update(diff)
+				if not zone_report["changed"]:
+					# Zone was not updated. There were no changes.
+					continue
+
+				# Mark that we just updated this domain.
+				updated_domains.append(domain)
+				if dry_run:
+					continue
+
+				# If this is a .justtesting.email domain, then post the update.
+				try:
+					justtestingdotemail(domain, records)
+				except:
+					# Hmm. Might be a network issue. If we stop now, will we end
+					# up in an inconsistent state? Let's just continue.
+					pass
+
+				# Sign the zone.
+				#
+				# Every time we sign the zone we get a new result, which means
+				# we can't sign a zone without bumping the zone's serial number.
+				# Thus we only sign a zone if write_nsd_zone returned True
+				# indicating the zone changed, and thus it got a new serial number.
+				# write_nsd_zone is smart enough to check if a zone's signature
+				# is nearing expiration and if so it'll bump the serial number
+				# and return True so we get a chance to re-sign it.
+				if dnssec_keys is None:
+					dnssec_keys = load_dnssec_keys(env)
+				sign_zone(domain, zonefile, env, timings=zone_report["timings"], dnssec_keys=dnssec_keys)
+				for stage in ("sign", "ds"):
+					timings[stage] = timings.get(stage, 0) + zone_report["timings"][stage]
+		finally:
+			if dnssec_keys is not None:
+				import shutil
+				shutil.rmtree(dnssec_keys[0])
+
+		# Now that all zones are signed (some might not have changed and so didn't
+		# just get signed now, but were before) update the zone filename so nsd.conf
+		# uses the signed file.
+		for i in range(len(zonefiles)):
+			zonefiles[i][1] += ".signed"
+
+		# Write the main nsd.conf file.
+		with timed(timings, "nsd_conf"):
+			if write_nsd_conf(zonefiles, additional_records, env, dry_run=dry_run):
+				# Make sure updated_domains contains *something* if we wrote an updated
+				# nsd.conf so that we know to restart nsd.
+				if len(updated_domains) == 0:
+					updated_domains.append("DNS configuration")
+
+		# Kick nsd if anything changed.
+		if len(updated_domains) > 0 and not dry_run:
+			with timed(timings, "nsd_restart"):
+				shell('check_call', ["/usr/sbin/service", "nsd", "restart"])
+
+		# Write the OpenDKIM configuration tables.
+		with timed(timings, "opendkim"):
+			if write_opendkim_tables(domains, env, dry_run=dry_run):
+				# Settings changed. Kick opendkim.
+				if not dry_run:
+					shell('check_call', ["/usr/sbin/service", "opendkim", "restart"])
+				if len(updated_domains) == 0:
+					# If this is the only thing that changed?
+					updated_domains.append("OpenDKIM configuration")
+
+	return report
+
 ########################################################################
 
-def build_zone(domain, all_domains, additional_records, www_redirect_domains, env, is_zone=True):
+# The TXT record policy prefixes that build_zone checks for when deciding
+# whether to add its own SPF, DKIM and DMARC records.
+TXT_POLICY_PREFIXES = ("v=spf1 ", "v=DKIM1; ", "v=DMARC1; ")
+
+def build_zone(domain, all_domains, additional_records, www_redirect_domains, tlsa_records, env, is_zone=True):
 	records = []
 
 	# For top-level zones, define the authoritative name servers.
@@ -179,7 +240,7 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 	subdomains = [d for d in all_domains if d.endswith("." + domain)]
 	for subdomain in subdomains:
 		subdomain_qname = subdomain[0:-len("." + domain)]
-		subzone = build_zone(subdomain, [], additional_records, www_redirect_domains, env, is_zone=False)
+		subzone = build_zone(subdomain, [], additional_records, www_redirect_domains, tlsa_records, env, is_zone=False)
 		for child_qname, child_rtype, child_value, child_explanation in subzone:
 			if child_qname == None:
 				child_qname = subdomain_qname
@@ -187,18 +248,33 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 				child_qname += "." + subdomain_qname
 			records.append((child_qname, child_rtype, child_value, child_explanation))
 
-	has_rec_base = list(records) # clone current state
+	# Index the records by qname and rtype so that checking whether a record is
+	# already set doesn't scan the whole zone, which gets slow on zones with many
+	# custom records. TXT records are also indexed by the policy prefixes we look
+	# for below.
+	rec_index = { }
+	def index_rec(rec):
+		rec_index.setdefault((rec[0], rec[1]), []).append(rec[2])
+		if rec[1] == "TXT":
+			for prefix in TXT_POLICY_PREFIXES:
+				if rec[2].startswith(prefix):
+					rec_index[(rec[0], rec[1], prefix)] = True
 	def has_rec(qname, rtype, prefix=None):
-		for rec in has_rec_base:
-			if rec[0] == qname and rec[1] == rtype and (prefix is None or rec[2].startswith(prefix)):
-				return True
-		return False
+		if prefix is None:
+			return (qname, rtype) in rec_index
+		if rtype == "TXT" and prefix in TXT_POLICY_PREFIXES:
+			return (qname, rtype, prefix) in rec_index
+		return any(value.startswith(prefix) for value in rec_index.get((qname, rtype), []))
+	for rec in records:
+		index_rec(rec)
 
 	# The user may set other records that don't conflict with our settings.
 	# Don't put any TXT records above this line, or it'll prevent any custom TXT records.
+	custom_records = []
 	for qname, rtype, value in filter_custom_records(domain, additional_records):
 		# Don't allow custom records for record types that override anything above.
-		# But allow multiple custom records for the same rtype --- see how has_rec_base is used.
+		# But allow multiple custom records for the same rtype --- the custom records
+		# aren't indexed until after this loop.
 		if has_rec(qname, rtype): continue
 
 		# The "local" keyword on A/AAAA records are short-hand for our own IP.
@@ -210,11 +286,18 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 				value = env["PUBLIC_IPV6"]
 			else:
 				continue
-		records.append((qname, rtype, value, "(Set by user.)"))
+		custom_records.append((qname, rtype, value, "(Set by user.)"))
+
+	# From here on, every record we add is immediately taken into account
+	# when checking for existing records.
+	def add_rec(rec):
+		records.append(rec)
+		index_rec(rec)
+	for rec in custom_records:
+		add_rec(rec)
 
 	# Add defaults if not overridden by the user's custom settings (and not otherwise configured).
 	# Any "CNAME" record on the qname overrides A and AAAA.
-	has_rec_base = records
 	defaults = [
 		(None,  "A",    env["PUBLIC_IP"],       "Required. May have a different value. Sets the IP address that %s resolves to for web hosting and other services besides mail. The A record must be present but its value does not affect mail delivery." % domain),
 		(None,  "AAAA", env.get('PUBLIC_IPV6'), "Optional. Sets the IPv6 address that %s resolves to, e.g. for web hosting. (It is not necessary for receiving mail on this domain.)" % domain),
@@ -232,36 +315,39 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 		# (2) there is not a CNAME record already, since you can't set both and who knows what takes precedence
 		# (2) there is not an A record already (if this is an A record this is a dup of (1), and if this is an AAAA record then don't set a default AAAA record if the user sets a custom A record, since the default wouldn't make sense and it should not resolve if the user doesn't provide a new AAAA record)
 		if not has_rec(qname, rtype) and not has_rec(qname, "CNAME") and not has_rec(qname, "A"):
-			records.append((qname, rtype, value, explanation))
+			add_rec((qname, rtype, value, explanation))
+
+	# Add DANE TLSA records for HTTPS matching the domain's own certificate, if it
+	# has one (see get_web_tlsa_records). Skip if the user has set their own.
+	if not has_rec("_443._tcp", "TLSA"):
+		for value in tlsa_records.get(domain, []):
+			add_rec(("_443._tcp", "TLSA", value, "Optional. When DNSSEC is enabled, advertises to web browsers and other clients connecting to %s over HTTPS which certificate they should expect." % domain))
 
 	# SPF record: Permit the box ('mx', see above) to send mail on behalf of
 	# the domain, and no one else.
 	# Skip if the user has set a custom SPF record.
 	if not has_rec(None, "TXT", prefix="v=spf1 "):
-		records.append((None,  "TXT", 'v=spf1 mx -all', "Recommended. Specifies that only the box is permitted to send @%s mail." % domain))
+		add_rec((None,  "TXT", 'v=spf1 mx -all', "Recommended. Specifies that only the box is permitted to send @%s mail." % domain))
 
 	# Append the DKIM TXT record to the zone as generated by OpenDKIM.
 	# Skip if the user has set a DKIM record already.
-	opendkim_record_file = os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.txt')
-	with open(opendkim_record_file) as orf:
-		m = re.match(r'(\S+)\s+IN\s+TXT\s+\( "([^"]+)"\s+"([^"]+)"\s*\)', orf.read(), re.S)
-		val = m.group(2) + m.group(3)
-		if not has_rec(m.group(1), "TXT", prefix="v=DKIM1; "):
-			records.append((m.group(1), "TXT", val, "Recommended. Provides a way for recipients to verify that this machine sent @%s mail." % domain))
+	dkim_qname, dkim_value = get_opendkim_record(env)
+	if not has_rec(dkim_qname, "TXT", prefix="v=DKIM1; "):
+		add_rec((dkim_qname, "TXT", dkim_value, "Recommended. Provides a way for recipients to verify that this machine sent @%s mail." % domain))
 
 	# Append a DMARC record.
 	# Skip if the user has set a DMARC record already.
 	if not has_rec("_dmarc", "TXT", prefix="v=DMARC1; "):
-		records.append(("_dmarc", "TXT", 'v=DMARC1; p=quarantine', "Recommended. Specifies that mail that does not originate from the box but claims to be from @%s or which does not have a valid DKIM signature is suspect and should be quarantined by the recipient's mail system." % domain))
+		add_rec(("_dmarc", "TXT", 'v=DMARC1; p=quarantine', "Recommended. Specifies that mail that does not originate from the box but claims to be from @%s or which does not have a valid DKIM signature is suspect and should be quarantined by the recipient's mail system." % domain))
 
 	# For any subdomain with an A record but no SPF or DMARC record, add strict policy records.
 	all_resolvable_qnames = set(r[0] for r in records if r[1] in ("A", "AAAA"))
 	for qname in all_resolvable_qnames:
 		if not has_rec(qname, "TXT", prefix="v=spf1 "):
-			records.append((qname,  "TXT", 'v=spf1 -all', "Recommended. Prevents use of this domain name for outbound mail by specifying that no servers are valid sources for mail from @%s. If you do send email from this domain name you should either override this record such that the SPF rule does allow the originating server, or, take the recommended approach and have the box handle mail for this domain (simply add any receiving alias at this domain name to make this machine treat the domain name as one of its mail domains)." % (qname + "." + domain)))
+			add_rec((qname,  "TXT", 'v=spf1 -all', "Recommended. Prevents use of this domain name for outbound mail by specifying that no servers are valid sources for mail from @%s. If you do send email from this domain name you should either override this record such that the SPF rule does allow the originating server, or, take the recommended approach and have the box handle mail for this domain (simply add any receiving alias at this domain name to make this machine treat the domain name as one of its mail domains)." % (qname + "." + domain)))
 		dmarc_qname = "_dmarc" + ("" if qname is None else "." + qname)
 		if not has_rec(dmarc_qname, "TXT", prefix="v=DMARC1; "):
-			records.append((dmarc_qname, "TXT", 'v=DMARC1; p=reject', "Recommended. Prevents use of this domain name for outbound mail by specifying that the SPF rule should be honoured for mail from @%s." % (qname + "." + domain)))
+			add_rec((dmarc_qname, "TXT", 'v=DMARC1; p=reject', "Recommended. Prevents use of this domain name for outbound mail by specifying that the SPF rule should be honoured for mail from @%s." % (qname + "." + domain)))
 
 
 	# Sort the records. The None records *must* go first in the nsd zone file. Otherwise it doesn't matter.
@@ -271,29 +357,64 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 
 ########################################################################
 
+_opendkim_record_cache = None
+def get_opendkim_record(env):
+	# Returns the qname and value of the DKIM TXT record generated by OpenDKIM.
+	# Every zone gets the same record, so only parse the file again if it has
+	# changed.
+	global _opendkim_record_cache
+	opendkim_record_file = os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.txt')
+	cache_key = (opendkim_record_file, file_cache_key(opendkim_record_file))
+	if _opendkim_record_cache is not None and _opendkim_record_cache[0] == cache_key:
+		return _opendkim_record_cache[1]
+
+	with open(opendkim_record_file) as orf:
+		m = re.match(r'(\S+)\s+IN\s+TXT\s+\( "([^"]+)"\s+"([^"]+)"\s*\)', orf.read(), re.S)
+		record = (m.group(1), m.group(2) + m.group(3))
+
+	_opendkim_record_cache = (cache_key, record)
+	return record
+
 def build_tlsa_record(env):
 	# A DANE TLSA record in DNS specifies that connections on a port
 	# must use TLS and the certificate must match a particular certificate.
 	#
 	# Thanks to http://blog.huque.com/2012/10/dnssec-and-certificates.html
 	# for explaining all of this!
+	#
+	# For SMTP we match the whole certificate (see ssl_certificates.py).
+	return get_certificate_tlsa_records(os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem"))[0]
+
+def get_web_tlsa_records(env):
+	# Map each domain we serve a website for that has its own certificate to
+	# the TLSA records for that certificate. Domains that nginx serves with
+	# PRIMARY_HOSTNAME's certificate or another domain's get none, so that
+	# their zones don't change with whichever certificate they fall back to.
+	# Only domains with a certificate file of their own are looked at any
+	# further. Domains whose certificate can't be read are skipped.
+	from web_update import get_web_domains, get_domain_ssl_files
+	ret = { }
+	for domain in get_web_domains(env):
+		if domain == env['PRIMARY_HOSTNAME']:
+			own_certificate = os.path.join(env["STORAGE_ROOT"], 'ssl/ssl_certificate.pem')
+		else:
+			own_certificate = os.path.join(env["STORAGE_ROOT"], 'ssl/%s/ssl_certificate.pem' % safe_domain_name(domain))
+			if not os.path.exists(own_certificate): continue
+			ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env)
+			if ssl_certificate != own_certificate: continue
+		try:
+			ret[domain] = get_certificate_tlsa_records(own_certificate)
+		except (OSError, ValueError):
+			continue
+	return ret
 
-	# Get the hex SHA256 of the DER-encoded server certificate:
-	certder = shell("check_output", [
-		"/usr/bin/openssl",
-		"x509",
-		"-in", os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem"),
-		"-outform", "DER"
-		],
-		return_bytes=True)
-	certhash = hashlib.sha256(certder).hexdigest()
-
-	# Specify the TLSA parameters:
-	# 3: This is the certificate that the client should trust. No CA is needed.
-	# 0: The whole certificate is matched.
-	# 1: The certificate is SHA256'd here.
-	return "3 0 1 " + certhash
+def get_certificate_tlsa_records(ssl_certificate):
+	# Returns the values of the TLSA records that match the (first) certificate
+	# in a PEM file, which are remembered until the certificate file changes.
+	from ssl_certificates import get_certificate_info
+	return get_certificate_info(ssl_certificate)["tlsa"]
 
+_sshfp_cache = None
 def build_sshfp_records():
 	# The SSHFP record is a way for us to embed this server's SSH public
 	# key fingerprint into the DNS so that remote hosts have an out-of-band
@@ -310,30 +431,78 @@ def build_sshfp_records():
 		"ssh-rsa": 1,
 		"ssh-dss": 2,
 		"ecdsa-sha2-nistp256": 3,
+		"ssh-ed25519": 4,
 	}
 
-	# Get our local fingerprints by running ssh-keyscan. The output looks
-	# like the known_hosts file: hostname, keytype, fingerprint. The order
-	# of the output is arbitrary, so sort it to prevent spurrious updates
-	# to the zone file (that trigger bumping the serial number).
-	keys = shell("check_output", ["ssh-keyscan", "localhost"])
-	for key in sorted(keys.split("\n")):
+	# Get our local public keys. Read them from sshd's host key files, which
+	# only change when the keys are regenerated, so cache what we read until
+	# the files change. This used to run ssh-keyscan against our own sshd on
+	# every zone build, which is slow and times out if sshd is slow. Fall back
+	# to that if the key files can't be read. The output of both looks like
+	# the known_hosts file: (hostname,) keytype, public key.
+	global _sshfp_cache
+	key_files = sorted(glob.glob("/etc/ssh/ssh_host_*_key.pub"))
+	cache_key = [(fn, file_cache_key(fn)) for fn in key_files]
+	if _sshfp_cache is not None and _sshfp_cache[0] == cache_key:
+		keys = _sshfp_cache[1]
+	else:
+		try:
+			keys = []
+			for fn in key_files:
+				with open(fn) as f:
+					keys.extend(f.read().split("\n"))
+			if len(keys) == 0:
+				raise OSError("No SSH host key files.")
+			_sshfp_cache = (cache_key, keys)
+		except OSError:
+			keys = shell("check_output", ["ssh-keyscan", "localhost"]).split("\n")
+
+	# The order of the keys is arbitrary, so sort the records to prevent
+	# spurrious updates to the zone file (that trigger bumping the serial
+	# number).
+	records = []
+	for key in keys:
 		if key.strip() == "" or key[0] == "#": continue
 		try:
-			host, keytype, pubkey = key.split(" ")
-			yield "%d %d ( %s )" % (
+			fields = key.split(" ")
+			if fields[0] not in algorithm_number:
+				fields.pop(0) # ssh-keyscan output starts with the hostname
+			keytype, pubkey = fields[0:2]
+			records.append("%d %d ( %s )" % (
 				algorithm_number[keytype],
 				2, # specifies we are using SHA-256 on next line
 				hashlib.sha256(base64.b64decode(pubkey)).hexdigest().upper(),
-				)
+				))
 		except:
 			# Lots of things can go wrong. Don't let it disturb the DNS
 			# zone.
 			pass
+	return sorted(records)
 
 ########################################################################
 
-def write_nsd_zone(domain, zonefile, records, env, force):
+def format_zone_record(subdomain, querytype, value):
+	# Returns a record as a line in an nsd zone file.
+	if querytype == "TXT":
+		value = value.replace('\\', '\\\\') # escape backslashes
+		value = value.replace('"', '\\"') # escape quotes
+		value = '"' + value + '"' # wrap in quotes
+	return (subdomain or "") + "\tIN\t" + querytype + "\t" + value + "\n"
+
+def diff_nsd_zone(zonefile, records):
+	# Compares records to the records in an existing zone file and returns
+	# the records (as zone file lines) that would be added and removed.
+	new_lines = set(format_zone_record(*rec[0:3]).rstrip("\n") for rec in records)
+	old_lines = set()
+	if os.path.exists(zonefile):
+		with open(zonefile) as f:
+			old_lines = set(line.rstrip("\n") for line in f if "\tIN\t" in line)
+	return {
+		"added": sorted(new_lines - old_lines),
+		"removed": sorted(old_lines - new_lines),
+	}
+
+def write_nsd_zone(domain, zonefile, records, env, force, dry_run=False):
 	# On the $ORIGIN line, there's typically a ';' comment at the end explaining
 	# what the $ORIGIN line does. Any further data after the domain confuses
 	# ldns-signzone, however. It used to say '; default zone domain'.
@@ -345,7 +514,7 @@ def write_nsd_zone(domain, zonefile, records, env, force):
 	# http://www.peerwisdom.org/2013/05/15/dns-understanding-the-soa-record/
 
 
-	zone = """
+	zone_header = """
 $ORIGIN {domain}.
 $TTL 1800           ; default time to live
 
@@ -359,18 +528,13 @@ $TTL 1800           ; default time to live
 """
 
 	# Replace replacement strings.
-	zone = zone.format(domain=domain, primary_domain=env["PRIMARY_HOSTNAME"])
+	zone = io.StringIO()
+	zone.write(zone_header.format(domain=domain, primary_domain=env["PRIMARY_HOSTNAME"]))
 
 	# Add records.
 	for subdomain, querytype, value, explanation in records:
-		if subdomain:
-			zone += subdomain
-		zone += "\tIN\t" + querytype + "\t"
-		if querytype == "TXT":
-			value = value.replace('\\', '\\\\') # escape backslashes
-			value = value.replace('"', '\\"') # escape quotes
-			value = '"' + value + '"' # wrap in quotes
-		zone += value + "\n"
+		zone.write(format_zone_record(subdomain, querytype, value))
+	zone = zone.getvalue()
 
 	# DNSSEC requires re-signing a zone periodically. That requires
 	# bumping the serial number even if no other records have changed.
@@ -428,6 +592,9 @@ $TTL 1800           ; default time to live
 
 	zone = zone.replace("__SERIAL__", serial)
 
+	if dry_run:
+		return True # file would be updated
+
 	# Write the zone file.
 	with open(zonefile, "w") as f:
 		f.write(zone)
@@ -436,7 +603,7 @@ $TTL 1800           ; default time to live
 
 ########################################################################
 
-def write_nsd_conf(zonefiles, additional_records, env):
+def write_nsd_conf(zonefiles, additional_records, env, dry_run=False):
 	# Write the list of zones to a configuration file.
 	nsd_conf_file = "/etc/nsd/zones.conf"
 	nsdconf = ""
@@ -468,6 +635,9 @@ zone:
 			if f.read() == nsdconf:
 				return False
 
+	if dry_run:
+		return True
+
 	# Write out new contents and return True to signal that
 	# configuration changed.
 	with open(nsd_conf_file, "w") as f:
@@ -489,80 +659,163 @@ def dnssec_choose_algo(domain, env):
 	# on existing users. We'll probably want to migrate to SHA256 later.
 	return "RSASHA1-NSEC3-SHA1"
 
-def sign_zone(domain, zonefile, env):
+_dnssec_ksk_cache = { }
+def get_dnssec_ksk(algo, env):
+	# Returns the DNSKEY record of our key-signing key for a DNSSEC algorithm
+	# as a tuple of the flags, protocol, algorithm, base64 public key, and key
+	# tag. The key files are only read again when they change, which is when
+	# the keys are rotated.
+	conf_fn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/%s.conf' % algo)
+	cache_key = file_cache_key(conf_fn)
+	if algo in _dnssec_ksk_cache and _dnssec_ksk_cache[algo][0] == cache_key:
+		key_fn, key_cache_key, ksk = _dnssec_ksk_cache[algo][1]
+		if file_cache_key(key_fn) == key_cache_key:
+			return ksk
+
+	dnssec_keys = load_env_vars_from_file(conf_fn)
+	if dnssec_keys.get("KSK", "").strip() == "": raise Exception("DNSSEC is not properly set up.")
+	key_fn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys["KSK"] + ".key")
+	key_cache_key = file_cache_key(key_fn)
+	if key_cache_key is None: raise Exception("DNSSEC is not properly set up.")
+	with open(key_fn) as f:
+		m = re.search(r"\sDNSKEY\s+(\d+)\s+(\d+)\s+(\d+)\s+([A-Za-z0-9+/=]+)", f.read())
+	if not m: raise Exception("DNSSEC is not properly set up.")
+	flags, protocol, algorithm = int(m.group(1)), int(m.group(2)), int(m.group(3))
+	pubkey = m.group(4)
+
+	# Compute the key tag from the DNSKEY RDATA (RFC 4034 Appendix B).
+	rdata = struct.pack("!HBB", flags, protocol, algorithm) + base64.b64decode(pubkey)
+	keytag = 0
+	for i, b in enumerate(rdata):
+		keytag += b if i & 1 else b << 8
+	keytag = (keytag + ((keytag >> 16) & 0xFFFF)) & 0xFFFF
+
+	ksk = (flags, protocol, algorithm, pubkey, keytag)
+	_dnssec_ksk_cache[algo] = (cache_key, (key_fn, key_cache_key, ksk))
+	return ksk
+
+_ds_cache = { }
+def get_ds_records(domain, env):
+	# Returns the values of the DS records that the domain's registrar should
+	# publish for the domain's KSK, as "keytag algorithm digesttype digest".
+	# Multiple forms may be valid depending on the digest type, so both are
+	# returned, but only one should actually be deployed, preferably the
+	# first (SHA-256).
+	#
+	# Since the same key is used for all domains, the DS record is specific to
+	# the domain only because the digest covers the domain name. Compute it here
+	# rather than with ldns-key2ds, and remember it until the KSK changes.
+	flags, protocol, algorithm, pubkey, keytag = get_dnssec_ksk(dnssec_choose_algo(domain, env), env)
+	cache_key = (domain, keytag, algorithm)
+	if cache_key in _ds_cache:
+		return _ds_cache[cache_key]
+
+	# The digest is over the owner name in canonical wire format followed by
+	# the DNSKEY RDATA (RFC 4034 Section 5.1.4).
+	owner = b"".join(bytes([len(label)]) + label for label in domain.lower().encode("idna").split(b".")) + b"\0"
+	rdata = struct.pack("!HBB", flags, protocol, algorithm) + base64.b64decode(pubkey)
+	records = [
+		"%d %d %d %s" % (keytag, algorithm, digest_type, hash_func(owner + rdata).hexdigest())
+		for digest_type, hash_func in ((2, hashlib.sha256), (1, hashlib.sha1))
+	]
+
+	_ds_cache[cache_key] = records
+	return records
+
+def load_dnssec_keys(env):
+	# Loads our DNSSEC keys so that many zones can be signed with them. Returns
+	# a tuple of a directory and a dict mapping each algorithm to the KSK and
+	# ZSK file names and .key file contents.
+	#
+	# ldns-signzone reads keys from files, so the private keys are written once
+	# into the directory: a new directory that only we (root) can read, on
+	# /dev/shm when possible so that the keys are never written to a disk.
+	# sign_zone then only writes each zone's (public) .key files there. The
+	# caller must remove the directory with shutil.rmtree when done.
+	import tempfile
+	keys = { }
+	key_dir = tempfile.mkdtemp(prefix="mailinabox-dnssec-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+	try:
+		for algo in ("RSASHA1-NSEC3-SHA1", "RSASHA256"):
+			conf_fn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/%s.conf' % algo)
+			if not os.path.exists(conf_fn): continue
+			dnssec_keys = load_env_vars_from_file(conf_fn)
+			keys[algo] = { }
+			for key in ("KSK", "ZSK"):
+				if dnssec_keys.get(key, "").strip() == "": raise Exception("DNSSEC is not properly set up.")
+				keyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys[key])
+				if not os.path.exists(keyfn + ".key") or not os.path.exists(keyfn + ".private"): raise Exception("DNSSEC is not properly set up.")
+				with open(keyfn + ".key") as f:
+					keydata = f.read()
+				with open(keyfn + ".private") as f:
+					privatedata = f.read()
+				with open(os.open(os.path.join(key_dir, dnssec_keys[key] + ".private"), os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o600), "w") as f:
+					f.write(privatedata)
+				keys[algo][key] = (dnssec_keys[key], keydata)
+	except:
+		import shutil
+		shutil.rmtree(key_dir)
+		raise
+	return key_dir, keys
+
+def sign_zone(domain, zonefile, env, timings=None, dnssec_keys=None):
+	# Signs a zone. dnssec_keys is what load_dnssec_keys returns, and if it
+	# isn't given the keys are loaded just for this zone.
+	if timings is None: timings = { }
+	if dnssec_keys is None:
+		import shutil
+		dnssec_keys = load_dnssec_keys(env)
+		try:
+			return sign_zone(domain, zonefile, env, timings=timings, dnssec_keys=dnssec_keys)
+		finally:
+			shutil.rmtree(dnssec_keys[0])
+
+	key_dir, keys = dnssec_keys
 	algo = dnssec_choose_algo(domain, env)
-	dnssec_keys = load_env_vars_from_file(os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/%s.conf' % algo))
+	if algo not in keys: raise Exception("DNSSEC is not properly set up.")
 
 	# In order to use the same keys for all domains, we have to generate
 	# a new .key file with a DNSSEC record for the specific domain. We
 	# can reuse the same key, but it won't validate without a DNSSEC
-	# record specifically for the domain.
-	#
-	# Copy the .key and .private files to /tmp to patch them up.
-	#
-	# Use os.umask and open().write() to securely create a copy that only
-	# we (root) can read.
-	files_to_kill = []
+	# record specifically for the domain. The private key doesn't name
+	# the domain, so link to the one copy of it.
+	zone_keys = { }
 	for key in ("KSK", "ZSK"):
-		if dnssec_keys.get(key, "").strip() == "": raise Exception("DNSSEC is not properly set up.")
-		oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys[key])
-		newkeyfn = '/tmp/' + dnssec_keys[key].replace("_domain_", domain)
-		dnssec_keys[key] = newkeyfn
-		for ext in (".private", ".key"):
-			if not os.path.exists(oldkeyfn + ext): raise Exception("DNSSEC is not properly set up.")
-			with open(oldkeyfn + ext, "r") as fr:
-				keydata = fr.read()
-			keydata = keydata.replace("_domain_", domain) # trick ldns-signkey into letting our generic key be used by this zone
-			fn = newkeyfn + ext
-			prev_umask = os.umask(0o77) # ensure written file is not world-readable
-			try:
-				with open(fn, "w") as fw:
-					fw.write(keydata)
-			finally:
-				os.umask(prev_umask) # other files we write should be world-readable
-			files_to_kill.append(fn)
+		keyfn, keydata = keys[algo][key]
+		zone_keys[key] = os.path.join(key_dir, keyfn.replace("_domain_", domain))
+		with open(zone_keys[key] + ".key", "w") as f:
+			f.write(keydata.replace("_domain_", domain)) # trick ldns-signkey into letting our generic key be used by this zone
+		if not os.path.lexists(zone_keys[key] + ".private"):
+			os.symlink(keyfn + ".private", zone_keys[key] + ".private")
 
 	# Do the signing.
 	expiry_date = (datetime.datetime.now() + datetime.timedelta(days=30)).strftime("%Y%m%d")
-	shell('check_call', ["/usr/bin/ldns-signzone",
-		# expire the zone after 30 days
-		"-e", expiry_date,
+	with timed(timings, "sign"):
+		shell('check_call', ["/usr/bin/ldns-signzone",
+			# expire the zone after 30 days
+			"-e", expiry_date,
 
-		# use NSEC3
-		"-n",
+			# use NSEC3
+			"-n",
 
-		# zonefile to sign
-		"/etc/nsd/zones/" + zonefile,
+			# zonefile to sign
+			"/etc/nsd/zones/" + zonefile,
 
-		# keys to sign with (order doesn't matter -- it'll figure it out)
-		dnssec_keys["KSK"],
-		dnssec_keys["ZSK"],
-	])
+			# keys to sign with (order doesn't matter -- it'll figure it out)
+			zone_keys["KSK"],
+			zone_keys["ZSK"],
+		])
 
-	# Create a DS record based on the patched-up key files. The DS record is specific to the
-	# zone being signed, so we can't use the .ds files generated when we created the keys.
-	# The DS record points to the KSK only. Write this next to the zone file so we can
-	# get it later to give to the user with instructions on what to do with it.
-	#
-	# We want to be able to validate DS records too, but multiple forms may be valid depending
-	# on the digest type. So we'll write all (both) valid records. Only one DS record should
-	# actually be deployed. Preferebly the first.
-	with open("/etc/nsd/zones/" + zonefile + ".ds", "w") as f:
-		for digest_type in ('2', '1'):
-			rr_ds = shell('check_output', ["/usr/bin/ldns-key2ds",
-				"-n", # output to stdout
-				"-" + digest_type, # 1=SHA1, 2=SHA256
-				dnssec_keys["KSK"] + ".key"
-			])
-			f.write(rr_ds)
-
-	# Remove our temporary file.
-	for fn in files_to_kill:
-		os.unlink(fn)
+	# Write the DS records for the zone next to the zone file, in the format
+	# ldns-key2ds used, for anything that looks for them there. The status
+	# checks get them from get_ds_records instead.
+	with timed(timings, "ds"), open("/etc/nsd/zones/" + zonefile + ".ds", "w") as f:
+		for ds in get_ds_records(domain, env):
+			f.write("%s.\t3600\tIN\tDS\t%s\n" % (domain, ds))
 
 ########################################################################
 
-def write_opendkim_tables(domains, env):
+def write_opendkim_tables(domains, env, dry_run=False):
 	# Append a record to OpenDKIM's KeyTable and SigningTable for each domain
 	# that we send mail from (zones and all subdomains).
 
@@ -605,9 +858,11 @@ def write_opendkim_tables(domains, env):
 					continue
 
 		# The contents needs to change.
+		did_update = True
+		if dry_run:
+			continue
 		with open("/etc/opendkim/" + filename, "w") as f:
 			f.write(content)
-		did_update = True
 
 	# Return whether the files changed. If they didn't change, there's
 	# no need to kick the opendkim process.
@@ -615,9 +870,36 @@ def write_opendkim_tables(domains, env):
 
 ########################################################################
 
+class CustomDnsRecords(list):
+	# A list of the (qname, rtype, value) records in custom.yaml, plus an index
+	# from each domain name to the records at or below it so that we don't have
+	# to scan every record for every zone we build.
+	def __init__(self, records):
+		super().__init__(records)
+		self.by_domain = { }
+		for rec in self:
+			labels = rec[0].split(".")
+			for i in range(len(labels)):
+				self.by_domain.setdefault(".".join(labels[i:]), []).append(rec)
+
+_custom_dns_cache = None
 def get_custom_dns_config(env):
+	# Returns a CustomDnsRecords list. This is called from lots of places, so
+	# the parsed file is cached until it changes. Callers must not modify the
+	# returned list.
+	global _custom_dns_cache
+	custom_dns_fn = os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')
+	cache_key = (custom_dns_fn, file_cache_key(custom_dns_fn))
+	if _custom_dns_cache is not None and _custom_dns_cache[0] == cache_key:
+		return _custom_dns_cache[1]
+
+	records = CustomDnsRecords(parse_custom_dns_config(custom_dns_fn))
+	_custom_dns_cache = (cache_key, records)
+	return records
+
+def parse_custom_dns_config(custom_dns_fn):
 	try:
-		custom_dns = rtyaml.load(open(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')))
+		custom_dns = rtyaml.load(open(custom_dns_fn))
 		if not isinstance(custom_dns, dict): raise ValueError() # caught below
 	except:
 		return [ ]
@@ -647,6 +929,10 @@ def get_custom_dns_config(env):
 				raise ValueError()
 
 def filter_custom_records(domain, custom_dns_iter):
+	# Only look at the records at or below the domain, if we have an index.
+	if domain is not None and isinstance(custom_dns_iter, CustomDnsRecords):
+		custom_dns_iter = custom_dns_iter.by_domain.get(domain, [])
+
 	for qname, rtype, value in custom_dns_iter:
 		# We don't count the secondary nameserver config (if present) as a record - that would just be
 		# confusing to users. Instead it is accessed/manipulated directly via (get/set)_custom_dns_config.
@@ -671,40 +957,55 @@ def write_custom_dns_config(config, env):
 	# We get a list of (qname, rtype, value) triples. Convert this into a
 	# nice dictionary format for storage on disk.
 	from collections import OrderedDict
-	config = list(config)
 	dns = OrderedDict()
-	seen_qnames = set()
-
-	# Process the qnames in the order we see them.
-	for qname in [rec[0] for rec in config]:
-		if qname in seen_qnames: continue
-		seen_qnames.add(qname)
-
-		records = [(rec[1], rec[2]) for rec in config if rec[0] == qname]
-		if len(records) == 1 and records[0][0] == "A":
-			dns[qname] = records[0][1]
-		else:
-			dns[qname] = OrderedDict()
-			seen_rtypes = set()
 
-			# Process the rtypes in the order we see them.
-			for rtype in [rec[0] for rec in records]:
-				if rtype in seen_rtypes: continue
-				seen_rtypes.add(rtype)
+	# Group the values by qname and then by rtype, in the order we see them.
+	for qname, rtype, value in config:
+		dns.setdefault(qname, OrderedDict()).setdefault(rtype, []).append(value)
 
-				values = [rec[1] for rec in records if rec[0] == rtype]
-				if len(values) == 1:
-					values = values[0]
-				dns[qname][rtype] = values
+	# Use the short forms where possible: A qname with a single A record maps
+	# to just the IP address, and a single value isn't wrapped in a list.
+	for qname, rtypes in dns.items():
+		if list(rtypes) == ["A"] and len(rtypes["A"]) == 1:
+			dns[qname] = rtypes["A"][0]
+			continue
+		for rtype, values in rtypes.items():
+			if len(values) == 1:
+				rtypes[rtype] = values[0]
 
 	# Write.
 	config_yaml = rtyaml.dump(dns)
 	with open(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml'), "w") as f:
 		f.write(config_yaml)
 
-def set_custom_dns_record(qname, rtype, value, action, env):
+	# Don't rely on the file's modification time to notice this change.
+	global _custom_dns_cache
+	_custom_dns_cache = None
+
+def normalize_custom_dns_record(qname, value):
+	# Puts a qname and value from the control panel or API into the form
+	# that custom.yaml stores. Domain names are stored in their IDNA (ASCII)
+	# form and record values must be ASCII-only, so other characters are
+	# dropped. Raises a ValueError if the qname isn't a valid domain name.
+	qname = qname.strip()
+	try:
+		qname.encode("ascii")
+	except UnicodeEncodeError:
+		try:
+			qname = qname.encode("idna").decode("ascii")
+		except UnicodeError:
+			raise ValueError("%s is not a valid domain name." % qname)
+	if value is not None:
+		value = value.encode("ascii", "ignore").decode("ascii").strip()
+	return qname, value
+
+def validate_custom_dns_record(qname, rtype, value, zones):
+	# Checks a record that is about to be set and returns the zone it goes in
+	# (None for the secondary nameserver setting) and its normalized rtype.
+	# Raises a ValueError if there's a problem.
+
 	# validate qname
-	for zone, fn in get_dns_zones(env):
+	for zone, fn in zones:
 		# It must match a zone apex or be a subdomain of a zone
 		# that we are otherwise hosting.
 		if qname == zone or qname.endswith("."+zone):
@@ -713,6 +1014,7 @@ def set_custom_dns_record(qname, rtype, value, action, env):
 		# No match.
 		if qname != "_secondary_nameserver":
 			raise ValueError("%s is not a domain name or a subdomain of a domain name managed by this box." % qname)
+		zone = None
 
 	# validate rtype
 	rtype = rtype.upper()
@@ -728,10 +1030,11 @@ def set_custom_dns_record(qname, rtype, value, action, env):
 		else:
 			raise ValueError("Unknown record type '%s'." % rtype)
 
-	# load existing config
-	config = list(get_custom_dns_config(env))
+	return zone, rtype
 
-	# update
+def apply_custom_dns_record(config, qname, rtype, value, action):
+	# Applies an add/set/remove action to a list of (qname, rtype, value)
+	# records. Returns the new list and whether anything changed.
 	newconfig = []
 	made_change = False
 	needs_add = True
@@ -739,7 +1042,7 @@ def set_custom_dns_record(qname, rtype, value, action, env):
 		if action == "add":
 			if (_qname, _rtype, _value) == (qname, rtype, value):
 				# Record already exists. Bail.
-				return False
+				return config, False
 		elif action == "set":
 			if (_qname, _rtype) == (qname, rtype):
 				if _value == value:
@@ -769,12 +1072,53 @@ def set_custom_dns_record(qname, rtype, value, action, env):
 		newconfig.append((qname, rtype, value))
 		made_change = True
 
+	return newconfig, made_change
+
+def set_custom_dns_record(qname, rtype, value, action, env):
+	# validate
+	zone, rtype = validate_custom_dns_record(qname, rtype, value, get_dns_zones(env))
+
+	# load existing config & update
+	config, made_change = apply_custom_dns_record(list(get_custom_dns_config(env)), qname, rtype, value, action)
+
 	if made_change:
 		# serialize & save
-		write_custom_dns_config(newconfig, env)
+		write_custom_dns_config(config, env)
 
 	return made_change
 
+def set_custom_dns_records(changes, env):
+	# Applies a list of (qname, rtype, value, action) changes all at once so
+	# that custom.yaml is rewritten just once. Every change is validated
+	# before anything is applied, so either all of the changes are made or,
+	# if a ValueError is raised, none of them are.
+	#
+	# Returns the set of zones that changed, or None if all zones are
+	# affected (i.e. when the secondary nameserver changed), so that the
+	# caller can rebuild just those zones.
+	zones = get_dns_zones(env)
+	validated = []
+	for qname, rtype, value, action in changes:
+		if action not in ("add", "set", "remove"):
+			raise ValueError("Invalid action: %s" % action)
+		zone, rtype = validate_custom_dns_record(qname, rtype, value, zones)
+		validated.append((zone, qname, rtype, value, action))
+
+	config = list(get_custom_dns_config(env))
+	changed_zones = set()
+	for zone, qname, rtype, value, action in validated:
+		config, made_change = apply_custom_dns_record(config, qname, rtype, value, action)
+		if made_change:
+			changed_zones.add(zone)
+
+	if len(changed_zones) > 0:
+		# serialize & save
+		write_custom_dns_config(config, env)
+
+	if None in changed_zones:
+		return None
+	return changed_zones
+
 ########################################################################
 
 def get_secondary_dns(custom_dns):
@@ -851,11 +1195,12 @@ def build_recommended_dns(env):
 	ret = []
 	domains = get_dns_domains(env)
 	zonefiles = get_dns_zones(env)
-	additional_records = list(get_custom_dns_config(env))
+	additional_records = get_custom_dns_config(env)
 	from web_update import get_default_www_redirects
 	www_redirect_domains = get_default_www_redirects(env)
+	tlsa_records = get_web_tlsa_records(env)
 	for domain, zonefile in zonefiles:
-		records = build_zone(domain, domains, additional_records, www_redirect_domains, env)
+		records = build_zone(domain, domains, additional_records, www_redirect_domains, tlsa_records, env)
 
 		# remove records that we don't dislay
 		records = [r for r in records if r[3] is not False]
@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+#
+# Reads our SSL certificates and private keys and remembers what is in
+# them, so that the many places that need to know about a certificate
+# (the nginx configuration, DNS, the status checks, and the control
+# panel) don't each have to run openssl on it. What's remembered about
+# a file is thrown away when the file changes.
+########################################################################
+
+import os, os.path, re, datetime, hashlib, threading
+
+from utils import file_cache_key
+
+_certificate_cache = { }
+def get_certificate_info(ssl_certificate):
+	# Returns a dict of information about the certificate at the top of
+	# the PEM file ssl_certificate:
+	#
+	# names: the set of domain names in the Subject Common Name and the
+	#   Subject Alternative Names, which may include wildcards
+	# expires: when the certificate expires, as a datetime in UTC
+	# public_key: the DER-encoded SubjectPublicKeyInfo in the certificate
+	# public_key_sha256: a hex digest of that, for comparing keys
+	# fingerprint: the SHA1 fingerprint, formatted like openssl formats it
+	# self_signed: whether the certificate was issued by its own subject
+	# tlsa: the values of the DANE TLSA records that match the certificate
+	# chain: the PEM text of the intermediate certificates after it
+	# certificate: the certificate itself, as a cryptography x509.Certificate
+	#
+	# Raises OSError if the file can't be read or ValueError if it doesn't
+	# start with a PEM-encoded certificate.
+	cache_key = file_cache_key(ssl_certificate)
+	if ssl_certificate in _certificate_cache and _certificate_cache[ssl_certificate][0] == cache_key:
+		return _certificate_cache[ssl_certificate][1]
+
+	with open(ssl_certificate) as f:
+		pem = f.read()
+	m = re.match(r"\s*(-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----)(.*)", pem, re.S)
+	if not m:
+		raise ValueError("%s is not a PEM-formatted certificate." % ssl_certificate)
+
+	from cryptography import x509
+	from cryptography.x509.oid import NameOID
+	from cryptography.hazmat.primitives import hashes, serialization
+	from cryptography.hazmat.backends import default_backend
+	cert = x509.load_pem_x509_certificate(m.group(1).encode("ascii"), default_backend())
+
+	# The names the certificate is good for.
+	names = set(a.value for a in cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME))
+	try:
+		names |= set(cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(x509.DNSName))
+	except x509.ExtensionNotFound:
+		pass
+
+	# Older versions of the cryptography package return a naive datetime.
+	expires = getattr(cert, "not_valid_after_utc", None) or cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+
+	certder = cert.public_bytes(serialization.Encoding.DER)
+	spkider = cert.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+	info = {
+		"names": names,
+		"expires": expires,
+		"public_key": spkider,
+		"public_key_sha256": hashlib.sha256(spkider).hexdigest(),
+		"fingerprint": ":".join("%02X" % b for b in cert.fingerprint(hashes.SHA1())),
+		"self_signed": cert.issuer == cert.subject,
+
+		# 3: This is the certificate that the client should trust. No CA is needed.
+		# 0/1: The whole certificate is matched, or just its public key. A public key
+		#      match survives renewing the certificate with the same private key.
+		# 1: The certificate (or key) is SHA256'd here.
+		"tlsa": [
+			"3 0 1 " + hashlib.sha256(certder).hexdigest(),
+			"3 1 1 " + hashlib.sha256(spkider).hexdigest(),
+		],
+
+		"chain": m.group(2).strip(),
+		"certificate": cert,
+	}
+
+	_certificate_cache[ssl_certificate] = (cache_key, info)
+	return info
+
+_private_key_cache = { }
+def get_private_key_public_key(ssl_private_key):
+	# Returns the DER-encoded SubjectPublicKeyInfo of the public key that goes
+	# with the (unencrypted, PEM-encoded) private key in ssl_private_key, which
+	# can be compared to the public_key of a certificate. Raises OSError if the
+	# file can't be read or ValueError if it isn't a private key.
+	cache_key = file_cache_key(ssl_private_key)
+	if ssl_private_key in _private_key_cache and _private_key_cache[ssl_private_key][0] == cache_key:
+		return _private_key_cache[ssl_private_key][1]
+
+	# Only the public half of the key is needed, so skip the consistency
+	# checks on RSA keys, which take far longer than the rest of this. Older
+	# versions of the cryptography package always do them.
+	import inspect
+	from cryptography.hazmat.primitives import serialization
+	from cryptography.hazmat.backends import default_backend
+	kwargs = { }
+	if "unsafe_skip_rsa_key_validation" in inspect.signature(serialization.load_pem_private_key).parameters:
+		kwargs["unsafe_skip_rsa_key_validation"] = True
+	with open(ssl_private_key, "rb") as f:
+		try:
+			key = serialization.load_pem_private_key(f.read(), password=None, backend=default_backend(), **kwargs)
+		except TypeError:
+			# The key is encrypted.
+			raise ValueError("%s is an encrypted private key." % ssl_private_key)
+	spkider = key.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+	_private_key_cache[ssl_private_key] = (cache_key, spkider)
+	return spkider
+
+_private_key_objects = { }
+def load_private_key(ssl_private_key):
+	# Returns the (unencrypted, PEM-encoded) private key in ssl_private_key
+	# as a cryptography private key object, for signing with. Since the same
+	# key is typically used for all domains, it's remembered until the file
+	# changes.
+	cache_key = file_cache_key(ssl_private_key)
+	if ssl_private_key in _private_key_objects and _private_key_objects[ssl_private_key][0] == cache_key:
+		return _private_key_objects[ssl_private_key][1]
+
+	from cryptography.hazmat.primitives import serialization
+	from cryptography.hazmat.backends import default_backend
+	with open(ssl_private_key, "rb") as f:
+		key = serialization.load_pem_private_key(f.read(), password=None, backend=default_backend())
+
+	_private_key_objects[ssl_private_key] = (cache_key, key)
+	return key
+
+def create_self_signed_certificate(domain, ssl_private_key, ssl_certificate, env):
+	# Writes a self-signed certificate for the domain, good for a year, to
+	# ssl_certificate using the private key in ssl_private_key. This makes
+	# the same certificate that `openssl x509 -req -days 365 -signkey` made
+	# from a CSR for the domain, without running openssl.
+	from cryptography import x509
+	from cryptography.x509.oid import NameOID
+	from cryptography.hazmat.primitives import hashes, serialization
+	from cryptography.hazmat.backends import default_backend
+
+	key = load_private_key(ssl_private_key)
+	name = x509.Name([
+		x509.NameAttribute(NameOID.COUNTRY_NAME, env["CSR_COUNTRY"]),
+		x509.NameAttribute(NameOID.COMMON_NAME, domain),
+	])
+	now = datetime.datetime.now(datetime.timezone.utc)
+	cert = x509.CertificateBuilder() \
+		.subject_name(name) \
+		.issuer_name(name) \
+		.public_key(key.public_key()) \
+		.serial_number(x509.random_serial_number()) \
+		.not_valid_before(now) \
+		.not_valid_after(now + datetime.timedelta(days=365)) \
+		.sign(key, hashes.SHA256(), default_backend())
+
+	# Write it to a temporary file and move it into place so that a
+	# partially written certificate is never seen.
+	import tempfile
+	os.makedirs(os.path.dirname(ssl_certificate), exist_ok=True)
+	fd, fn = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(ssl_certificate))
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(cert.public_bytes(serialization.Encoding.PEM))
+		os.chmod(fn, 0o644)
+		os.replace(fn, ssl_certificate)
+	except:
+		os.unlink(fn)
+		raise
+
+def create_csr(domains, ssl_private_key, env):
+	# Returns a PEM-encoded certificate signing request for the private key
+	# in ssl_private_key. The first domain is the common name, like the CSR
+	# that `openssl req -new -subj /C=../CN=domain` made, and all of the
+	# domains are listed as subject alternative names, so one CSR can be
+	# for a multi-domain certificate.
+	from cryptography import x509
+	from cryptography.x509.oid import NameOID
+	from cryptography.hazmat.primitives import hashes, serialization
+	from cryptography.hazmat.backends import default_backend
+
+	key = load_private_key(ssl_private_key)
+	csr = x509.CertificateSigningRequestBuilder() \
+		.subject_name(x509.Name([
+			x509.NameAttribute(NameOID.COUNTRY_NAME, env["CSR_COUNTRY"]),
+			x509.NameAttribute(NameOID.COMMON_NAME, domains[0]),
+		])) \
+		.add_extension(x509.SubjectAlternativeName([x509.DNSName(d) for d in domains]), critical=False) \
+		.sign(key, hashes.SHA256(), default_backend())
+	return csr.public_bytes(serialization.Encoding.PEM).decode("ascii")
+
+# The CAs that this machine trusts.
+CA_CERTIFICATES = "/etc/ssl/certs/ca-certificates.crt"
+
+def load_pem_certificates(pem):
+	# Parses each PEM-encoded certificate in a string.
+	from cryptography import x509
+	from cryptography.hazmat.backends import default_backend
+	return [
+		x509.load_pem_x509_certificate(block.encode("ascii"), default_backend())
+		for block in re.findall(r"-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----", pem, re.S)
+	]
+
+_trusted_cas = None
+_trusted_cas_lock = threading.Lock()
+def get_trusted_cas():
+	# Returns the system's trusted CA certificates, as a dict mapping each
+	# subject name to the certificates with that subject. The bundle is only
+	# parsed again when it changes. The status checks check certificates in
+	# several threads at once, so only one thread parses the bundle (which
+	# also keeps warnings.catch_warnings, which isn't thread-safe, sane).
+	with _trusted_cas_lock:
+		return load_trusted_cas()
+
+def load_trusted_cas():
+	global _trusted_cas
+	cache_key = file_cache_key(CA_CERTIFICATES)
+	if _trusted_cas is not None and _trusted_cas[0] == (CA_CERTIFICATES, cache_key):
+		return _trusted_cas[1]
+
+	cas = { }
+	if cache_key is not None:
+		with open(CA_CERTIFICATES) as f:
+			pem = f.read()
+		import warnings
+		with warnings.catch_warnings():
+			# Some long-trusted CAs have certificates that newer versions of the
+			# cryptography package warn about (e.g. negative serial numbers).
+			warnings.simplefilter("ignore")
+			for block in re.findall(r"-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----", pem, re.S):
+				try:
+					cert = load_pem_certificates(block)[0]
+				except ValueError:
+					continue # skip anything the cryptography package can't parse
+				cas.setdefault(cert.subject, []).append(cert)
+
+	_trusted_cas = ((CA_CERTIFICATES, cache_key), cas)
+	return cas
+
+def find_issuer(cert, candidates):
+	# Returns the certificate among candidates that issued and signed cert,
+	# or None.
+	from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+	for issuer in candidates:
+		if issuer.subject != cert.issuer: continue
+		try:
+			verify_signature(cert, issuer)
+			return issuer
+		except (ValueError, TypeError, InvalidSignature, UnsupportedAlgorithm):
+			continue
+	return None
+
+def verify_signature(cert, issuer):
+	# Raises an exception unless cert was signed by issuer's key. Newer
+	# versions of the cryptography package can check this themselves.
+	if hasattr(cert, "verify_directly_issued_by"):
+		cert.verify_directly_issued_by(issuer)
+		return
+
+	from cryptography.hazmat.primitives.asymmetric import rsa, ec, dsa, padding
+	key = issuer.public_key()
+	if isinstance(key, rsa.RSAPublicKey):
+		key.verify(cert.signature, cert.tbs_certificate_bytes, padding.PKCS1v15(), cert.signature_hash_algorithm)
+	elif isinstance(key, ec.EllipticCurvePublicKey):
+		key.verify(cert.signature, cert.tbs_certificate_bytes, ec.ECDSA(cert.signature_hash_algorithm))
+	elif isinstance(key, dsa.DSAPublicKey):
+		key.verify(cert.signature, cert.tbs_certificate_bytes, cert.signature_hash_algorithm)
+	else:
+		raise ValueError("Unsupported public key type.")
+
+def check_issuer_constraints(issuer, cert, num_intermediates):
+	# A certificate's signature isn't enough: its issuer must also be a CA
+	# that is allowed to sign certificates, with no more than its path length
+	# limit of intermediate CAs between it and the server's certificate.
+	# Returns what's wrong, or None. This follows openssl, which accepts an
+	# old (v1) self-signed root, which can't say whether it's a CA.
+	from cryptography import x509
+	try:
+		constraints = issuer.extensions.get_extension_for_class(x509.BasicConstraints).value
+	except x509.ExtensionNotFound:
+		constraints = None
+	if constraints is None:
+		if issuer.version != x509.Version.v1 or issuer.issuer != issuer.subject:
+			return "The certificate %s is not a CA certificate, but it issued %s." % (describe_certificate(issuer), describe_certificate(cert))
+	elif not constraints.ca:
+		return "The certificate %s is not a CA certificate, but it issued %s." % (describe_certificate(issuer), describe_certificate(cert))
+	elif constraints.path_length is not None and num_intermediates > constraints.path_length:
+		return "The certificate %s allows at most %d intermediate certificates below it." % (describe_certificate(issuer), constraints.path_length)
+
+	try:
+		if not issuer.extensions.get_extension_for_class(x509.KeyUsage).value.key_cert_sign:
+			return "The certificate %s is not allowed to sign certificates, but it issued %s." % (describe_certificate(issuer), describe_certificate(cert))
+	except x509.ExtensionNotFound:
+		pass
+
+	return None
+
+def describe_certificate(cert):
+	return cert.subject.rfc4514_string() or "(no subject)"
+
+_verify_cache = { }
+def verify_certificate_chain(ssl_certificate):
+	# Checks the chain of trust of the certificate: that each certificate,
+	# starting with ours and then using the intermediate certificates that
+	# follow it in the file, was issued and signed by the next, which must
+	# be a CA allowed to do so, up to a CA this machine trusts, and that none
+	# of them has expired. Returns a tuple
+	# of a status and a description of the problem:
+	#
+	# ("OK", None)
+	# ("SELF-SIGNED", None): the chain ends at a certificate that signed
+	#   itself but that isn't a trusted CA
+	# ("UNKNOWN-ISSUER", description): the chain ends at a certificate
+	#   whose issuer we don't have
+	# ("INVALID", description): anything else
+	#
+	# The result is remembered until the certificate or the system's list
+	# of CAs changes, or until tomorrow, since certificates expire.
+	cache_key = (file_cache_key(ssl_certificate), file_cache_key(CA_CERTIFICATES), datetime.date.today())
+	if ssl_certificate in _verify_cache and _verify_cache[ssl_certificate][0] == cache_key:
+		return _verify_cache[ssl_certificate][1]
+
+	result = check_chain(get_certificate_info(ssl_certificate), get_trusted_cas())
+	_verify_cache[ssl_certificate] = (cache_key, result)
+	return result
+
+def forget_certificate(ssl_certificate):
+	# Drops what's remembered about the certificate file, e.g. once a
+	# temporary file that was checked is gone.
+	_certificate_cache.pop(ssl_certificate, None)
+	_verify_cache.pop(ssl_certificate, None)
+
+def check_chain(cert_info, trusted_cas):
+	from cryptography import x509
+	cert = cert_info["certificate"]
+	try:
+		intermediates = load_pem_certificates(cert_info["chain"])
+	except ValueError:
+		return ("INVALID", "An intermediate certificate in the chain could not be read.")
+
+	# The certificate must be usable for a web/mail server, if it says what
+	# it can be used for at all.
+	try:
+		usage = cert.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value
+		if x509.oid.ExtendedKeyUsageOID.SERVER_AUTH not in usage and x509.oid.ExtendedKeyUsageOID.ANY_EXTENDED_KEY_USAGE not in usage:
+			return ("INVALID", "The certificate is not for use by servers (%s)." % describe_certificate(cert))
+	except x509.ExtensionNotFound:
+		pass
+
+	now = datetime.datetime.now(datetime.timezone.utc)
+	chain = [cert]
+	while True:
+		cert = chain[-1]
+
+		not_before = getattr(cert, "not_valid_before_utc", None) or cert.not_valid_before.replace(tzinfo=datetime.timezone.utc)
+		not_after = getattr(cert, "not_valid_after_utc", None) or cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+		if now < not_before:
+			return ("INVALID", "The certificate %s is not yet valid." % describe_certificate(cert))
+		if now > not_after:
+			return ("INVALID", "The certificate %s has expired." % describe_certificate(cert))
+
+		# Is this certificate a trusted CA?
+		if cert in trusted_cas.get(cert.subject, []):
+			return ("OK", None)
+
+		# Was it issued by one? Every certificate above the server's own
+		# must be allowed to issue the one below it.
+		issuer = find_issuer(cert, trusted_cas.get(cert.issuer, []))
+		if issuer is not None:
+			problem = check_issuer_constraints(issuer, cert, len(chain) - 1)
+			if problem:
+				return ("INVALID", problem)
+			return ("OK", None)
+
+		# Did it sign itself?
+		if find_issuer(cert, [cert]):
+			return ("SELF-SIGNED", None)
+
+		# Move up the chain.
+		issuer = find_issuer(cert, intermediates)
+		if issuer is None:
+			return ("UNKNOWN-ISSUER", "Unable to get the issuer certificate of %s, which was issued by %s."
+				% (describe_certificate(cert), cert.issuer.rfc4514_string()))
+		if issuer in chain or len(chain) > 10:
+			return ("INVALID", "The intermediate chain is too long or has a loop.")
+		problem = check_issuer_constraints(issuer, cert, len(chain) - 1)
+		if problem:
+			return ("INVALID", problem)
+		chain.append(issuer)
@@ -6,23 +6,129 @@
 
 __ALL__ = ['check_certificate']
 
-import sys, os, os.path, re, subprocess, datetime, multiprocessing.pool
+import sys, os, os.path, re, subprocess, datetime, time, types, functools, threading, asyncio, concurrent.futures
 
 import dns.reversename, dns.resolver
-import dateutil.parser, dateutil.tz
+import dateutil.tz
 
-from dns_update import get_dns_zones, build_tlsa_record, get_custom_dns_config, get_secondary_dns
+from dns_update import get_dns_zones, build_tlsa_record, get_custom_dns_config, get_secondary_dns, get_ds_records, get_dnssec_ksk, dnssec_choose_algo
 from web_update import get_web_domains, get_default_www_redirects, get_domain_ssl_files
 from mailconfig import get_mail_domains, get_mail_aliases
+from ssl_certificates import get_certificate_info, get_private_key_public_key, verify_certificate_chain
+
+from utils import shell, sort_domains, file_cache_key
+
+# The checks must run on Python 3.4 (Ubuntu 14.04), which predates async
+# and await, so the coroutines here are written as generators. Newer
+# versions of asyncio no longer accept generators as coroutines
+# (asyncio.coroutine is gone as of Python 3.11 and generators aren't
+# coroutines to asyncio as of 3.12), so where async def exists each one
+# is wrapped in a native coroutine instead. That code is compiled when
+# this module loads because Python 3.4 can't parse it. asyncio.async was
+# renamed ensure_future in Python 3.4.4.
+if sys.version_info >= (3, 5):
+	exec("""def coroutine(func):
+	func = types.coroutine(func) # so that it may yield from native coroutines
+	@functools.wraps(func)
+	async def native_coroutine(*args, **kwargs):
+		return await func(*args, **kwargs)
+	return native_coroutine
+""")
+else:
+	coroutine = asyncio.coroutine
+ensure_future = getattr(asyncio, "ensure_future", None) or getattr(asyncio, "async")
+
+# How many checks run at once, and how many seconds each may take before
+# it is reported as timed out. Connecting to a service is given
+# SERVICE_CONNECT_TIMEOUT seconds.
+MAX_CONCURRENT_CHECKS = 20
+CHECK_TIMEOUT = 60
+SERVICE_CONNECT_TIMEOUT = 1
+
+# Each check has an id and a ttl, which is for how many seconds its
+# result can be shown again without running it (see run_checks). Checks
+# with a ttl of 0 only look at this machine, are quick, and are always
+# run. The saved results are kept in CHECK_RESULTS_CACHE.
+DNS_CHECK_TTL = 5*60
+CERTIFICATE_CHECK_TTL = 60*60
+OUTBOUND_MAIL_CHECK_TTL = 60*60
+SOFTWARE_UPDATES_CHECK_TTL = 8*60*60
+CHECK_RESULTS_CACHE = "/var/cache/mailinabox/status_check_results.json"
+_check_results_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+
+# What run_check returns in place of the check's return value if the
+# check didn't finish in time.
+CHECK_TIMED_OUT = "[timed out]"
+
+def run_checks(rounded_values, env, output, use_cache=False, force=()):
+	# The checks spend most of their time waiting on the network (DNS
+	# queries and connections to services), so they are run concurrently
+	# by an asyncio event loop. Each check runs in a worker thread and
+	# writes to its own BufferedOutput, and the outputs are played back
+	# in a fixed order so the report doesn't depend on which check
+	# finished first.
+	#
+	# With use_cache, the saved result of a check is shown instead of
+	# running it, unless the check's id or domain is in force (or force
+	# is True). Checks whose saved results are older than their ttl are
+	# re-run in the background afterwards, so the next call gets fresh
+	# results. The system services are always checked.
+	stale_checks = []
+	run_in_event_loop(lambda executor : run_checks_async(rounded_values, env, output, executor, use_cache, force, stale_checks))
+	if len(stale_checks) > 0:
+		refresh_checks_in_background(stale_checks)
+
+def run_in_event_loop(coroutine):
+	# Runs the coroutine returned by coroutine(executor) on a new event
+	# loop, where executor is a thread pool to run checks in.
+	# The loop is also made this thread's current event loop, since before
+	# Python 3.5.3 asyncio.get_event_loop() (which asyncio.Semaphore and
+	# asyncio.Future use by default) doesn't return the running loop.
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHECKS)
+	try:
+		return loop.run_until_complete(coroutine(executor))
+	finally:
+		# Don't wait for checks that timed out. Their threads end on their
+		# own once whatever they were waiting on times out.
+		executor.shutdown(wait=False)
+		asyncio.set_event_loop(None)
+		loop.close()
+
+@coroutine
+def run_checks_async(rounded_values, env, output, executor, use_cache, force, stale_checks):
+	semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHECKS)
+	dns_cache = DnsCache() # starts empty so the DNS checks are up to date
+	saved_results = load_check_results() if use_cache else None
+	now = time.time()
+	checks_run = []
+	check_keys = set()
+	saved_ages = []
+	def run(check):
+		check_keys.add(get_check_key(check))
+		saved = get_saved_check_result(check, saved_results, force)
+		if saved is not None:
+			saved_time, output2 = saved
+			saved_ages.append(now - saved_time)
+			if now - saved_time >= check["ttl"]:
+				stale_checks.append(check)
+			future = asyncio.Future()
+			future.set_result((None, output2))
+			return future
+
+		# Start the check now, rather than when it's awaited.
+		future = ensure_future(run_check(check["check"], CHECK_TIMEOUT, executor, semaphore, dns_cache))
+		checks_run.append((check, future))
+		return future
 
-from utils import shell, sort_domains, load_env_vars_from_file
-
-def run_checks(rounded_values, env, output, pool):
 	# run systems checks
 	output.add_heading("System")
 
 	# check that services are running
-	if not run_services_checks(env, output, pool):
+	services_ok, connect_times = yield from run_services_checks(env, output)
+	if not services_ok:
 		# If critical services are not running, stop. If bind9 isn't running,
 		# all later DNS checks will timeout and that will take forever to
 		# go through, and if running over the web will cause a fastcgi timeout.
@@ -32,27 +138,186 @@ def run_checks(rounded_values, env, output, pool):
 	# (ignore errors; if bind9/rndc isn't running we'd already report
 	# that in run_services checks.)
 	shell('check_call', ["/usr/sbin/rndc", "flush"], trap=True)
-	
-	run_system_checks(rounded_values, env, output)
 
-	# perform other checks asynchronously
+	# Start all of the remaining checks at once, then show their output
+	# in order, each as soon as it and the checks before it are done.
+	system_checks = [run(check) for check in get_system_checks(rounded_values, env)]
+	network_checks = [run(check) for check in get_network_checks(env)]
+	domain_checks = [(heading, [run(check) for check in checks]) for heading, checks in get_domain_checks(rounded_values, env)]
+
+	for future in system_checks:
+		result, output2 = yield from future
+		output2.playback(output)
+
+	output.add_heading("Network")
+	for future in network_checks:
+		result, output2 = yield from future
+		output2.playback(output)
 
-	run_network_checks(env, output)
-	run_domain_checks(rounded_values, env, output, pool)
+	for heading, checks in domain_checks:
+		output.add_heading(heading)
+		for future in checks:
+			result, output2 = yield from future
+			output2.playback(output)
 
+	if saved_results is not None:
+		# Save the results of the checks that were run, and forget the
+		# results of checks that no longer exist (e.g. of removed domains).
+		save_check_results(
+			[(check, future.result()[1]) for check, future in checks_run
+				if check["ttl"] > 0 and future.result()[0] != CHECK_TIMED_OUT],
+			keep=check_keys)
+
+	if not rounded_values:
+		# (Not when the output is compared with the previous run's, since
+		# these numbers will always be a little different.)
+		output.add_heading("DNS Queries")
+		output.print_line(dns_cache.format_stats())
+
+		if len(connect_times) > 0:
+			output.add_heading("Time to Connect to Services")
+			output.print_line(", ".join(connect_times) + ".")
+
+		if saved_results is not None and len(saved_ages) > 0:
+			output.add_heading("Saved Results")
+			message = "%d checks were not run again. Their results are from up to %d minutes ago." \
+				% (len(saved_ages), max(saved_ages) // 60)
+			if len(stale_checks) > 0:
+				message += " The %d that are out of date are being checked again in the background." % len(stale_checks)
+			output.print_line(message)
+
+@coroutine
+def run_check(check, timeout, executor, semaphore, dns_cache):
+	# Runs check(output) in a worker thread once fewer than
+	# MAX_CONCURRENT_CHECKS are running, with query_dns using dns_cache
+	# (the run's DnsCache), and returns what the check
+	# returned and a BufferedOutput with what it wrote. If the check takes
+	# longer than timeout seconds, what it wrote so far is returned with an
+	# error saying so (and CHECK_TIMED_OUT for what it returned). It stays
+	# counted as running until its thread is actually done.
+	output = BufferedOutput()
+	yield from semaphore.acquire()
+	try:
+		future = asyncio.get_event_loop().run_in_executor(executor, run_with_dns_cache, dns_cache, check, output)
+	except:
+		semaphore.release()
+		raise
+	future.add_done_callback(lambda f : semaphore.release())
+	try:
+		return ((yield from asyncio.wait_for(asyncio.shield(future), timeout)), output)
+	except asyncio.TimeoutError:
+		# The thread may still write to output, so stop using it.
+		output = BufferedOutput(with_lines=list(output.buf))
+		output.print_error("This check did not finish within %d seconds." % timeout)
+		return (CHECK_TIMED_OUT, output)
+
+def get_check_key(check):
+	# The key of a check's saved result.
+	if "domain" in check:
+		return check["domain"] + "/" + check["id"]
+	return check["id"]
+
+def get_files_stamp(*filenames):
+	# Returns a value that changes when any of the files change, as a
+	# check's "stamp", so that the check's saved result is not used once
+	# what it looked at has changed.
+	return [list(key) if key is not None else None for key in map(file_cache_key, filenames)]
+
+def is_check_forced(check, force):
+	if force is True or check["id"] in force:
+		return True
+	# Domains may be given IDNA-encoded or in Unicode.
+	return "domain" in check and (check["domain"] in force or check["domain"].encode('ascii').decode('idna') in force)
+
+def get_saved_check_result(check, saved_results, force):
+	# Returns when the check's saved result was saved and a BufferedOutput
+	# with it, or None if the check must be run.
+	if saved_results is None or check["ttl"] == 0 or is_check_forced(check, force):
+		return None
+	saved = saved_results.get(get_check_key(check))
+	if saved is None or saved["stamp"] != check.get("stamp"):
+		return None
+	return (saved["time"], BufferedOutput(with_lines=saved["output"]))
+
+def load_check_results():
+	import json
+	try:
+		with open(CHECK_RESULTS_CACHE) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return { }
+
+def save_check_results(results, keep=None):
+	# Saves the output of each (check, BufferedOutput) in results. If keep
+	# is given, the saved results of checks whose keys aren't in it are
+	# removed.
+	import json, tempfile
+	now = time.time()
+	with _check_results_lock:
+		saved = load_check_results()
+		if keep is not None:
+			saved = { key: value for key, value in saved.items() if key in keep }
+		for check, output in results:
+			saved[get_check_key(check)] = { "time": now, "stamp": check.get("stamp"), "output": output.buf }
+
+		os.makedirs(os.path.dirname(CHECK_RESULTS_CACHE), exist_ok=True)
+		fd, tmpfn = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(CHECK_RESULTS_CACHE))
+		try:
+			with os.fdopen(fd, "w") as f:
+				json.dump(saved, f)
+			os.replace(tmpfn, CHECK_RESULTS_CACHE)
+		except:
+			os.unlink(tmpfn)
+			raise
+
+def refresh_checks_in_background(checks):
+	# Runs the checks again and saves their results, in a thread so that
+	# the caller doesn't wait. Only one refresh runs at a time. If one is
+	# already running, these checks are refreshed by a later call instead.
+	if not _refresh_lock.acquire(blocking=False):
+		return
+	def refresh():
+		try:
+			run_in_event_loop(lambda executor : refresh_checks_async(checks, executor))
+		finally:
+			_refresh_lock.release()
+	threading.Thread(target=refresh, daemon=True).start()
+
+@coroutine
+def refresh_checks_async(checks, executor):
+	semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHECKS)
+	dns_cache = DnsCache()
+	results = yield from asyncio.gather(*[run_check(check["check"], CHECK_TIMEOUT, executor, semaphore, dns_cache) for check in checks])
+	save_check_results([(check, output) for check, (result, output) in zip(checks, results) if result != CHECK_TIMED_OUT])
+
+_ssh_port = None
 def get_ssh_port():
-    # Returns ssh port
+    # Returns ssh port. Running sshd is slow-ish, so remember the port
+    # until sshd_config changes.
+    global _ssh_port
+    cache_key = file_cache_key("/etc/ssh/sshd_config")
+    if _ssh_port is not None and _ssh_port[0] == cache_key:
+        return _ssh_port[1]
+
     output = shell('check_output', ['sshd', '-T'])
     returnNext = False
 
+    port = None
     for e in output.split():
         if returnNext:
-            return int(e)
+            port = int(e)
+            break
         if e == "port":
             returnNext = True
 
-def run_services_checks(env, output, pool):
-	# Check that system services are running.
+    _ssh_port = (cache_key, port)
+    return port
+
+@coroutine
+def run_services_checks(env, output):
+	# Check that system services are running. Returns whether the other
+	# checks can be run, and how long it took to connect to each service
+	# that is running, for showing at the end of the report.
 
 	services = [
 		{ "name": "Local DNS (bind9)", "port": 53, "public": False, },
@@ -77,44 +342,47 @@ def run_services_checks(env, output, pool):
 		{ "name": "HTTPS Web (nginx)", "port": 443, "public": True, },
 	]
 
+	# Connect to all of them at once. These are just connections, so
+	# they're made from the event loop itself rather than worker threads.
 	all_running = True
 	fatal = False
-	ret = pool.starmap(check_service, ((i, service, env) for i, service in enumerate(services)), chunksize=1)
-	for i, running, fatal2, output2 in sorted(ret):
+	latencies = []
+	outputs = [BufferedOutput() for service in services]
+	ret = yield from asyncio.gather(*[check_service(service, env, output2) for service, output2 in zip(services, outputs)])
+	for service, (running, fatal2, latency), output2 in zip(services, ret, outputs):
 		all_running = all_running and running
 		fatal = fatal or fatal2
 		output2.playback(output)
+		if latency is not None:
+			latencies.append("%s %.1f ms" % (service["name"], latency * 1000))
 
 	if all_running:
 		output.print_ok("All system services are running.")
 
-	return not fatal
+	return (not fatal, latencies)
 
-def check_service(i, service, env):
-	import socket
-	output = BufferedOutput()
+@coroutine
+def check_service(service, env, output):
+	# Returns whether the service is running, whether it not running is
+	# fatal for the rest of the checks, and how long it took to connect
+	# (or None).
 	running = False
 	fatal = False
-	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	s.settimeout(1)
+	latency = None
 	try:
 		try:
-			s.connect((
+			latency = yield from connect_to_service(
 				"127.0.0.1" if not service["public"] else env['PUBLIC_IP'],
-				service["port"]))
+				service["port"])
 			running = True
 		except OSError as e1:
 			if service["public"] and service["port"] != 53:
 				# For public services (except DNS), try the private IP as a fallback.
-				s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-				s1.settimeout(1)
 				try:
-					s1.connect(("127.0.0.1", service["port"]))
-					output.print_error("%s is running but is not publicly accessible at %s:%d (%s)." % (service['name'], env['PUBLIC_IP'], service['port'], str(e1)))
+					yield from connect_to_service("127.0.0.1", service["port"])
 				except:
 					raise e1
-				finally:
-					s1.close()
+				output.print_error("%s is running but is not publicly accessible at %s:%d (%s)." % (service['name'], env['PUBLIC_IP'], service['port'], str(e1)))
 			else:
 				raise
 
@@ -123,21 +391,50 @@ def check_service(i, service, env):
 
 		# Why is nginx not running?
 		if service["port"] in (80, 443):
-			output.print_line(shell('check_output', ['nginx', '-t'], capture_stderr=True, trap=True)[1].strip())
+			nginx_test = yield from asyncio.get_event_loop().run_in_executor(None,
+				lambda : shell('check_output', ['nginx', '-t'], capture_stderr=True, trap=True))
+			output.print_line(nginx_test[1].strip())
 
 		# Flag if local DNS is not running.
 		if service["port"] == 53 and service["public"] == False:
 			fatal = True
+
+	return (running, fatal, latency)
+
+@coroutine
+def connect_to_service(host, port):
+	# Opens and closes a TCP connection to host:port without blocking the
+	# event loop. Returns how many seconds it took to connect, or raises
+	# OSError, worded as a blocking connect would have been.
+	import socket
+	loop = asyncio.get_event_loop()
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	s.setblocking(False)
+	try:
+		start = time.perf_counter()
+		try:
+			yield from asyncio.wait_for(loop.sock_connect(s, (host, port)), SERVICE_CONNECT_TIMEOUT)
+		except asyncio.TimeoutError:
+			raise socket.timeout("timed out")
+		except OSError as e:
+			if e.errno is None: raise
+			raise OSError(e.errno, os.strerror(e.errno))
+		return time.perf_counter() - start
 	finally:
 		s.close()
 
-	return (i, running, fatal, output)
-
-def run_system_checks(rounded_values, env, output):
-	check_ssh_password(env, output)
-	check_software_updates(env, output)
-	check_system_aliases(env, output)
-	check_free_disk_space(rounded_values, env, output)
+def get_system_checks(rounded_values, env):
+	# Each check has an id, a ttl (see DNS_CHECK_TTL), and a function that
+	# takes the output to write to. A check may also have a "stamp" (see
+	# get_files_stamp) and, if it is about one domain, that "domain".
+	return [
+		{ "id": "ssh-password", "ttl": 0, "check": lambda output : check_ssh_password(env, output) },
+		{ "id": "software-updates", "ttl": SOFTWARE_UPDATES_CHECK_TTL,
+			"stamp": get_files_stamp("/var/lib/dpkg/status", "/var/run/reboot-required"),
+			"check": lambda output : check_software_updates(env, output) },
+		{ "id": "system-aliases", "ttl": 0, "check": lambda output : check_system_aliases(env, output) },
+		{ "id": "free-disk-space", "ttl": 0, "check": lambda output : check_free_disk_space(rounded_values, env, output) },
+	]
 
 def check_ssh_password(env, output):
 	# Check that SSH login with password is disabled. The openssh-server
@@ -188,11 +485,14 @@ def check_free_disk_space(rounded_values, env, output):
 	else:
 		output.print_error(disk_msg)
 
-def run_network_checks(env, output):
+def get_network_checks(env):
 	# Also see setup/network-checks.sh.
+	return [
+		{ "id": "outbound-mail", "ttl": OUTBOUND_MAIL_CHECK_TTL, "check": lambda output : check_outbound_mail(env, output) },
+		{ "id": "ip-blacklist", "ttl": DNS_CHECK_TTL, "check": lambda output : check_ip_blacklist(env, output) },
+	]
 
-	output.add_heading("Network")
-
+def check_outbound_mail(env, output):
 	# Stop if we cannot make an outbound connection on port 25. Many residential
 	# networks block outbound port 25 to prevent their network from sending spam.
 	# See if we can reach one of Google's MTAs with a 5-second timeout.
@@ -205,6 +505,7 @@ def run_network_checks(env, output):
 			machines from being able to send spam. A quick connection test to Google's mail server on port 25
 			failed.""")
 
+def check_ip_blacklist(env, output):
 	# Stop if the IPv4 address is listed in the ZEN Spamhaus Block List.
 	# The user might have ended up on an IP address that was previously in use
 	# by a spammer, or the user may be deploying on a residential network. We
@@ -218,7 +519,11 @@ def run_network_checks(env, output):
 			which may prevent recipients from receiving your email. See http://www.spamhaus.org/query/ip/%s."""
 			% (env['PUBLIC_IP'], zen, env['PUBLIC_IP']))
 
-def run_domain_checks(rounded_time, env, output, pool):
+def get_domain_checks(rounded_time, env):
+	# Returns the checks for each domain, as a list of (heading, checks),
+	# with the domains in the order they're shown. A domain's checks are
+	# independent of each other, so they can run at the same time too.
+
 	# Get the list of domains we handle mail for.
 	mail_domains = get_mail_domains(env)
 
@@ -231,40 +536,50 @@ def run_domain_checks(rounded_time, env, output, pool):
 
 	domains_to_check = mail_domains | dns_domains | web_domains
 
-	# Serial version:
-	#for domain in sort_domains(domains_to_check, env):
-	#	run_domain_checks_on_domain(domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains)
+	return [
+		(
+			# The domain is IDNA-encoded, but for display use Unicode.
+			domain.encode('ascii').decode('idna'),
+			get_domain_checks_for_domain(domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains)
+		)
+		for domain in sort_domains(domains_to_check, env)
+	]
 
-	# Parallelize the checks across a worker pool.
-	args = ((domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains)
-		for domain in domains_to_check)
-	ret = pool.starmap(run_domain_checks_on_domain, args, chunksize=1)
-	ret = dict(ret) # (domain, output) => { domain: output }
-	for domain in sort_domains(ret, env):
-		ret[domain].playback(output)
+def get_domain_checks_for_domain(domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains):
+	checks = []
 
-def run_domain_checks_on_domain(domain, rounded_time, env, dns_domains, dns_zonefiles, mail_domains, web_domains):
-	output = BufferedOutput()
+	# The results of the DNS checks are not reused once the zones they are
+	# about have changed.
+	zones_stamp = get_files_stamp(*["/etc/nsd/zones/" + dns_zonefiles[zone] for zone in sorted(dns_domains)
+		if zone == domain or domain.endswith("." + zone)])
 
-	# The domain is IDNA-encoded, but for display use Unicode.
-	output.add_heading(domain.encode('ascii').decode('idna'))
+	def add(id, ttl, check, stamp=None):
+		checks.append({ "id": id, "domain": domain, "ttl": ttl, "stamp": stamp, "check": check })
 
 	if domain == env["PRIMARY_HOSTNAME"]:
-		check_primary_hostname_dns(domain, env, output, dns_domains, dns_zonefiles)
-		
+		add("primary-hostname-dns", DNS_CHECK_TTL, lambda output : check_primary_hostname_dns(domain, env, output, dns_domains, dns_zonefiles), zones_stamp)
+
 	if domain in dns_domains:
-		check_dns_zone(domain, env, output, dns_zonefiles)
-		
+		add("dns-zone", DNS_CHECK_TTL, lambda output : check_dns_zone(domain, env, output, dns_zonefiles), zones_stamp)
+
 	if domain in mail_domains:
-		check_mail_domain(domain, env, output)
+		add("mail-domain", DNS_CHECK_TTL, lambda output : check_mail_domain(domain, env, output),
+			get_files_stamp(env["STORAGE_ROOT"] + "/mail/users.sqlite"))
 
 	if domain in web_domains:
-		check_web_domain(domain, rounded_time, env, output)
+		add("web-domain", DNS_CHECK_TTL, lambda output : check_web_domain(domain, env, output))
+
+		# We need a SSL certificate for PRIMARY_HOSTNAME because that's where the
+		# user will log in with IMAP or webmail. Any other domain we serve a
+		# website for also needs a signed certificate.
+		ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env)
+		add("ssl-certificate", CERTIFICATE_CHECK_TTL, lambda output : check_ssl_cert(domain, rounded_time, env, output),
+			get_files_stamp(ssl_key, ssl_certificate))
 
 	if domain in dns_domains:
-		check_dns_zone_suggestions(domain, env, output, dns_zonefiles)
+		add("dns-zone-suggestions", DNS_CHECK_TTL, lambda output : check_dns_zone_suggestions(domain, env, output, dns_zonefiles), zones_stamp)
 
-	return (domain, output)
+	return checks
 
 def check_primary_hostname_dns(domain, env, output, dns_domains, dns_zonefiles):
 	# If a DS record is set on the zone containing this domain, check DNSSEC now.
@@ -384,19 +699,18 @@ def check_dns_zone_suggestions(domain, env, output, dns_zonefiles):
 
 def check_dnssec(domain, env, output, dns_zonefiles, is_checking_primary=False):
 	# See if the domain has a DS record set at the registrar. The DS record may have
-	# several forms. We have to be prepared to check for any valid record. We've
-	# pre-generated all of the valid digests --- read them in.
-	ds_correct = open('/etc/nsd/zones/' + dns_zonefiles[domain] + '.ds').read().strip().split("\n")
+	# several forms. We have to be prepared to check for any valid record. Get all
+	# of the valid digests.
+	ds_correct = get_ds_records(domain, env)
 	digests = { }
 	for rr_ds in ds_correct:
-		ds_keytag, ds_alg, ds_digalg, ds_digest = rr_ds.split("\t")[4].split(" ")
+		ds_keytag, ds_alg, ds_digalg, ds_digest = rr_ds.split(" ")
 		digests[ds_digalg] = ds_digest
 
 	# Some registrars may want the public key so they can compute the digest. The DS
 	# record that we suggest using is for the KSK (and that's how the DS records were generated).
 	alg_name_map = { '7': 'RSASHA1-NSEC3-SHA1', '8': 'RSASHA256' }
-	dnssec_keys = load_env_vars_from_file(os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/%s.conf' % alg_name_map[ds_alg]))
-	dnsssec_pubkey = open(os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys['KSK'] + '.key')).read().split("\t")[3].split(" ")[3]
+	dnsssec_pubkey = get_dnssec_ksk(dnssec_choose_algo(domain, env), env)[3]
 
 	# Query public DNS for the DS record at the registrar.
 	ds = query_dns(domain, "DS", nxdomain=None)
@@ -434,7 +748,7 @@ def check_dnssec(domain, env, output, dns_zonefiles, is_checking_primary=False):
 		output.print_line(dnsssec_pubkey, monospace=True)
 		output.print_line("")
 		output.print_line("Bulk/Record Format:")
-		output.print_line("" + ds_correct[0])
+		output.print_line("%s.\t3600\tIN\tDS\t%s" % (domain, ds_correct[0]))
 		output.print_line("")
 
 def check_mail_domain(domain, env, output):
@@ -496,7 +810,7 @@ def check_mail_domain(domain, env, output):
 			which may prevent recipients from receiving your mail.
 			See http://www.spamhaus.org/dbl/ and http://www.spamhaus.org/query/domain/%s.""" % (dbl, domain))
 
-def check_web_domain(domain, rounded_time, env, output):
+def check_web_domain(domain, env, output):
 	# See if the domain's A record resolves to our PUBLIC_IP. This is already checked
 	# for PRIMARY_HOSTNAME, for which it is required for mail specifically. For it and
 	# other domains, it is required to access its website.
@@ -509,10 +823,82 @@ def check_web_domain(domain, rounded_time, env, output):
 				webmail or a website on this domain. The domain currently resolves to %s in public DNS. It may take several hours for
 				public DNS to update after a change. This problem may result from other issues listed here.""" % (env['PUBLIC_IP'], ip))
 
-	# We need a SSL certificate for PRIMARY_HOSTNAME because that's where the
-	# user will log in with IMAP or webmail. Any other domain we serve a
-	# website for also needs a signed certificate.
-	check_ssl_cert(domain, rounded_time, env, output)
+# The checks look up many of the same names (e.g. the primary hostname's
+# A record for each mail domain, and each zone's DS record more than once),
+# so query_dns keeps the answers in a cache shared by all of the checks in
+# a run. Answers are kept for their TTL, and the lack of an answer for
+# DNS_NEGATIVE_CACHE_TTL seconds. If a name is already being looked up,
+# query_dns waits for that answer rather than sending another query.
+#
+# Each run of the checks (including a background refresh) has its own
+# DnsCache, which its worker threads use (see run_with_dns_cache), so
+# that a run starts with an empty cache without emptying the cache of
+# another run that's still going, and counts only its own lookups.
+# query_dns outside of a run uses a cache of its own.
+DNS_NEGATIVE_CACHE_TTL = 60
+
+class DnsCache:
+	def __init__(self):
+		self.answers = { } # (qname, rtype) => (expiration time, answer)
+		self.in_flight = { } # (qname, rtype) => concurrent.futures.Future
+		self.stats = { "queries": 0, "cached": 0, "shared": 0, "timeouts": 0 }
+		self.lock = threading.Lock()
+
+	def lookup(self, qname, rtype):
+		# Returns the answer from resolve_dns, using the cached answer, or
+		# waiting for the same lookup in another thread, or else doing it.
+		key = (str(qname).lower(), rtype)
+		with self.lock:
+			if key in self.answers and self.answers[key][0] > time.time():
+				self.stats["cached"] += 1
+				return self.answers[key][1]
+			if key in self.in_flight:
+				self.stats["shared"] += 1
+				future = self.in_flight[key]
+			else:
+				self.stats["queries"] += 1
+				future = None
+				self.in_flight[key] = concurrent.futures.Future()
+
+		if future is not None:
+			return future.result()
+
+		# Do the lookup, and hand the answer (or error) to any threads that
+		# are waiting on it.
+		future = self.in_flight[key]
+		try:
+			answer, expiration = resolve_dns(qname, rtype)
+		except BaseException as e:
+			with self.lock:
+				del self.in_flight[key]
+			future.set_exception(e)
+			raise
+		with self.lock:
+			del self.in_flight[key]
+			if expiration is not None:
+				self.answers[key] = (expiration, answer)
+			if answer == "[timeout]":
+				self.stats["timeouts"] += 1
+		future.set_result(answer)
+		return answer
+
+	def format_stats(self):
+		with self.lock:
+			stats = dict(self.stats)
+		total = stats["queries"] + stats["cached"] + stats["shared"]
+		return "%d lookups: %d answered from the cache, %d waited on the same lookup in progress, and %d sent to the DNS server (%d timed out)." \
+			% (total, stats["cached"], stats["shared"], stats["queries"], stats["timeouts"])
+
+_dns_cache = threading.local() # the DnsCache of the run a worker thread is in
+_default_dns_cache = DnsCache()
+
+def run_with_dns_cache(dns_cache, check, output):
+	# Runs check(output) in this worker thread with query_dns using dns_cache.
+	_dns_cache.current = dns_cache
+	try:
+		return check(output)
+	finally:
+		_dns_cache.current = None
 
 def query_dns(qname, rtype, nxdomain='[Not Set]'):
 	# Make the qname absolute by appending a period. Without this, dns.resolver.query
@@ -523,21 +909,32 @@ def query_dns(qname, rtype, nxdomain='[Not Set]'):
 	if isinstance(qname, str):
 		qname += "."
 
-	# Do the query.
+	dns_cache = getattr(_dns_cache, "current", None) or _default_dns_cache
+	return answer_or_nxdomain(dns_cache.lookup(qname, rtype), nxdomain)
+
+def answer_or_nxdomain(answer, nxdomain):
+	# resolve_dns gives None for no answer, but each caller of query_dns
+	# says what to return instead.
+	return nxdomain if answer is None else answer
+
+def resolve_dns(qname, rtype):
+	# Does a query_dns lookup. Returns the answer, or None if the host did
+	# not have an answer, and when the answer expires from the cache (None
+	# if it shouldn't be cached).
 	try:
 		response = dns.resolver.query(qname, rtype)
 	except (dns.resolver.NoNameservers, dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
 		# Host did not have an answer for this query; not sure what the
 		# difference is between the two exceptions.
-		return nxdomain
+		return (None, time.time() + DNS_NEGATIVE_CACHE_TTL)
 	except dns.exception.Timeout:
-		return "[timeout]"
+		return ("[timeout]", None)
 
 	# There may be multiple answers; concatenate the response. Remove trailing
 	# periods from responses since that's how qnames are encoded in DNS but is
 	# confusing for us. The order of the answers doesn't matter, so sort so we
 	# can compare to a well known order.
-	return "; ".join(sorted(str(r).rstrip('.') for r in response))
+	return ("; ".join(sorted(str(r).rstrip('.') for r in response)), response.expiration)
 
 def check_ssl_cert(domain, rounded_time, env, output):
 	# Check that SSL certificate is signed.
@@ -563,14 +960,7 @@ def check_ssl_cert(domain, rounded_time, env, output):
 	elif cert_status == "SELF-SIGNED":
 		# Offer instructions for purchasing a signed certificate.
 
-		fingerprint = shell('check_output', [
-			"openssl",
-			"x509",
-			"-in", ssl_certificate,
-			"-noout",
-			"-fingerprint"
-			])
-		fingerprint = re.sub(".*Fingerprint=", "", fingerprint).strip()
+		fingerprint = get_certificate_info(ssl_certificate)["fingerprint"]
 
 		if domain == env['PRIMARY_HOSTNAME']:
 			output.print_error("""The SSL certificate for this domain is currently self-signed. You will get a security
@@ -594,114 +984,55 @@ def check_ssl_cert(domain, rounded_time, env, output):
 			output.print_line("")
 
 def check_certificate(domain, ssl_certificate, ssl_private_key, warn_if_expiring_soon=True, rounded_time=False):
-	# Use openssl verify to check the status of a certificate.
+	# Check the status of a certificate. What's in the certificate is read
+	# once and remembered (see ssl_certificates.py) since this is called for
+	# many domains on every web and DNS update.
+	try:
+		cert_info = get_certificate_info(ssl_certificate)
+	except (OSError, ValueError):
+		# If the certificate is catastrophically bad, catch that now and report it.
+		return ("The SSL certificate appears to be corrupted or not a PEM-formatted SSL certificate file. (%s)" % ssl_certificate, None)
 
 	# First check that the certificate is for the right domain. The domain
 	# must be found in the Subject Common Name (CN) or be one of the
 	# Subject Alternative Names. A wildcard might also appear as the CN
 	# or in the SAN list, so check for that tool.
-	retcode, cert_dump = shell('check_output', [
-		"openssl", "x509",
-		"-in", ssl_certificate,
-		"-noout", "-text", "-nameopt", "rfc2253",
-		], trap=True)
-
-	# If the certificate is catastrophically bad, catch that now and report it.
-	# More information was probably written to stderr (which we aren't capturing),
-	# but it is probably not helpful to the user anyway.
-	if retcode != 0:
-		return ("The SSL certificate appears to be corrupted or not a PEM-formatted SSL certificate file. (%s)" % ssl_certificate, None)
-
-	cert_dump = cert_dump.split("\n")
-	certificate_names = set()
-	cert_expiration_date = None
-	while len(cert_dump) > 0:
-		line = cert_dump.pop(0)
-
-		# Grab from the Subject Common Name. We include the indentation
-		# at the start of the line in case maybe the cert includes the
-		# common name of some other referenced entity (which would be
-		# indented, I hope).
-		m = re.match("        Subject: CN=([^,]+)", line)
-		if m:
-			certificate_names.add(m.group(1))
-	
-		# Grab from the Subject Alternative Name, which is a comma-delim
-		# list of names, like DNS:mydomain.com, DNS:otherdomain.com.
-		m = re.match("            X509v3 Subject Alternative Name:", line)
-		if m:
-			names = re.split(",\s*", cert_dump.pop(0).strip())
-			for n in names:
-				m = re.match("DNS:(.*)", n)
-				if m:
-					certificate_names.add(m.group(1))
-
-		# Grab the expiration date for testing later.
-		m = re.match("            Not After : (.*)", line)
-		if m:
-			cert_expiration_date = dateutil.parser.parse(m.group(1))
-
+	certificate_names = cert_info["names"]
+	cert_expiration_date = cert_info["expires"]
 	wildcard_domain = re.sub("^[^\.]+", "*", domain)
 	if domain is not None and domain not in certificate_names and wildcard_domain not in certificate_names:
 		return ("The certificate is for the wrong domain name. It is for %s."
 			% ", ".join(sorted(certificate_names)), None)
 
-	# Second, check that the certificate matches the private key. Get the modulus of the
-	# private key and of the public key in the certificate. They should match. The output
-	# of each command looks like "Modulus=XXXXX".
+	# Second, check that the certificate matches the private key. The public key
+	# in the certificate must be the public key of the private key.
 	if ssl_private_key is not None:
-		private_key_modulus = shell('check_output', [
-			"openssl", "rsa",
-			"-inform", "PEM",
-			"-noout", "-modulus",
-			"-in", ssl_private_key])
-		cert_key_modulus = shell('check_output', [
-			"openssl", "x509",
-			"-in", ssl_certificate,
-			"-noout", "-modulus"])
-		if private_key_modulus != cert_key_modulus:
+		try:
+			private_key_public_key = get_private_key_public_key(ssl_private_key)
+		except (OSError, ValueError):
+			return ("The private key at %s could not be read." % ssl_private_key, None)
+		if private_key_public_key != cert_info["public_key"]:
 			return ("The certificate installed at %s does not correspond to the private key at %s." % (ssl_certificate, ssl_private_key), None)
 
 	# Next validate that the certificate is valid. This checks whether the certificate
 	# is self-signed, that the chain of trust makes sense, that it is signed by a CA
-	# that Ubuntu has installed on this machine's list of CAs, and I think that it hasn't
-	# expired.
-
-	# In order to verify with openssl, we need to split out any
-	# intermediary certificates in the chain (if any) from our
-	# certificate (at the top). They need to be passed separately.
-
-	cert = open(ssl_certificate).read()
-	m = re.match(r'(-*BEGIN CERTIFICATE-*.*?-*END CERTIFICATE-*)(.*)', cert, re.S)
-	if m == None:
-		return ("The certificate file is an invalid PEM certificate.", None)
-	mycert, chaincerts = m.groups()
-
-	# This command returns a non-zero exit status in most cases, so trap errors.
-
-	retcode, verifyoutput = shell('check_output', [
-		"openssl",
-		"verify", "-verbose",
-		"-purpose", "sslserver", "-policy_check",]
-		+ ([] if chaincerts.strip() == "" else ["-untrusted", "/dev/stdin"])
-		+ [ssl_certificate],
-		input=chaincerts.encode('ascii'),
-		trap=True)
-
-	if "self signed" in verifyoutput:
+	# that Ubuntu has installed on this machine's list of CAs, and that none of the
+	# certificates in the chain has expired.
+	verify_status, verify_problem = verify_certificate_chain(ssl_certificate)
+
+	if verify_status == "SELF-SIGNED":
 		# Certificate is self-signed.
 		return ("SELF-SIGNED", None)
 
-	elif retcode != 0:
-		if "unable to get local issuer certificate" in verifyoutput:
-			return ("The certificate is missing an intermediate chain or the intermediate chain is incorrect or incomplete. (%s)" % verifyoutput, None)
+	elif verify_status == "UNKNOWN-ISSUER":
+		return ("The certificate is missing an intermediate chain or the intermediate chain is incorrect or incomplete. (%s)" % verify_problem, None)
 
-		# There is some unknown problem. Return the `openssl verify` raw output.
-		return ("There is a problem with the SSL certificate.", verifyoutput.strip())
+	elif verify_status != "OK":
+		# There is some other problem.
+		return ("There is a problem with the SSL certificate.", verify_problem)
 
 	else:
-		# `openssl verify` returned a zero exit status so the cert is currently
-		# good.
+		# The chain of trust is good so the cert is currently good.
 
 		# But is it expiring soon?
 		now = datetime.datetime.now(dateutil.tz.tzlocal())
@@ -755,7 +1086,7 @@ def list_apt_updates(apt_update=True):
 
 	return pkgs
 
-def run_and_output_changes(env, pool, send_via_email):
+def run_and_output_changes(env, send_via_email):
 	import json
 	from difflib import SequenceMatcher
 
@@ -767,7 +1098,7 @@ def run_and_output_changes(env, pool, send_via_email):
 
 	# Run status checks.
 	cur = BufferedOutput()
-	run_checks(True, env, cur, pool)
+	run_checks(True, env, cur)
 
 	# Load previously saved status checks.
 	cache_fn = "/var/cache/mailinabox/status_checks.json"
@@ -915,13 +1246,12 @@ if __name__ == "__main__":
 	from utils import load_environment
 
 	env = load_environment()
-	pool = multiprocessing.pool.Pool(processes=10)
 
 	if len(sys.argv) == 1:
-		run_checks(False, env, ConsoleOutput(), pool)
+		run_checks(False, env, ConsoleOutput())
 
 	elif sys.argv[1] == "--show-changes":
-		run_and_output_changes(env, pool, sys.argv[-1] == "--smtp")
+		run_and_output_changes(env, sys.argv[-1] == "--smtp")
 
 	elif sys.argv[1] == "--check-primary-hostname":
 		# See if the primary hostname appears resolvable and has a signed certificate.
@@ -1,4 +1,4 @@
-import os.path
+import os, os.path, contextlib
 
 CONF_DIR = os.path.join(os.path.dirname(__file__), "../conf")
 
@@ -18,6 +18,27 @@ def save_environment(env):
         for k, v in env.items():
             f.write("%s=%s\n" % (k, v))
 
+def file_cache_key(fn):
+    # Returns a value that changes whenever the file at fn is replaced or
+    # modified, for invalidating data cached from the file, or None if
+    # the file does not exist.
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+@contextlib.contextmanager
+def timed(timings, stage):
+    # Adds the wall-clock time (in seconds) spent in a `with` block to
+    # timings[stage], so that repeated stages accumulate.
+    import time
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + (time.perf_counter() - start)
+
 def safe_domain_name(name):
     # Sanitize a domain name so it is safe to use as a file name on disk.
     import urllib.parse
@@ -6,7 +6,7 @@ import os, os.path, shutil, re, tempfile, rtyaml
 
 from mailconfig import get_mail_domains
 from dns_update import get_custom_dns_config, do_dns_update, get_dns_zones
-from utils import shell, safe_domain_name, sort_domains
+from utils import shell, safe_domain_name, sort_domains, file_cache_key
 
 def get_web_domains(env):
 	# What domains should we serve websites for?
@@ -36,20 +36,139 @@ def get_domains_with_a_records(env):
 			domains.add(domain)
 	return domains
 
-def get_web_domains_with_root_overrides(env):
-	# Load custom settings so we can tell what domains have a redirect or proxy set up on '/',
-	# which means static hosting is not happening.
-	root_overrides = { }
-	nginx_conf_custom_fn = os.path.join(env["STORAGE_ROOT"], "www/custom.yaml")
-	if os.path.exists(nginx_conf_custom_fn):
-		custom_settings = rtyaml.load(open(nginx_conf_custom_fn))
-		for domain, settings in custom_settings.items():
+class WebCustomSettings(dict):
+	# The user's custom settings in www/custom.yaml, as a dict mapping each
+	# domain to its settings (proxies and redirects), plus an index of the
+	# domains with a redirect or proxy set up on '/', which means static
+	# hosting is not happening.
+	#
+	# The reserved key "_upstreams" isn't a domain. It names backends that
+	# proxies can share a pool of connections (and optionally a cache) to.
+	# A proxy then uses a dict instead of a URL:
+	#
+	#   _upstreams:
+	#     app:
+	#       servers: [127.0.0.1:8080, 127.0.0.1:8081]
+	#       keepalive: 16  # idle connections kept open, per nginx worker (default 16)
+	#       cache: 10m     # optional: cache responses this long
+	#       cache_size: 100m  # optional: the most disk the cache may use (default 100m)
+	#   example.com:
+	#     proxies:
+	#       /api:
+	#         upstream: app
+	#         path: /v1/   # optional: where on the backend to proxy to
+	#
+	# The parsed upstreams are in the upstreams attribute (see parse_web_upstreams).
+	# Upstreams with bad settings, and proxies that use them or that don't
+	# look right, are left out so that one mistake in the file doesn't stop
+	# everything that reads it. What's wrong is listed in the problems
+	# attribute, which /web/update reports.
+	def __init__(self, settings):
+		settings = dict(settings)
+		self.upstreams, self.problems = parse_web_upstreams(settings.pop("_upstreams", None) or { })
+		for domain, domain_settings in list(settings.items()):
+			if isinstance(domain_settings, dict) and isinstance(domain_settings.get("proxies"), dict):
+				proxies = { }
+				for path, proxy in domain_settings["proxies"].items():
+					problem = check_proxy(path, proxy, self.upstreams)
+					if problem:
+						self.problems.append("%s: %s" % (domain, problem))
+					else:
+						proxies[path] = proxy
+				settings[domain] = dict(domain_settings, proxies=proxies)
+		super().__init__(settings)
+		self.root_overrides = { }
+		for domain, settings in self.items():
 			for type, value in [('redirect', settings.get('redirects', {}).get('/')),
 				('proxy', settings.get('proxies', {}).get('/'))]:
 				if value:
-					root_overrides[domain] = (type, value)
-	return root_overrides
-
+					self.root_overrides[domain] = (type, value)
+
+# Shared upstreams become nginx upstream blocks with these names prefixed,
+# so that they can't be confused with hostnames in other proxy URLs. Their
+# caches go in directories under NGINX_PROXY_CACHE_DIR, which nginx makes.
+NGINX_UPSTREAM_PREFIX = "miab_upstream_"
+NGINX_PROXY_CACHE_DIR = "/var/cache/nginx/mailinabox"
+
+def parse_web_upstreams(upstreams):
+	# Checks the "_upstreams" in custom.yaml and fills in the defaults.
+	# Returns a dict mapping each name to a dict of servers, keepalive,
+	# cache and cache_size (cache is None without caching), and a list of
+	# what's wrong with the upstreams that were left out. Since the values
+	# go into the nginx configuration, anything that doesn't look right
+	# leaves its upstream out.
+	if not isinstance(upstreams, dict):
+		return { }, ["_upstreams must map names to settings."]
+	ret = { }
+	problems = [ ]
+	for name, settings in upstreams.items():
+		try:
+			ret[name] = parse_web_upstream(name, settings)
+		except ValueError as e:
+			problems.append(str(e))
+	return ret, problems
+
+def parse_web_upstream(name, settings):
+	if not isinstance(name, str) or not re.match(r"^[A-Za-z0-9_-]+$", name):
+		raise ValueError("Invalid upstream name: %s" % name)
+	if not isinstance(settings, dict):
+		raise ValueError("The settings for upstream %s must be a mapping." % name)
+	servers = settings.get("servers", settings.get("server"))
+	if isinstance(servers, str): servers = [servers]
+	if not servers or not isinstance(servers, list) or any(not isinstance(s, str) or not re.match(r"^[^;{}\s][^;{}\n]*$", s) for s in servers):
+		raise ValueError("Upstream %s needs one or more servers." % name)
+	keepalive = settings.get("keepalive", 16)
+	if not isinstance(keepalive, int) or keepalive < 1:
+		raise ValueError("The keepalive for upstream %s must be a positive number." % name)
+	cache = settings.get("cache")
+	if cache is not None and not re.match(r"^\d+[smhd]?$", str(cache)):
+		raise ValueError("The cache for upstream %s must be a time, like 10m." % name)
+	cache_size = settings.get("cache_size", "100m")
+	if not re.match(r"^\d+[kmg]?$", str(cache_size), re.I):
+		raise ValueError("The cache_size for upstream %s must be a size, like 100m." % name)
+	return {
+		"servers": servers,
+		"keepalive": keepalive,
+		"cache": str(cache) if cache is not None else None,
+		"cache_size": str(cache_size),
+	}
+
+def check_proxy(path, proxy, upstreams):
+	# Returns what's wrong with a proxy in custom.yaml that names one of the
+	# shared upstreams, or None. (Proxies given as a URL are used as is.)
+	if not isinstance(proxy, dict):
+		return None
+	if proxy.get("upstream") not in upstreams:
+		return "The proxy for %s uses an upstream that is not in _upstreams (or has a problem): %s" % (path, proxy.get("upstream"))
+	upstream_path = proxy.get("path", "")
+	if upstream_path and not re.match(r"^/[^;{}\s]*$", str(upstream_path)):
+		return "The path of the proxy for %s must start with a slash." % path
+	return None
+
+_web_custom_settings = None
+def get_web_custom_settings(env):
+	# Returns a WebCustomSettings. It's needed for every domain on every web
+	# update, so the parsed file is cached until it changes. Callers must not
+	# modify what's returned.
+	global _web_custom_settings
+	nginx_conf_custom_fn = os.path.join(env["STORAGE_ROOT"], "www/custom.yaml")
+	cache_key = (nginx_conf_custom_fn, file_cache_key(nginx_conf_custom_fn))
+	if _web_custom_settings is not None and _web_custom_settings[0] == cache_key:
+		return _web_custom_settings[1]
+
+	settings = { }
+	if cache_key[1] is not None:
+		with open(nginx_conf_custom_fn) as f:
+			settings = rtyaml.load(f) or { }
+	settings = WebCustomSettings(settings)
+	_web_custom_settings = (cache_key, settings)
+	return settings
+
+def get_web_domains_with_root_overrides(env, custom_settings=None):
+	# Get the domains that have a redirect or proxy set up on '/', which means static
+	# hosting is not happening.
+	if custom_settings is None: custom_settings = get_web_custom_settings(env)
+	return custom_settings.root_overrides
 
 def get_default_www_redirects(env):
 	# Returns a list of www subdomains that we want to provide default redirects
@@ -60,41 +179,77 @@ def get_default_www_redirects(env):
 	return sort_domains(www_domains - web_domains - get_domains_with_a_records(env), env)
 
 def do_web_update(env):
-	# Build an nginx configuration file.
-	nginx_conf = open(os.path.join(os.path.dirname(__file__), "../conf/nginx-top.conf")).read()
-
-	# Load the templates.
-	template0 = open(os.path.join(os.path.dirname(__file__), "../conf/nginx.conf")).read()
-	template1 = open(os.path.join(os.path.dirname(__file__), "../conf/nginx-alldomains.conf")).read()
-	template2 = open(os.path.join(os.path.dirname(__file__), "../conf/nginx-primaryonly.conf")).read()
-	template3 = "\trewrite / https://$REDIRECT_DOMAIN permanent;\n"
+	# Build the nginx configuration. Each domain gets its own file in
+	# local.d so that when one domain's configuration changes only that
+	# file is rewritten. The top-level local.conf (which nginx reads
+	# from conf.d) includes them in order.
+	nginx_conf_dir = "/etc/nginx/conf.d/local.d"
+	os.makedirs(nginx_conf_dir, exist_ok=True)
+	domain_confs = []
+	ret = ""
+
+	# Make any self-signed certificates that are needed first.
+	num_certificates, elapsed = ensure_ssl_certificates_exist(env)
+	if num_certificates > 0:
+		ret += "created %d self-signed certificate%s in %.1f seconds\n" % (num_certificates, "s" if num_certificates != 1 else "", elapsed)
+
+		# The new certificates go in their domains' TLSA records.
+		ret += do_dns_update(env)
+
+	# Update the compressed copies of the hosted static files.
+	ret += format_precompress_result(*precompress_web_roots(env))
+
+	# Load the templates and the user's custom settings.
+	templates = get_nginx_templates()
+	custom_settings = get_web_custom_settings(env)
+	for problem in custom_settings.problems:
+		ret += "skipped in www/custom.yaml: %s\n" % problem
+	if any(upstream["cache"] for upstream in custom_settings.upstreams.values()):
+		os.makedirs(NGINX_PROXY_CACHE_DIR, exist_ok=True)
 
 	# Add the PRIMARY_HOST configuration first so it becomes nginx's default server.
-	nginx_conf += make_domain_config(env['PRIMARY_HOSTNAME'], [template0, template1, template2], env)
+	domain_confs.append((env['PRIMARY_HOSTNAME'], make_domain_config(env['PRIMARY_HOSTNAME'], templates["primary"], custom_settings, env)))
 
 	# Add configuration all other web domains.
-	has_root_proxy_or_redirect = get_web_domains_with_root_overrides(env)
+	has_root_proxy_or_redirect = get_web_domains_with_root_overrides(env, custom_settings)
 	for domain in get_web_domains(env):
 		if domain == env['PRIMARY_HOSTNAME']: continue # handled above
 		if domain not in has_root_proxy_or_redirect:
-			nginx_conf += make_domain_config(domain, [template0, template1], env)
+			domain_confs.append((domain, make_domain_config(domain, templates["domain"], custom_settings, env)))
 		else:
-			nginx_conf += make_domain_config(domain, [template0], env)
+			domain_confs.append((domain, make_domain_config(domain, templates["root_override"], custom_settings, env)))
 
 	# Add default www redirects.
 	for domain in get_default_www_redirects(env):
-		nginx_conf += make_domain_config(domain, [template0, template3], env)
-
-	# Did the file change? If not, don't bother writing & restarting nginx.
-	nginx_conf_fn = "/etc/nginx/conf.d/local.conf"
-	if os.path.exists(nginx_conf_fn):
-		with open(nginx_conf_fn) as f:
-			if f.read() == nginx_conf:
-				return ""
-
-	# Save the file.
-	with open(nginx_conf_fn, "w") as f:
-		f.write(nginx_conf)
+		domain_confs.append((domain, make_domain_config(domain, templates["www_redirect"], custom_settings, env)))
+
+	# Write out the files that changed. If none did, don't bother
+	# restarting nginx.
+	changed = False
+	conf_files = []
+	for domain, domain_conf in domain_confs:
+		fn = os.path.join(nginx_conf_dir, safe_domain_name(domain) + ".conf")
+		conf_files.append(fn)
+		if write_nginx_conf_file(fn, domain_conf):
+			changed = True
+
+	nginx_conf = templates["top"] + make_upstreams_config(custom_settings.upstreams)
+	for fn in conf_files:
+		nginx_conf += "include %s;\n" % fn
+	if write_nginx_conf_file("/etc/nginx/conf.d/local.conf", nginx_conf):
+		changed = True
+
+	# Remove the files of domains we no longer serve, now that local.conf
+	# doesn't include them.
+	for fn in os.listdir(nginx_conf_dir):
+		fn = os.path.join(nginx_conf_dir, fn)
+		if fn.endswith(".conf") and fn not in conf_files:
+			os.unlink(fn)
+			_nginx_conf_hashes.pop(fn, None)
+			changed = True
+
+	if not changed:
+		return ret
 
 	# Kick nginx. Since this might be called from the web admin
 	# don't do a 'restart'. That would kill the connection before
@@ -102,9 +257,248 @@ def do_web_update(env):
 	# enough and doesn't break any open connections.
 	shell('check_call', ["/usr/sbin/service", "nginx", "reload"])
 
-	return "web updated\n"
+	return ret + "web updated\n"
+
+def format_precompress_result(num_compressed, num_failed, elapsed):
+	ret = ""
+	if num_compressed > 0:
+		ret += "compressed %d static file%s in %.1f seconds\n" % (num_compressed, "s" if num_compressed != 1 else "", elapsed)
+	if num_failed > 0:
+		ret += "%d static file%s could not be compressed\n" % (num_failed, "s" if num_failed != 1 else "")
+	return ret
+
+_nginx_conf_hashes = { }
+def write_nginx_conf_file(fn, conf):
+	# Writes conf to the file fn unless the file already has exactly that
+	# content, and returns whether the file was written. The hash of each
+	# file is remembered along with its stat info so that unchanged files
+	# aren't read back on every update.
+	import hashlib
+	conf_hash = hashlib.sha1(conf.encode("utf8")).hexdigest()
+	cache_key = file_cache_key(fn)
+	if cache_key is not None:
+		if fn in _nginx_conf_hashes and _nginx_conf_hashes[fn][0] == cache_key:
+			existing_hash = _nginx_conf_hashes[fn][1]
+		else:
+			with open(fn, "rb") as f:
+				existing_hash = hashlib.sha1(f.read()).hexdigest()
+		if existing_hash == conf_hash:
+			_nginx_conf_hashes[fn] = (cache_key, conf_hash)
+			return False
+
+	# Write to a temporary file next to fn and move it into place so
+	# that nginx never sees a partially written file.
+	fd, tmpfn = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(fn))
+	try:
+		with os.fdopen(fd, "w") as f:
+			f.write(conf)
+		os.chmod(tmpfn, 0o644)
+		os.replace(tmpfn, fn)
+	except:
+		os.unlink(tmpfn)
+		raise
+	_nginx_conf_hashes[fn] = (file_cache_key(fn), conf_hash)
+	return True
+
+# Static files worth serving compressed. precompress_web_roots keeps a
+# gzip'd copy of each next to it (name + ".gz"), which nginx sends in
+# place of the file to clients that accept gzip (gzip_static in
+# nginx-alldomains.conf). Files smaller than the minimum size aren't
+# worth it. The copies it made are listed in PRECOMPRESS_MANIFEST so that
+# .gz files that users put in their web roots are never changed.
+PRECOMPRESS_EXTENSIONS = (".html", ".htm", ".css", ".js", ".json", ".xml", ".rss", ".atom", ".svg",
+	".txt", ".md", ".csv", ".ico", ".map", ".webmanifest", ".eot", ".ttf", ".otf")
+PRECOMPRESS_MIN_SIZE = 256
+PRECOMPRESS_MANIFEST = "/var/cache/mailinabox/precompressed_files.json"
+
+def precompress_web_roots(env):
+	# Makes the compressed copies of the files in the hosted web roots
+	# (STORAGE_ROOT/www), as a stage of the web update. Only new and changed
+	# files are compressed, and they are compressed in parallel in worker
+	# processes. Copies whose file is gone or too small now are removed.
+	#
+	# A .gz file is only rewritten or removed if it's listed in the manifest
+	# and hasn't changed since it was written, so that it's certainly one of
+	# ours. A file that already has some other .gz file next to it is left
+	# alone, as are symlinks, since they can point outside the web roots.
+	# Returns the number of files compressed, the number that could not be,
+	# and how long it took.
+	import multiprocessing, stat, time
+	start = time.perf_counter()
+	www = os.path.join(env["STORAGE_ROOT"], "www")
+	manifest = load_precompress_manifest()
+	new_manifest = { }
+
+	def is_ours(gz_path):
+		return gz_path in manifest and file_cache_key(gz_path) == tuple(manifest[gz_path]["copy"])
+
+	todo = []
+	for web_root in (sorted(os.listdir(www)) if os.path.isdir(www) else []):
+		web_root = os.path.join(www, web_root)
+		if not os.path.isdir(web_root) or os.path.islink(web_root): continue # e.g. custom.yaml
+		for dirpath, dirnames, filenames in os.walk(web_root, followlinks=False):
+			# Skip dotfiles like .git, which nginx doesn't serve, and
+			# symlinked files. (os.walk doesn't go into symlinked directories.)
+			dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+			files = set(filenames)
+			for fn in filenames:
+				if fn.startswith(".") or not fn.lower().endswith(PRECOMPRESS_EXTENSIONS): continue
+				path = os.path.join(dirpath, fn)
+				gz_path = path + ".gz"
+				if fn + ".gz" in files and not is_ours(gz_path): continue # the user's own
+				try:
+					st = os.lstat(path)
+				except FileNotFoundError:
+					continue # deleted since the walk saw it
+				if not stat.S_ISREG(st.st_mode): continue # e.g. a symlink
+				if st.st_size < PRECOMPRESS_MIN_SIZE: continue # any copy of ours is removed below
+				if fn + ".gz" in files and manifest[gz_path]["source"] == [st.st_mtime_ns, st.st_size]:
+					new_manifest[gz_path] = manifest[gz_path] # up to date
+					continue
+				todo.append(path)
+
+	num_compressed = num_failed = 0
+	if len(todo) > 0:
+		pool = multiprocessing.Pool(processes=min(os.cpu_count() or 1, len(todo)))
+		try:
+			for path, result in zip(todo, pool.imap(precompress_file, todo, chunksize=16)):
+				if result is None:
+					num_failed += 1
+				elif result is not False:
+					new_manifest[path + ".gz"] = result
+					num_compressed += 1
+		finally:
+			pool.terminate()
+
+	# Remove our copies that weren't kept above: their file is gone, too
+	# small, or didn't get smaller when compressed.
+	for gz_path in manifest:
+		if gz_path not in new_manifest and is_ours(gz_path):
+			os.unlink(gz_path)
+
+	save_precompress_manifest(new_manifest)
+	return num_compressed, num_failed, time.perf_counter() - start
+
+def precompress_file(fn):
+	# Writes the compressed copy of fn (see precompress_web_roots). Returns
+	# its manifest entry if it was written, False if compressing didn't make
+	# the file any smaller (in which case there's no copy), or None if the
+	# file could not be read or the copy could not be written.
+	import gzip, stat
+	gz_fn = fn + ".gz"
+	try:
+		st = os.stat(fn)
+		fd, tmpfn = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(fn))
+		try:
+			with os.fdopen(fd, "wb") as tmp:
+				with open(fn, "rb") as f, gzip.GzipFile(filename="", mode="wb", fileobj=tmp, compresslevel=9, mtime=int(st.st_mtime)) as gz:
+					shutil.copyfileobj(f, gz)
+				size = tmp.tell()
+			if size >= st.st_size:
+				os.unlink(tmpfn)
+				return False
+
+			# The copy must be readable by nginx just like the file, and belong
+			# to the same user so that they can replace or remove it.
+			os.chmod(tmpfn, stat.S_IMODE(st.st_mode))
+			if os.geteuid() == 0:
+				os.chown(tmpfn, st.st_uid, st.st_gid)
+			os.utime(tmpfn, ns=(st.st_atime_ns, st.st_mtime_ns))
+			os.replace(tmpfn, gz_fn)
+		except:
+			if os.path.exists(tmpfn): os.unlink(tmpfn)
+			raise
+	except OSError:
+		return None
+	return { "source": [st.st_mtime_ns, st.st_size], "copy": list(file_cache_key(gz_fn)) }
+
+def load_precompress_manifest():
+	# Returns a dict mapping the path of each compressed copy we made to the
+	# mtime and size of its file when it was made and the copy's cache key.
+	import json
+	try:
+		with open(PRECOMPRESS_MANIFEST) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return { }
+
+def save_precompress_manifest(manifest):
+	import json
+	os.makedirs(os.path.dirname(PRECOMPRESS_MANIFEST), exist_ok=True)
+	fd, tmpfn = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(PRECOMPRESS_MANIFEST))
+	try:
+		with os.fdopen(fd, "w") as f:
+			json.dump(manifest, f)
+		os.replace(tmpfn, PRECOMPRESS_MANIFEST)
+	except:
+		os.unlink(tmpfn)
+		raise
+
+# The placeholder in each template where the next template goes, and the
+# variables that are filled in for each domain.
+NGINX_PLACEHOLDER = re.compile("[ \t]*# ADDITIONAL DIRECTIVES HERE *\n")
+NGINX_VARIABLES = re.compile(r"\$(STORAGE_ROOT|HOSTNAME|ROOT|SSL_KEY|SSL_CERTIFICATE|REDIRECT_DOMAIN)")
+
+def fill_nginx_placeholder(template, directives):
+	# Places directives into the "# ADDITIONAL DIRECTIVES HERE" placeholder(s)
+	# of the template, as is.
+	return NGINX_PLACEHOLDER.sub(lambda m : directives, template)
+
+_nginx_templates = None
+def get_nginx_templates():
+	# Loads the nginx configuration templates and combines them into the
+	# template for each kind of domain, which only has to be done again
+	# when a template file changes. Returns a dict of:
+	#
+	# top: the start of local.conf
+	# primary: PRIMARY_HOSTNAME
+	# domain: other domains that we serve a website for
+	# root_override: domains with a proxy or redirect set up on '/'
+	# www_redirect: default www redirects
+	global _nginx_templates
+	fns = [os.path.join(os.path.dirname(__file__), "../conf", fn)
+		for fn in ("nginx-top.conf", "nginx.conf", "nginx-alldomains.conf", "nginx-primaryonly.conf")]
+	cache_key = [file_cache_key(fn) for fn in fns]
+	if _nginx_templates is not None and _nginx_templates[0] == cache_key:
+		return _nginx_templates[1]
+
+	top, template0, template1, template2 = [open(fn).read() for fn in fns]
+	template3 = "\trewrite / https://$REDIRECT_DOMAIN permanent;\n"
 
-def make_domain_config(domain, templates, env):
+	# Combine the pieces. Iteratively place each template into the "# ADDITIONAL DIRECTIVES HERE"
+	# placeholder of the previous template. Each domain's own directives go into whatever
+	# placeholder is left (template3 has none, so default www redirects get none).
+	def compose(templates):
+		nginx_conf = "# ADDITIONAL DIRECTIVES HERE\n"
+		for t in templates:
+			nginx_conf = fill_nginx_placeholder(nginx_conf, t)
+		return nginx_conf
+
+	templates = {
+		"top": top,
+		"primary": compose([template0, template1, template2]),
+		"domain": compose([template0, template1]),
+		"root_override": compose([template0]),
+		"www_redirect": compose([template0, template3]),
+	}
+
+	_nginx_templates = (cache_key, templates)
+	return templates
+
+_file_hashes = { }
+def hash_file(fn):
+	# Returns the SHA1 hex digest of a file, which is remembered until the
+	# file changes.
+	import hashlib
+	cache_key = file_cache_key(fn)
+	if fn in _file_hashes and _file_hashes[fn][0] == cache_key:
+		return _file_hashes[fn][1]
+	with open(fn, 'rb') as f:
+		digest = hashlib.sha1(f.read()).hexdigest()
+	_file_hashes[fn] = (cache_key, digest)
+	return digest
+
+def make_domain_config(domain, template, custom_settings, env):
 	# GET SOME VARIABLES
 
 	# Where will its root directory be for static files?
@@ -114,7 +508,8 @@ def make_domain_config(domain, templates, env):
 	ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env)
 
 	# For hostnames created after the initial setup, ensure we have an SSL certificate
-	# available. Make a self-signed one now if one doesn't exist.
+	# available. do_web_update will have made them already, but make a self-signed
+	# one now if one doesn't exist.
 	ensure_ssl_certificate_exists(domain, ssl_key, ssl_certificate, env)
 
 	# ADDITIONAL DIRECTIVES.
@@ -123,49 +518,85 @@ def make_domain_config(domain, templates, env):
 
 	# Because the certificate may change, we should recognize this so we
 	# can trigger an nginx update.
-	def hashfile(filepath):
-		import hashlib
-		sha1 = hashlib.sha1()
-		f = open(filepath, 'rb')
-		try:
-			sha1.update(f.read())
-		finally:
-			f.close()
-		return sha1.hexdigest()
-	nginx_conf_extra += "# ssl files sha1: %s / %s\n" % (hashfile(ssl_key), hashfile(ssl_certificate))
+	nginx_conf_extra += "# ssl files sha1: %s / %s\n" % (hash_file(ssl_key), hash_file(ssl_certificate))
 
 	# Add in any user customizations in YAML format.
-	nginx_conf_custom_fn = os.path.join(env["STORAGE_ROOT"], "www/custom.yaml")
-	if os.path.exists(nginx_conf_custom_fn):
-		yaml = rtyaml.load(open(nginx_conf_custom_fn))
-		if domain in yaml:
-			yaml = yaml[domain]
-			for path, url in yaml.get("proxies", {}).items():
-				nginx_conf_extra += "\tlocation %s {\n\t\tproxy_pass %s;\n\t}\n" % (path, url)
-			for path, url in yaml.get("redirects", {}).items():
-				nginx_conf_extra += "\trewrite %s %s permanent;\n" % (path, url)
+	if domain in custom_settings:
+		yaml = custom_settings[domain]
+		for path, proxy in yaml.get("proxies", {}).items():
+			nginx_conf_extra += make_proxy_config(path, proxy, custom_settings.upstreams)
+		for path, url in yaml.get("redirects", {}).items():
+			nginx_conf_extra += "\trewrite %s %s permanent;\n" % (path, url)
 
 	# Add in any user customizations in the includes/ folder.
 	nginx_conf_custom_include = os.path.join(env["STORAGE_ROOT"], "www", safe_domain_name(domain) + ".conf")
 	if os.path.exists(nginx_conf_custom_include):
 		nginx_conf_extra += "\tinclude %s;\n" % (nginx_conf_custom_include)
-	# PUT IT ALL TOGETHER
-
-	# Combine the pieces. Iteratively place each template into the "# ADDITIONAL DIRECTIVES HERE" placeholder
-	# of the previous template.
-	nginx_conf = "# ADDITIONAL DIRECTIVES HERE\n"
-	for t in templates + [nginx_conf_extra]:
-		nginx_conf = re.sub("[ \t]*# ADDITIONAL DIRECTIVES HERE *\n", t, nginx_conf)
 
-	# Replace substitution strings in the template & return.
-	nginx_conf = nginx_conf.replace("$STORAGE_ROOT", env['STORAGE_ROOT'])
-	nginx_conf = nginx_conf.replace("$HOSTNAME", domain)
-	nginx_conf = nginx_conf.replace("$ROOT", root)
-	nginx_conf = nginx_conf.replace("$SSL_KEY", ssl_key)
-	nginx_conf = nginx_conf.replace("$SSL_CERTIFICATE", ssl_certificate)
-	nginx_conf = nginx_conf.replace("$REDIRECT_DOMAIN", re.sub(r"^www\.", "", domain)) # for default www redirects to parent domain
+	# PUT IT ALL TOGETHER
 
-	return nginx_conf
+	# Place the additional directives into the template, then replace the
+	# substitution strings in one pass & return.
+	nginx_conf = fill_nginx_placeholder(template, nginx_conf_extra)
+	values = {
+		"STORAGE_ROOT": env['STORAGE_ROOT'],
+		"HOSTNAME": domain,
+		"ROOT": root,
+		"SSL_KEY": ssl_key,
+		"SSL_CERTIFICATE": ssl_certificate,
+		"REDIRECT_DOMAIN": re.sub(r"^www\.", "", domain), # for default www redirects to parent domain
+	}
+	return NGINX_VARIABLES.sub(lambda m : values[m.group(1)], nginx_conf)
+
+def make_proxy_config(path, proxy, upstreams):
+	# The location block for a proxy in custom.yaml, which is either a URL
+	# or a dict that names one of the shared upstreams.
+	if not isinstance(proxy, dict):
+		return "\tlocation %s {\n\t\tproxy_pass %s;\n\t}\n" % (path, proxy)
+
+	# WebCustomSettings has already left out proxies that fail check_proxy.
+	name = proxy["upstream"]
+	upstream = upstreams[name]
+	upstream_path = proxy.get("path", "")
+
+	conf = "\tlocation %s {\n" % path
+	conf += "\t\tproxy_pass http://%s%s;\n" % (NGINX_UPSTREAM_PREFIX + name, upstream_path)
+
+	# Keeping the upstream's connections open needs HTTP/1.1, without the
+	# "Connection: close" header nginx sends by default.
+	conf += "\t\tproxy_http_version 1.1;\n"
+	conf += "\t\tproxy_set_header Connection \"\";\n"
+
+	# The backend would otherwise see the upstream's name as the Host.
+	conf += "\t\tproxy_set_header Host $host;\n"
+
+	if upstream["cache"]:
+		# Several domains can share the upstream and so its cache, so the
+		# host must be part of the cache key.
+		conf += "\t\tproxy_cache %s;\n" % (NGINX_UPSTREAM_PREFIX + name)
+		conf += "\t\tproxy_cache_key $scheme$host$request_uri;\n"
+		conf += "\t\tproxy_cache_valid 200 301 302 %s;\n" % upstream["cache"]
+
+	conf += "\t}\n"
+	return conf
+
+def make_upstreams_config(upstreams):
+	# The shared upstream blocks, and the caches of those that have one,
+	# which go at the top of local.conf.
+	conf = ""
+	for name, upstream in sorted(upstreams.items()):
+		nginx_name = NGINX_UPSTREAM_PREFIX + name
+		conf += "\nupstream %s {\n" % nginx_name
+		for server in upstream["servers"]:
+			conf += "\tserver %s;\n" % server
+		conf += "\tkeepalive %d;\n" % upstream["keepalive"]
+		conf += "}\n"
+		if upstream["cache"]:
+			conf += "proxy_cache_path %s levels=1:2 keys_zone=%s:10m max_size=%s inactive=%s;\n" \
+				% (os.path.join(NGINX_PROXY_CACHE_DIR, name), nginx_name, upstream["cache_size"], upstream["cache"])
+	if conf:
+		conf += "\n"
+	return conf
 
 def get_web_root(domain, env, test_exists=True):
 	# Try STORAGE_ROOT/web/domain_name if it exists, but fall back to STORAGE_ROOT/web/default.
@@ -214,115 +645,226 @@ def get_domain_ssl_files(domain, env, allow_shared_cert=True):
 
 	return ssl_key, ssl_certificate, ssl_via
 
-def ensure_ssl_certificate_exists(domain, ssl_key, ssl_certificate, env):
-	# For domains besides PRIMARY_HOSTNAME, generate a self-signed certificate if
+def needs_self_signed_certificate(domain, ssl_certificate, env):
+	# For domains besides PRIMARY_HOSTNAME, we generate a self-signed certificate if
 	# a certificate doesn't already exist. See setup/mail.sh for documentation.
 
 	if domain == env['PRIMARY_HOSTNAME']:
-		return
+		return False
 
 	# Sanity check. Shouldn't happen. A non-primary domain might use this
 	# certificate (see above), but then the certificate should exist anyway.
 	if ssl_certificate == os.path.join(env["STORAGE_ROOT"], 'ssl/ssl_certificate.pem'):
-		return
-
-	if os.path.exists(ssl_certificate):
-		return
-
-	os.makedirs(os.path.dirname(ssl_certificate), exist_ok=True)
+		return False
 
-	# Generate a new self-signed certificate using the same private key that we already have.
+	return not os.path.exists(ssl_certificate)
 
-	# Start with a CSR written to a temporary file.
-	with tempfile.NamedTemporaryFile(mode="w") as csr_fp:
-		csr_fp.write(create_csr(domain, ssl_key, env))
-		csr_fp.flush() # since we won't close until after running 'openssl x509', since close triggers delete.
+def ensure_ssl_certificate_exists(domain, ssl_key, ssl_certificate, env):
+	# Generate a new self-signed certificate using the same private key that we
+	# already have, if the domain needs one.
+	if needs_self_signed_certificate(domain, ssl_certificate, env):
+		from ssl_certificates import create_self_signed_certificate
+		create_self_signed_certificate(domain, ssl_key, ssl_certificate, env)
+
+def ensure_ssl_certificates_exist(env):
+	# For hostnames created after the initial setup, make self-signed certificates
+	# for all of the domains that need one before building the nginx configuration.
+	# When many domains are added at once there can be many to make, so make them
+	# in parallel. Returns the number of certificates made and how long it took.
+	import multiprocessing.pool, time
+	from ssl_certificates import load_private_key, create_self_signed_certificate
+
+	start = time.perf_counter()
+	missing = []
+	for domain in get_web_domains(env) + get_default_www_redirects(env):
+		ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env)
+		if needs_self_signed_certificate(domain, ssl_certificate, env):
+			missing.append((domain, ssl_key, ssl_certificate, env))
+
+	if len(missing) > 0:
+		# Load the private keys first so that the threads don't all load them.
+		for ssl_key in set(args[1] for args in missing):
+			load_private_key(ssl_key)
+		pool = multiprocessing.pool.ThreadPool(processes=min(10, len(missing)))
+		try:
+			pool.starmap(create_self_signed_certificate, missing)
+		finally:
+			pool.terminate()
 
-		# And then make the certificate.
-		shell("check_call", [
-			"openssl", "x509", "-req",
-			"-days", "365",
-			"-in", csr_fp.name,
-			"-signkey", ssl_key,
-			"-out", ssl_certificate])
+	return len(missing), time.perf_counter() - start
 
 def create_csr(domain, ssl_key, env):
-	return shell("check_output", [
-                "openssl", "req", "-new",
-                "-key", ssl_key,
-                "-sha256",
-                "-subj", "/C=%s/ST=/L=/O=/CN=%s" % (env["CSR_COUNTRY"], domain)])
+	from ssl_certificates import create_csr
+	return create_csr([domain], ssl_key, env)
+
+def create_csrs(domains, env, multi_domain=False):
+	# Returns a list of (domains, CSR): a CSR for each domain using its own
+	# private key, or with multi_domain one CSR for all of the domains using
+	# the first domain's private key (for a multi-domain certificate to be
+	# installed for that domain). The private keys are loaded once.
+	from ssl_certificates import create_csr
+	if len(domains) == 0:
+		raise ValueError("No domains were given.")
+	valid_domains = set(get_web_domains(env)) | set(get_default_www_redirects(env))
+	for domain in domains:
+		if domain not in valid_domains:
+			raise ValueError("Invalid domain name: %s" % domain)
+
+	if multi_domain:
+		ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domains[0], env)
+		return [(domains, create_csr(domains, ssl_key, env))]
+	ret = []
+	for domain in domains:
+		ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env)
+		ret.append(([domain], create_csr([domain], ssl_key, env)))
+	return ret
 
 def install_cert(domain, ssl_cert, ssl_chain, env):
-	if domain not in get_web_domains(env):
-		return "Invalid domain name."
+	# Installs a single certificate (see install_certs). Returns what
+	# happened, starting with "OK" on success, or what's wrong with it.
+	try:
+		return install_certs([(domain, ssl_cert, ssl_chain)], env)
+	except ValueError as e:
+		return str(e)
+
+def install_certs(certs, env):
+	# Installs certificates, given as a list of (domain, certificate, chain).
+	# All of them are checked, in parallel, before any is installed, and if
+	# any is not OK then none are installed and ValueError is raised saying
+	# what's wrong. Otherwise they are all moved into place, or if that
+	# fails partway the ones already moved are put back, and then DNS (for
+	# the TLSA records), the mail services (if PRIMARY_HOSTNAME's
+	# certificate changed) and nginx are each updated just once.
+	import multiprocessing.pool
+	from status_checks import check_certificate
+	from ssl_certificates import forget_certificate
 
-	# Write the combined cert+chain to a temporary path and validate that it is OK.
-	# The certificate always goes above the chain.
-	import tempfile, os
-	fd, fn = tempfile.mkstemp('.pem')
-	os.write(fd, (ssl_cert + '\n' + ssl_chain).encode("ascii"))
-	os.close(fd)
+	if len(certs) == 0:
+		raise ValueError("No certificates were given.")
 
-	# Do validation on the certificate before installing it.
-	from status_checks import check_certificate
-	ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env, allow_shared_cert=False)
-	cert_status, cert_status_details = check_certificate(domain, fn, ssl_key)
-	if cert_status != "OK":
+	web_domains = set(get_web_domains(env))
+	domains = [domain for domain, ssl_cert, ssl_chain in certs]
+	errors = []
+	for i, domain in enumerate(domains):
+		if domain not in web_domains:
+			errors.append((domain, "Invalid domain name."))
+		elif domain in domains[:i]:
+			errors.append((domain, "The domain is given more than once."))
+
+	def check_cert(staged_cert):
+		domain, fn, ssl_key, ssl_certificate = staged_cert
+		cert_status, cert_status_details = check_certificate(domain, fn, ssl_key)
+		if cert_status == "OK":
+			return None
 		if cert_status == "SELF-SIGNED":
 			cert_status = "This is a self-signed certificate. I can't install that."
-		os.unlink(fn)
 		if cert_status_details is not None:
 			cert_status += " " + cert_status_details
 		return cert_status
 
-	# Copy the certificate to its expected location.
-	os.makedirs(os.path.dirname(ssl_certificate), exist_ok=True)
-	shutil.move(fn, ssl_certificate)
+	staged = [] # (domain, temporary file, ssl_key, ssl_certificate)
+	created_dirs = []
+	installed = False
+	try:
+		if len(errors) == 0:
+			# Write each certificate to a temporary file next to where it goes,
+			# so that it can be checked there and then moved into place. The
+			# certificate always goes above the chain.
+			for domain, ssl_cert, ssl_chain in certs:
+				ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env, allow_shared_cert=False)
+				cert_dir = os.path.dirname(ssl_certificate)
+				if not os.path.exists(cert_dir):
+					os.makedirs(cert_dir)
+					created_dirs.append(cert_dir)
+				fd, fn = tempfile.mkstemp(prefix=".", suffix=".pem", dir=cert_dir)
+				staged.append((domain, fn, ssl_key, ssl_certificate))
+				with os.fdopen(fd, "wb") as f:
+					f.write((ssl_cert + '\n' + ssl_chain).encode("ascii"))
+
+			pool = multiprocessing.pool.ThreadPool(processes=min(10, len(staged)))
+			try:
+				for staged_cert, error in zip(staged, pool.map(check_cert, staged)):
+					if error is not None:
+						errors.append((staged_cert[0], error))
+			finally:
+				pool.terminate()
+
+		if len(errors) > 0:
+			if len(certs) == 1:
+				raise ValueError(errors[0][1])
+			raise ValueError("".join("%s: %s\n" % e for e in errors))
+
+		# Move them into place. Each certificate being replaced is kept (as
+		# a hard link next to it) until they're all in place, so that if one
+		# can't be moved the ones before it can be put back.
+		moved = [] # (domain, ssl_certificate, backup file or None)
+		try:
+			for domain, fn, ssl_key, ssl_certificate in staged:
+				backup = None
+				if os.path.exists(ssl_certificate):
+					backup = fn + ".old"
+					os.link(ssl_certificate, backup)
+				try:
+					os.replace(fn, ssl_certificate)
+				except:
+					if backup: os.unlink(backup)
+					raise
+				moved.append((domain, ssl_certificate, backup))
+		except OSError as e:
+			still_installed = []
+			for domain, ssl_certificate, backup in reversed(moved):
+				try:
+					if backup:
+						os.replace(backup, ssl_certificate)
+					else:
+						os.unlink(ssl_certificate)
+				except OSError:
+					still_installed.append(domain)
+			message = "The certificates could not be installed (%s)." % e
+			if len(still_installed) > 0:
+				message += " The certificates for these domains were installed and could not be taken back out: %s." % ", ".join(sort_domains(still_installed, env))
+			raise ValueError(message)
+		finally:
+			for domain, ssl_certificate, backup in moved:
+				if backup and os.path.exists(backup): os.unlink(backup)
+		installed = True
+	finally:
+		for domain, fn, ssl_key, ssl_certificate in staged:
+			forget_certificate(fn)
+		if not installed:
+			for domain, fn, ssl_key, ssl_certificate in staged:
+				if os.path.exists(fn): os.unlink(fn)
+			for cert_dir in reversed(created_dirs):
+				if os.path.exists(cert_dir) and len(os.listdir(cert_dir)) == 0:
+					os.rmdir(cert_dir)
 
 	ret = ["OK"]
 
-	# When updating the cert for PRIMARY_HOSTNAME, also update DNS because it is
-	# used in the DANE TLSA record and restart postfix and dovecot which use
-	# that certificate.
-	if domain == env['PRIMARY_HOSTNAME']:
-		ret.append( do_dns_update(env) )
+	# Each web domain's certificate is in its TLSA records. Only the zones
+	# that changed are updated.
+	ret.append( do_dns_update(env) )
 
+	# Postfix and dovecot use the certificate for PRIMARY_HOSTNAME.
+	if env['PRIMARY_HOSTNAME'] in domains:
 		shell('check_call', ["/usr/sbin/service", "postfix", "restart"])
 		shell('check_call', ["/usr/sbin/service", "dovecot", "restart"])
 		ret.append("mail services restarted")
 
-	# Kick nginx so it sees the cert.
+	# Kick nginx so it sees the certificates.
 	ret.append( do_web_update(env) )
-	return "\n".join(ret)
+	return "\n".join(r for r in ret if r)
 
-def get_web_domains_info(env):
+def get_web_domains_info(env, with_ssl_status=True):
+	# For the SSL config panel. Without with_ssl_status, the domains are
+	# returned without their "ssl_certificate" status, which the panel
+	# can then get from iter_web_domains_ssl_status as the checks finish.
 	has_root_proxy_or_redirect = get_web_domains_with_root_overrides(env)
 
-	# for the SSL config panel, get cert status
-	def check_cert(domain):
-		from status_checks import check_certificate
-		ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env)
-		if not os.path.exists(ssl_certificate):
-			return ("danger", "No Certificate Installed")
-		cert_status, cert_status_details = check_certificate(domain, ssl_certificate, ssl_key)
-		if cert_status == "OK":
-			if not ssl_via:
-				return ("success", "Signed & valid. " + cert_status_details)
-			else:
-				# This is an alternate domain but using the same cert as the primary domain.
-				return ("success", "Signed & valid. " + ssl_via)
-		elif cert_status == "SELF-SIGNED":
-			return ("warning", "Self-signed. Get a signed certificate to stop warnings.")
-		else:
-			return ("danger", "Certificate has a problem: " + cert_status)
-
-	return [
+	ret = [
 		{
 			"domain": domain,
 			"root": get_web_root(domain, env),
 			"custom_root": get_web_root(domain, env, test_exists=False),
-			"ssl_certificate": check_cert(domain),
 			"static_enabled": domain not in has_root_proxy_or_redirect,
 		}
 		for domain in get_web_domains(env)
@@ -330,8 +872,61 @@ def get_web_domains_info(env):
 	[
 		{
 			"domain": domain,
-			"ssl_certificate": check_cert(domain),
 			"static_enabled": False,
 		}
 		for domain in get_default_www_redirects(env)
 	]
+
+	if with_ssl_status:
+		status = dict(iter_web_domains_ssl_status([d["domain"] for d in ret], env))
+		for d in ret:
+			d["ssl_certificate"] = status[d["domain"]]
+
+	return ret
+
+def get_web_domain_ssl_status(domain, ssl_key, ssl_certificate, ssl_via):
+	# The certificate status shown for a domain in the SSL config panel.
+	from status_checks import check_certificate
+	if not os.path.exists(ssl_certificate):
+		return ("danger", "No Certificate Installed")
+	cert_status, cert_status_details = check_certificate(domain, ssl_certificate, ssl_key)
+	if cert_status == "OK":
+		if not ssl_via:
+			return ("success", "Signed & valid. " + cert_status_details)
+		else:
+			# This is an alternate domain but using the same cert as the primary domain.
+			return ("success", "Signed & valid. " + ssl_via)
+	elif cert_status == "SELF-SIGNED":
+		return ("warning", "Self-signed. Get a signed certificate to stop warnings.")
+	else:
+		return ("danger", "Certificate has a problem: " + cert_status)
+
+def iter_web_domains_ssl_status(domains, env):
+	# Yields (domain, status) for each domain as its certificate check
+	# finishes, not in the order given. Many domains can share a certificate
+	# (the primary hostname's multi-domain or wildcard certificate), so the
+	# domains are grouped by certificate. Each group is checked in a thread:
+	# its first domain reads and verifies the certificate, and the rest of
+	# the group gets that from the ssl_certificates cache.
+	import multiprocessing.pool
+
+	groups = { }
+	for domain in domains:
+		ssl_key, ssl_certificate, ssl_via = get_domain_ssl_files(domain, env)
+		groups.setdefault((ssl_key, ssl_certificate), []).append((domain, ssl_via))
+
+	def check_group(item):
+		(ssl_key, ssl_certificate), group = item
+		return [
+			(domain, get_web_domain_ssl_status(domain, ssl_key, ssl_certificate, ssl_via))
+			for domain, ssl_via in group
+		]
+
+	if len(groups) == 0:
+		return
+	pool = multiprocessing.pool.ThreadPool(processes=min(10, len(groups)))
+	try:
+		for results in pool.imap_unordered(check_group, groups.items()):
+			yield from results
+	finally:
+		pool.terminate()
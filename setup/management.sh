@@ -2,9 +2,12 @@
 
 source setup/functions.sh
 
-apt_install python3-flask links duplicity libyaml-dev python3-dnspython python3-dateutil
-hide_output pip3 install rtyaml "email_validator==0.1.0-rc5"
+apt_install python3-flask links duplicity libyaml-dev python3-dnspython python3-dateutil \
+	libssl-dev libffi-dev
+hide_output pip3 install rtyaml "email_validator==0.1.0-rc5" "cryptography==2.8"
 	# email_validator is repeated in setup/questions.sh
+	# libssl-dev and libffi-dev are needed to build cryptography, and 2.8 is the
+	# last version of cryptography that supports Ubuntu 14.04's Python 3.4
 
 # Create a backup directory and a random key for encrypting backups.
 mkdir -p $STORAGE_ROOT/backup
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# Measures how long it takes to check an SSL certificate.
+#
+# python3 tests/benchmark_certificates.py [--count 50] [--output results.json]
+#
+# This makes a throwaway CA (a root and an intermediate) and certificates
+# signed by it, self-signed certificates, and certificates signed by a
+# server certificate that isn't a CA (which must not pass the check), using
+# benchmark_fixtures.py.
+# Each certificate is then checked two ways:
+#
+# openssl: the openssl commands that check_certificate used to run for each
+#   certificate (x509 -text, rsa -modulus, x509 -modulus, and verify)
+# check_certificate: the in-process check, with nothing cached
+#
+# and the average time per certificate of each is reported. The time for a
+# check_certificate call that is answered from its cache is reported too.
+# The throwaway root CA stands in for the system's trusted CAs.
+
+import sys, os, os.path, time, json, tempfile, shutil, argparse, subprocess, platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../management"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import benchmark_fixtures
+import ssl_certificates
+from status_checks import check_certificate
+
+def make_certificates(dir, count):
+	# Returns a list of (domain, certificate file, private key file) and the
+	# path to a CA bundle that trusts the CA that signed them.
+	root_key, root_cert = os.path.join(dir, "root.key"), os.path.join(dir, "root.pem")
+	benchmark_fixtures.make_certificate(root_key, root_cert, "Benchmark Root CA", is_ca=True, days=3650)
+	ca_key, ca_cert = os.path.join(dir, "ca.key"), os.path.join(dir, "ca.pem")
+	benchmark_fixtures.make_certificate(ca_key, ca_cert, "Benchmark Intermediate CA",
+		issuer_key_fn=root_key, issuer_cert_fn=root_cert, is_ca=True, days=3650)
+	server_key, server_cert = os.path.join(dir, "server.key"), os.path.join(dir, "server.pem")
+	benchmark_fixtures.make_certificate(server_key, server_cert, "not-a-ca.example.com",
+		issuer_key_fn=ca_key, issuer_cert_fn=ca_cert)
+
+	certs = []
+	for i in range(count):
+		domain = benchmark_fixtures.tenant_domain(i)
+		key_fn, cert_fn = os.path.join(dir, domain + ".key"), os.path.join(dir, domain + ".pem")
+		if i % 3 == 0:
+			# A signed certificate followed by its intermediate chain.
+			benchmark_fixtures.make_certificate(key_fn, cert_fn, domain, names=["www." + domain],
+				issuer_key_fn=ca_key, issuer_cert_fn=ca_cert)
+			with open(cert_fn, "a") as f, open(ca_cert) as chain:
+				f.write(chain.read())
+		elif i % 3 == 1:
+			benchmark_fixtures.make_certificate(key_fn, cert_fn, domain)
+		else:
+			# Signed by a server certificate, whose chain is otherwise good.
+			benchmark_fixtures.make_certificate(key_fn, cert_fn, domain,
+				issuer_key_fn=server_key, issuer_cert_fn=server_cert)
+			with open(cert_fn, "a") as f:
+				for chain_fn in (server_cert, ca_cert):
+					with open(chain_fn) as chain:
+						f.write(chain.read())
+		certs.append((domain, cert_fn, key_fn))
+	return certs, root_cert
+
+def check_with_openssl(domain, ssl_certificate, ssl_private_key, ca_file):
+	# The subprocesses the old check_certificate ran for a certificate.
+	run(["openssl", "x509", "-in", ssl_certificate, "-noout", "-text", "-nameopt", "rfc2253"])
+	run(["openssl", "rsa", "-inform", "PEM", "-noout", "-modulus", "-in", ssl_private_key])
+	run(["openssl", "x509", "-in", ssl_certificate, "-noout", "-modulus"])
+	with open(ssl_certificate) as f:
+		chain = f.read().split("-----END CERTIFICATE-----", 1)[1].strip()
+	run(["openssl", "verify", "-verbose", "-purpose", "sslserver", "-policy_check", "-CAfile", ca_file]
+		+ ([] if chain == "" else ["-untrusted", "/dev/stdin"])
+		+ [ssl_certificate],
+		input=chain.encode("ascii"))
+
+def run(cmd, input=None):
+	# Like subprocess.run, which Python 3.4 doesn't have.
+	proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	return proc.communicate(input=input)[0]
+
+def clear_caches():
+	ssl_certificates._certificate_cache.clear()
+	ssl_certificates._private_key_cache.clear()
+	ssl_certificates._verify_cache.clear()
+
+def time_per_certificate(certs, func):
+	start = time.perf_counter()
+	for cert in certs:
+		func(*cert)
+	return (time.perf_counter() - start) / len(certs)
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark SSL certificate checks.")
+	parser.add_argument("--count", type=int, default=50, help="number of certificates to check")
+	parser.add_argument("--output", help="where to write the results as JSON")
+	args = parser.parse_args()
+
+	dir = tempfile.mkdtemp(prefix="miab-benchmark-")
+	try:
+		certs, ca_file = make_certificates(dir, args.count)
+		ssl_certificates.CA_CERTIFICATES = ca_file
+
+		# Make sure the in-process check gets the answers we expect.
+		statuses = { }
+		for domain, cert_fn, key_fn in certs:
+			status = check_certificate(domain, cert_fn, key_fn, warn_if_expiring_soon=False)[0]
+			statuses[status] = statuses.get(status, 0) + 1
+		print("Statuses: " + ", ".join("%s: %d" % s for s in sorted(statuses.items())))
+
+		def check_uncached(domain, cert_fn, key_fn):
+			clear_caches()
+			check_certificate(domain, cert_fn, key_fn)
+
+		results = {
+			"openssl": time_per_certificate(certs, lambda d, c, k: check_with_openssl(d, c, k, ca_file)),
+			"check_certificate": time_per_certificate(certs, check_uncached),
+		}
+
+		# Fill the caches, then time answering from them.
+		for cert in certs:
+			check_certificate(*cert)
+		results["check_certificate_cached"] = time_per_certificate(certs, check_certificate)
+	finally:
+		shutil.rmtree(dir)
+
+	for name, seconds in results.items():
+		line = "%-26s %8.2f ms per certificate" % (name, seconds * 1000)
+		if name != "openssl":
+			line += "  (%.0fx faster than openssl)" % (results["openssl"] / seconds)
+		print(line)
+
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump({
+				"date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+				"python": platform.python_version(),
+				"count": args.count,
+				"statuses": statuses,
+				"seconds_per_certificate": results,
+			}, f, indent=2)
+
+if __name__ == "__main__":
+	main()
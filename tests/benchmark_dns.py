@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# Measures how DNS zone generation scales with the number of domains.
+#
+# python3 tests/benchmark_dns.py [--sizes 10,1000,10000] [--output results.json] [--compare old.json]
+#
+# For each size, this builds a throwaway STORAGE_ROOT with synthetic tenants
+# (see benchmark_fixtures.py) and runs zone generation end to end --- the same
+# steps as do_dns_update and build_recommended_dns --- writing zone files into
+# a temporary directory. Calls out to nsd, ldns, and other programs are
+# stubbed out, so nothing on this machine is changed.
+#
+# Each size is run twice: once for wall time, and once instrumented to get
+# peak memory and a per-function profile. The results are written to a JSON
+# file, by default in the system's temporary directory. The instrumented run
+# is many times slower than the timed one; pass --no-profile to skip it. Pass
+# --compare with the results from another commit to see what got faster or
+# slower.
+
+import sys, os, os.path, time, json, tempfile, shutil, argparse, subprocess, platform
+import cProfile, pstats, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../management"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import benchmark_fixtures
+import dns_update
+
+def fake_shell(method, cmd_args, **kwargs):
+	# Stands in for utils.shell so that no programs are run.
+	ret = 0 if method == "check_call" else ""
+	return ret if not kwargs.get("trap") else (0, ret)
+
+def generate_zones(env, zones_dir):
+	# The zone generation steps of do_dns_update, plus build_recommended_dns
+	# which the control panel's External DNS page uses. Returns the timings
+	# of each step and the number of zones and records generated.
+	from web_update import get_default_www_redirects
+	timings = { }
+	with dns_update.timed(timings, "get_dns_zones"):
+		domains = dns_update.get_dns_domains(env)
+		zonefiles = dns_update.get_dns_zones(env)
+	with dns_update.timed(timings, "prepare"):
+		additional_records = dns_update.get_custom_dns_config(env)
+		www_redirect_domains = get_default_www_redirects(env)
+		tlsa_records = dns_update.get_web_tlsa_records(env)
+	num_records = 0
+	for domain, zonefile in zonefiles:
+		with dns_update.timed(timings, "build_zone"):
+			records = dns_update.build_zone(domain, domains, additional_records, www_redirect_domains, tlsa_records, env)
+		with dns_update.timed(timings, "write_nsd_zone"):
+			dns_update.write_nsd_zone(domain, os.path.join(zones_dir, zonefile), records, env, False)
+		num_records += len(records)
+	with dns_update.timed(timings, "build_recommended_dns"):
+		dns_update.build_recommended_dns(env)
+	return timings, len(zonefiles), num_records
+
+def run_size(num_domains, profile_top, profile=True):
+	storage_root = tempfile.mkdtemp(prefix="miab-benchmark-")
+	try:
+		env = benchmark_fixtures.make_storage_root(storage_root, num_domains)
+		zones_dir = os.path.join(storage_root, "zones")
+
+		# Timing run. Each run starts with empty zone files so that every
+		# zone is written out.
+		os.makedirs(zones_dir)
+		start = time.perf_counter()
+		timings, num_zones, num_records = generate_zones(env, zones_dir)
+		timings["total"] = time.perf_counter() - start
+
+		result = {
+			"domains": num_domains,
+			"zones": num_zones,
+			"records": num_records,
+			"timings": timings,
+			"peak_memory_bytes": None,
+			"profile": [],
+		}
+		if not profile:
+			return result
+
+		# Instrumented run.
+		shutil.rmtree(zones_dir)
+		os.makedirs(zones_dir)
+		profiler = cProfile.Profile()
+		tracemalloc.start()
+		profiler.enable()
+		generate_zones(env, zones_dir)
+		profiler.disable()
+		current_memory, peak_memory = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+
+		result["peak_memory_bytes"] = peak_memory
+		result["profile"] = get_profile(profiler, profile_top)
+		return result
+	finally:
+		shutil.rmtree(storage_root)
+
+def get_profile(profiler, top):
+	# The functions with the most cumulative time, as a list of dicts.
+	stats = pstats.Stats(profiler)
+	rows = []
+	for (filename, lineno, funcname), (cc, nc, tt, ct, callers) in stats.stats.items():
+		rows.append({
+			"function": "%s:%d(%s)" % (os.path.basename(filename), lineno, funcname),
+			"calls": nc,
+			"tottime": tt,
+			"cumtime": ct,
+		})
+	rows.sort(key=lambda r: -r["cumtime"])
+	return rows[:top]
+
+def get_commit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=subprocess.DEVNULL).decode("ascii").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def print_result(result, previous=None):
+	print("%d domains: %d zones, %d records" % (result["domains"], result["zones"], result["records"]))
+	if result["peak_memory_bytes"] is not None:
+		print("  peak memory %.1f MB" % (result["peak_memory_bytes"]/1024/1024))
+	for step, seconds in result["timings"].items():
+		line = "  %-22s %9.3fs" % (step, seconds)
+		if previous and step in previous["timings"] and previous["timings"][step] > 0:
+			line += "  (%+.0f%% vs. previous)" % ((seconds / previous["timings"][step] - 1) * 100)
+		print(line)
+	if result["profile"]:
+		print("  top functions by cumulative time:")
+	for row in result["profile"][:10]:
+		print("    %9.3fs %8d calls  %s" % (row["cumtime"], row["calls"], row["function"]))
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark DNS zone generation.")
+	parser.add_argument("--sizes", default="10,1000,10000",
+		help="comma-separated numbers of domains to test")
+	parser.add_argument("--output", default=os.path.join(tempfile.gettempdir(), "benchmark_dns.json"),
+		help="where to write the results")
+	parser.add_argument("--compare",
+		help="results file from a previous run to compare with")
+	parser.add_argument("--no-profile", action="store_true",
+		help="skip the instrumented run, which is slow for large sizes")
+	parser.add_argument("--profile-top", type=int, default=40,
+		help="number of functions to keep in each profile")
+	args = parser.parse_args()
+
+	# Don't run any programs.
+	dns_update.shell = fake_shell
+	import status_checks, web_update
+	status_checks.shell = fake_shell
+	web_update.shell = fake_shell
+
+	previous = { }
+	if args.compare:
+		with open(args.compare) as f:
+			previous = { r["domains"]: r for r in json.load(f)["results"] }
+
+	results = []
+	for size in [int(s) for s in args.sizes.split(",")]:
+		result = run_size(size, args.profile_top, profile=not args.no_profile)
+		print_result(result, previous.get(size))
+		results.append(result)
+
+	with open(args.output, "w") as f:
+		json.dump({
+			"commit": get_commit(),
+			"date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+			"python": platform.python_version(),
+			"results": results,
+		}, f, indent=2)
+	print("Results written to %s." % args.output)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#
+# Builds a throwaway STORAGE_ROOT full of synthetic tenants for the
+# benchmark_*.py scripts in this directory. Nothing here touches the
+# real box: everything is written under the directory you pass in.
+
+import os, os.path, sqlite3, base64, datetime
+
+PRIMARY_HOSTNAME = "box.example.com"
+
+def make_env(storage_root):
+	# The settings that would normally come from /etc/mailinabox.conf.
+	return {
+		"STORAGE_ROOT": storage_root,
+		"PRIMARY_HOSTNAME": PRIMARY_HOSTNAME,
+		"PUBLIC_IP": "192.0.2.1",
+		"PUBLIC_IPV6": "2001:db8::1",
+		"CSR_COUNTRY": "US",
+	}
+
+def make_storage_root(storage_root, num_domains):
+	# Creates users, aliases, custom DNS records, and the DKIM, DNSSEC and
+	# SSL keys that zone generation reads. Returns the env to use with it.
+	env = make_env(storage_root)
+	for d in ("mail/dkim", "dns/dnssec", "ssl", "www"):
+		os.makedirs(os.path.join(storage_root, d), exist_ok=True)
+
+	make_users_db(os.path.join(storage_root, "mail/users.sqlite"), num_domains)
+	make_custom_dns(os.path.join(storage_root, "dns/custom.yaml"), num_domains)
+	make_dkim_record(os.path.join(storage_root, "mail/dkim/mail.txt"))
+	make_dnssec_keys(os.path.join(storage_root, "dns/dnssec"))
+	make_certificate(
+		os.path.join(storage_root, "ssl/ssl_private_key.pem"),
+		os.path.join(storage_root, "ssl/ssl_certificate.pem"),
+		PRIMARY_HOSTNAME)
+	return env
+
+def tenant_domain(i):
+	# Spread the tenants over a few TLDs so the zones don't all sort alike.
+	return "tenant%d.example.%s" % (i, ("com", "org", "net")[i % 3])
+
+def make_users_db(fn, num_domains):
+	# Same schema as setup/mail-users.sh. Every tenant gets a user, and every
+	# fifth tenant also gets an alias on a subdomain (which goes in the
+	# tenant's zone rather than getting its own).
+	if os.path.exists(fn): os.unlink(fn)
+	conn = sqlite3.connect(fn)
+	c = conn.cursor()
+	c.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, password TEXT NOT NULL, extra, privileges TEXT NOT NULL DEFAULT '');")
+	c.execute("CREATE TABLE aliases (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL UNIQUE, destination TEXT NOT NULL);")
+	c.execute("INSERT INTO users (email, password, privileges) VALUES (?, ?, ?)", ("admin@" + PRIMARY_HOSTNAME, "{SHA512-CRYPT}x", "admin"))
+	c.execute("INSERT INTO aliases (source, destination) VALUES (?, ?)", ("administrator@" + PRIMARY_HOSTNAME, "admin@" + PRIMARY_HOSTNAME))
+	for i in range(num_domains):
+		domain = tenant_domain(i)
+		c.execute("INSERT INTO users (email, password) VALUES (?, ?)", ("user@" + domain, "{SHA512-CRYPT}x"))
+		if i % 5 == 0:
+			c.execute("INSERT INTO aliases (source, destination) VALUES (?, ?)", ("info@lists." + domain, "user@" + domain))
+	conn.commit()
+	conn.close()
+
+def make_custom_dns(fn, num_domains):
+	# A mix of the kinds of custom records people set: extra TXT records,
+	# records that override our defaults, and hosts pointed elsewhere.
+	with open(fn, "w") as f:
+		for i in range(num_domains):
+			domain = tenant_domain(i)
+			if i % 2 == 0:
+				f.write("%s:\n  TXT:\n  - google-site-verification=%08d\n  - v=spf1 mx include:_spf.example.net -all\n" % (domain, i))
+			if i % 3 == 0:
+				f.write("www.%s: 198.51.100.%d\n" % (domain, i % 250 + 1))
+			if i % 4 == 0:
+				f.write("app.%s:\n  A: local\n  AAAA: local\n" % domain)
+				f.write("_dmarc.%s:\n  TXT: v=DMARC1; p=none\n" % domain)
+			if i % 7 == 0:
+				f.write("mail2.%s:\n  CNAME: %s.\n" % (domain, PRIMARY_HOSTNAME))
+
+def make_dkim_record(fn):
+	# Same format as the mail.txt file opendkim-genkey writes.
+	with open(fn, "w") as f:
+		f.write('mail._domainkey\tIN\tTXT\t( "v=DKIM1; k=rsa; "\n\t  "p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDZ7W8z0c1WLm7fOI+3yiR9Ea" )  ; ----- DKIM key mail for %s\n' % PRIMARY_HOSTNAME)
+
+def make_dnssec_keys(dnssec_dir):
+	# Writes key files in the format ldns-keygen uses, and the .conf files
+	# that setup/dns.sh writes to say which keys are current.
+	from cryptography.hazmat.primitives.asymmetric import rsa
+	from cryptography.hazmat.backends import default_backend
+	for algo, algo_num in (("RSASHA1-NSEC3-SHA1", 7), ("RSASHA256", 8)):
+		conf = { }
+		for key_type, flags, bits in (("KSK", 257, 2048), ("ZSK", 256, 1024)):
+			key = rsa.generate_private_key(public_exponent=65537, key_size=bits, backend=default_backend())
+			pub = key.public_key().public_numbers()
+			priv = key.private_numbers()
+			def b64(n):
+				return base64.b64encode(n.to_bytes((n.bit_length() + 7) // 8, "big")).decode("ascii")
+
+			# RFC 3110 public key: exponent length, exponent, modulus.
+			exponent = pub.e.to_bytes((pub.e.bit_length() + 7) // 8, "big")
+			pubkey = bytes([len(exponent)]) + exponent + pub.n.to_bytes((pub.n.bit_length() + 7) // 8, "big")
+			rdata = flags.to_bytes(2, "big") + bytes([3, algo_num]) + pubkey
+			fn = "K_domain_.+%03d+%05d" % (algo_num, dnskey_tag(rdata))
+			conf[key_type] = fn
+
+			with open(os.path.join(dnssec_dir, fn + ".key"), "w") as f:
+				f.write("_domain_.\tIN\tDNSKEY\t%d 3 %d %s ;{id = %d (%s), size = %db}\n"
+					% (flags, algo_num, base64.b64encode(pubkey).decode("ascii"), dnskey_tag(rdata), key_type.lower(), bits))
+			with open(os.path.join(dnssec_dir, fn + ".private"), "w") as f:
+				f.write("Private-key-format: v1.2\nAlgorithm: %d (%s)\n" % (algo_num, algo))
+				for name, value in (("Modulus", pub.n), ("PublicExponent", pub.e), ("PrivateExponent", priv.d),
+					("Prime1", priv.p), ("Prime2", priv.q), ("Exponent1", priv.dmp1), ("Exponent2", priv.dmq1),
+					("Coefficient", priv.iqmp)):
+					f.write("%s: %s\n" % (name, b64(value)))
+
+		with open(os.path.join(dnssec_dir, algo + ".conf"), "w") as f:
+			for key_type, fn in sorted(conf.items()):
+				f.write("%s=%s\n" % (key_type, fn))
+
+def dnskey_tag(rdata):
+	# The key tag algorithm in RFC 4034 Appendix B.
+	ac = 0
+	for i, b in enumerate(rdata):
+		ac += b if i & 1 else b << 8
+	ac += (ac >> 16) & 0xFFFF
+	return ac & 0xFFFF
+
+def make_certificate(key_fn, cert_fn, domain, names=[], issuer_key_fn=None, issuer_cert_fn=None, is_ca=False, days=90, path_length=None, key_cert_sign=None):
+	# Writes a private key and a certificate for it: self-signed, or signed by
+	# the given issuer (to build a chain). With is_ca, the certificate can
+	# itself be used as an issuer, limited to path_length intermediates below
+	# it if given. If key_cert_sign is given, the certificate gets a key usage
+	# extension that does or doesn't allow signing certificates.
+	from cryptography import x509
+	from cryptography.x509.oid import NameOID
+	from cryptography.hazmat.primitives import hashes, serialization
+	from cryptography.hazmat.primitives.asymmetric import rsa
+	from cryptography.hazmat.backends import default_backend
+
+	key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+	with open(key_fn, "wb") as f:
+		f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+
+	subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domain)])
+	issuer, signing_key = subject, key
+	if issuer_key_fn:
+		with open(issuer_key_fn, "rb") as f:
+			signing_key = serialization.load_pem_private_key(f.read(), password=None, backend=default_backend())
+		with open(issuer_cert_fn, "rb") as f:
+			issuer = x509.load_pem_x509_certificate(f.read(), default_backend()).subject
+
+	now = datetime.datetime.now(datetime.timezone.utc)
+	cert = x509.CertificateBuilder() \
+		.subject_name(subject) \
+		.issuer_name(issuer) \
+		.public_key(key.public_key()) \
+		.serial_number(x509.random_serial_number()) \
+		.not_valid_before(now - datetime.timedelta(days=1)) \
+		.not_valid_after(now + datetime.timedelta(days=days)) \
+		.add_extension(x509.SubjectAlternativeName([x509.DNSName(n) for n in [domain] + list(names)]), critical=False)
+	if is_ca:
+		cert = cert.add_extension(x509.BasicConstraints(ca=True, path_length=path_length), critical=True)
+	if key_cert_sign is not None:
+		cert = cert.add_extension(x509.KeyUsage(digital_signature=True, content_commitment=False, key_encipherment=not is_ca,
+			data_encipherment=False, key_agreement=False, key_cert_sign=key_cert_sign, crl_sign=is_ca,
+			encipher_only=False, decipher_only=False), critical=True)
+	cert = cert.sign(signing_key, hashes.SHA256(), default_backend())
+
+	with open(cert_fn, "wb") as f:
+		f.write(cert.public_bytes(serialization.Encoding.PEM))
@@ -0,0 +1,9 @@
+# pytest settings for the unit tests in this directory, which run without a
+# Mail-in-a-Box. The other scripts here test a live box and aren't collected.
+
+import sys, os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../management"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+collect_ignore = ["test_dns.py", "test_mail.py", "test_smtp_server.py", "tls.py"]
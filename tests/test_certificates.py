@@ -0,0 +1,117 @@
+# Tests of the certificate chain check in ssl_certificates.py.
+#
+# python3 -m pytest tests
+
+import os.path
+
+import pytest
+
+import benchmark_fixtures
+from ssl_certificates import check_chain, get_certificate_info, load_pem_certificates
+
+@pytest.fixture
+def ca(tmp_path):
+	# A throwaway root CA and an intermediate CA signed by it.
+	root = (str(tmp_path / "root.key"), str(tmp_path / "root.pem"))
+	benchmark_fixtures.make_certificate(root[0], root[1], "Test Root CA", is_ca=True, days=3650)
+	intermediate = (str(tmp_path / "ca.key"), str(tmp_path / "ca.pem"))
+	benchmark_fixtures.make_certificate(intermediate[0], intermediate[1], "Test Intermediate CA",
+		issuer_key_fn=root[0], issuer_cert_fn=root[1], is_ca=True, days=3650)
+	return root, intermediate
+
+def trusted(cert_fn):
+	with open(cert_fn) as f:
+		cert = load_pem_certificates(f.read())[0]
+	return { cert.subject: [cert] }
+
+def make_server_certificate(tmp_path, name, issuer, chain=[], **kwargs):
+	# Writes a certificate signed by issuer, followed by the chain files.
+	key_fn, cert_fn = str(tmp_path / (name + ".key")), str(tmp_path / (name + ".pem"))
+	if issuer is None:
+		benchmark_fixtures.make_certificate(key_fn, cert_fn, name, **kwargs)
+	else:
+		benchmark_fixtures.make_certificate(key_fn, cert_fn, name, issuer_key_fn=issuer[0], issuer_cert_fn=issuer[1], **kwargs)
+	with open(cert_fn, "a") as f:
+		for chain_fn in chain:
+			with open(chain_fn) as c:
+				f.write(c.read())
+	return key_fn, cert_fn
+
+def check(cert_fn, root):
+	return check_chain(get_certificate_info(cert_fn), trusted(root[1]))
+
+def test_chain_ok(tmp_path, ca):
+	root, intermediate = ca
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", intermediate, [intermediate[1]])
+	assert check(cert_fn, root) == ("OK", None)
+
+def test_signed_by_root(tmp_path, ca):
+	root, intermediate = ca
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", root)
+	assert check(cert_fn, root) == ("OK", None)
+
+def test_self_signed(tmp_path, ca):
+	root, intermediate = ca
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", None)
+	assert check(cert_fn, root) == ("SELF-SIGNED", None)
+
+def test_missing_intermediate(tmp_path, ca):
+	root, intermediate = ca
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", intermediate)
+	status, problem = check(cert_fn, root)
+	assert status == "UNKNOWN-ISSUER"
+	assert "CN=Test Intermediate CA" in problem
+
+def test_expired(tmp_path, ca):
+	root, intermediate = ca
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", intermediate, [intermediate[1]], days=-1)
+	assert check(cert_fn, root) == ("INVALID", "The certificate CN=example.com has expired.")
+
+def test_intermediate_not_a_ca(tmp_path, ca):
+	# A server certificate can't issue certificates, even though its
+	# signature on one checks out and its own chain is good.
+	root, intermediate = ca
+	server = make_server_certificate(tmp_path, "server.example.com", intermediate)
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", server, [server[1], intermediate[1]])
+	status, problem = check(cert_fn, root)
+	assert status == "INVALID"
+	assert "CN=server.example.com is not a CA certificate" in problem
+
+def test_root_issues_to_non_ca(tmp_path, ca):
+	# The same, one step further down from a trusted CA.
+	root, intermediate = ca
+	server = make_server_certificate(tmp_path, "server.example.com", root)
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", server, [server[1]])
+	status, problem = check(cert_fn, root)
+	assert status == "INVALID"
+	assert "CN=server.example.com is not a CA certificate" in problem
+
+def test_intermediate_without_cert_sign(tmp_path, ca):
+	root, intermediate = ca
+	limited = make_server_certificate(tmp_path, "Limited CA", root, is_ca=True, key_cert_sign=False)
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", limited, [limited[1]])
+	status, problem = check(cert_fn, root)
+	assert status == "INVALID"
+	assert "CN=Limited CA is not allowed to sign certificates" in problem
+
+def test_intermediate_with_cert_sign(tmp_path, ca):
+	root, intermediate = ca
+	allowed = make_server_certificate(tmp_path, "Allowed CA", root, is_ca=True, key_cert_sign=True)
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", allowed, [allowed[1]])
+	assert check(cert_fn, root) == ("OK", None)
+
+def test_path_length(tmp_path, ca):
+	# A root that allows no intermediates can sign server certificates
+	# directly but not through the intermediate.
+	root, intermediate = ca
+	strict_root = (str(tmp_path / "strict.key"), str(tmp_path / "strict.pem"))
+	benchmark_fixtures.make_certificate(strict_root[0], strict_root[1], "Strict Root CA", is_ca=True, path_length=0)
+
+	key_fn, cert_fn = make_server_certificate(tmp_path, "direct.example.com", strict_root)
+	assert check(cert_fn, strict_root) == ("OK", None)
+
+	sub = make_server_certificate(tmp_path, "Sub CA", strict_root, is_ca=True)
+	key_fn, cert_fn = make_server_certificate(tmp_path, "example.com", sub, [sub[1]])
+	status, problem = check(cert_fn, strict_root)
+	assert status == "INVALID"
+	assert "CN=Strict Root CA allows at most 0 intermediate certificates" in problem
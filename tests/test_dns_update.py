@@ -0,0 +1,184 @@
+# Tests of the TLSA and DS records and the custom DNS changes in
+# dns_update.py, using a throwaway STORAGE_ROOT from benchmark_fixtures.py.
+#
+# python3 -m pytest tests
+
+import os, os.path, hashlib
+
+import pytest
+
+import benchmark_fixtures
+import dns_update
+
+NUM_DOMAINS = 6
+
+@pytest.fixture(scope="module")
+def env(tmp_path_factory):
+	return benchmark_fixtures.make_storage_root(str(tmp_path_factory.mktemp("storage")), NUM_DOMAINS)
+
+@pytest.fixture
+def custom_dns(env):
+	# Starts each test with the fixtures' custom.yaml.
+	benchmark_fixtures.make_custom_dns(os.path.join(env["STORAGE_ROOT"], "dns/custom.yaml"), NUM_DOMAINS)
+	return os.path.join(env["STORAGE_ROOT"], "dns/custom.yaml")
+
+def tlsa_records(cert_fn):
+	# The TLSA record values for a certificate, computed without ssl_certificates.py.
+	from cryptography import x509
+	from cryptography.hazmat.primitives import serialization
+	from cryptography.hazmat.backends import default_backend
+	with open(cert_fn, "rb") as f:
+		cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+	spki = cert.public_key().public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+	return [
+		"3 0 1 " + hashlib.sha256(cert.public_bytes(serialization.Encoding.DER)).hexdigest(),
+		"3 1 1 " + hashlib.sha256(spki).hexdigest(),
+	]
+
+def make_domain_certificate(env, domain, fn="ssl_certificate.pem"):
+	cert_dir = os.path.join(env["STORAGE_ROOT"], "ssl", domain)
+	os.makedirs(cert_dir, exist_ok=True)
+	cert_fn = os.path.join(cert_dir, fn)
+	benchmark_fixtures.make_certificate(os.path.join(cert_dir, "private_key.pem"), cert_fn, domain)
+	return os.path.join(cert_dir, "ssl_certificate.pem")
+
+def test_primary_tlsa_record(env):
+	cert_fn = os.path.join(env["STORAGE_ROOT"], "ssl/ssl_certificate.pem")
+	assert dns_update.build_tlsa_record(env) == tlsa_records(cert_fn)[0]
+
+def test_web_tlsa_records(env, custom_dns):
+	domain = benchmark_fixtures.tenant_domain(1)
+	cert_fn = make_domain_certificate(env, domain)
+	records = dns_update.get_web_tlsa_records(env)
+	assert records[env["PRIMARY_HOSTNAME"]] == tlsa_records(os.path.join(env["STORAGE_ROOT"], "ssl/ssl_certificate.pem"))
+	assert records[domain] == tlsa_records(cert_fn)
+
+	# Domains without a certificate of their own yet have no records.
+	assert benchmark_fixtures.tenant_domain(2) not in records
+
+	# A new certificate gets new records.
+	make_domain_certificate(env, domain, "new_certificate.pem")
+	os.replace(os.path.join(os.path.dirname(cert_fn), "new_certificate.pem"), cert_fn)
+	assert dns_update.get_web_tlsa_records(env)[domain] == tlsa_records(cert_fn)
+	assert dns_update.get_web_tlsa_records(env)[domain] != records[domain]
+
+def test_no_tlsa_record_without_own_certificate(tmp_path, monkeypatch):
+	# A domain that nginx serves with the primary certificate gets no TLSA
+	# record for HTTPS, while one with its own certificate does.
+	import ssl_certificates
+	env = benchmark_fixtures.make_storage_root(str(tmp_path / "storage"), NUM_DOMAINS)
+	with_cert, shared_cert = benchmark_fixtures.tenant_domain(4), benchmark_fixtures.tenant_domain(5)
+	make_domain_certificate(env, with_cert)
+
+	# Make the primary certificate good for shared_cert too.
+	root = (str(tmp_path / "root.key"), str(tmp_path / "root.pem"))
+	benchmark_fixtures.make_certificate(root[0], root[1], "Test Root CA", is_ca=True)
+	monkeypatch.setattr(ssl_certificates, "CA_CERTIFICATES", root[1])
+	benchmark_fixtures.make_certificate(
+		os.path.join(env["STORAGE_ROOT"], "ssl/ssl_private_key.pem"),
+		os.path.join(env["STORAGE_ROOT"], "ssl/ssl_certificate.pem"),
+		env["PRIMARY_HOSTNAME"], names=[shared_cert], issuer_key_fn=root[0], issuer_cert_fn=root[1])
+
+	domains = dns_update.get_dns_domains(env)
+	additional_records = dns_update.get_custom_dns_config(env)
+	tlsa_records = dns_update.get_web_tlsa_records(env)
+	assert shared_cert not in tlsa_records
+
+	def https_tlsa(domain):
+		records = dns_update.build_zone(domain, domains, additional_records, [], tlsa_records, env)
+		return [value for qname, rtype, value, explanation in records if (qname, rtype) == ("_443._tcp", "TLSA")]
+	assert https_tlsa(shared_cert) == []
+	assert https_tlsa(with_cert) == tlsa_records[with_cert]
+	assert env["PRIMARY_HOSTNAME"] in tlsa_records
+
+def ksk(env, algo):
+	# The domain's KSK as a dnspython DNSKEY rdata, read from its .key file.
+	import dns.rdata, dns.rdataclass, dns.rdatatype
+	with open(os.path.join(env["STORAGE_ROOT"], "dns/dnssec/%s.conf" % algo)) as f:
+		key_fn = dict(line.strip().split("=", 1) for line in f)["KSK"]
+	with open(os.path.join(env["STORAGE_ROOT"], "dns/dnssec", key_fn + ".key")) as f:
+		rdata = f.read().split("DNSKEY", 1)[1].split(";", 1)[0].strip()
+	return dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.DNSKEY, rdata)
+
+def make_ds(name, key, digest_type):
+	# Newer versions of dnspython only make SHA1 DS records when told to.
+	import dns.dnssec
+	if hasattr(dns.dnssec, "allow_all_policy"):
+		return dns.dnssec.make_ds(name, key, digest_type, policy=dns.dnssec.allow_all_policy).to_text()
+	return dns.dnssec.make_ds(name, key, digest_type).to_text()
+
+@pytest.mark.parametrize("domain,algo", [
+	(benchmark_fixtures.tenant_domain(0), "RSASHA1-NSEC3-SHA1"),
+	(benchmark_fixtures.PRIMARY_HOSTNAME, "RSASHA1-NSEC3-SHA1"),
+	("Tenant0.Example.COM", "RSASHA1-NSEC3-SHA1"), # the digest is over the lowercased name
+	("tenant.example.email", "RSASHA256"),
+])
+def test_ds_records(env, domain, algo):
+	import dns.dnssec, dns.name
+	key = ksk(env, algo)
+	name = dns.name.from_text(domain)
+	assert dns_update.get_ds_records(domain, env) == [
+		make_ds(name, key, "SHA256"),
+		make_ds(name, key, "SHA1"),
+	]
+	assert dns_update.get_ds_records(domain, env)[0].split(" ")[0] == str(dns.dnssec.key_id(key))
+
+def test_custom_dns_batch(env, custom_dns):
+	tenant0, tenant1 = benchmark_fixtures.tenant_domain(0), benchmark_fixtures.tenant_domain(1)
+	changed = dns_update.set_custom_dns_records([
+		("new." + tenant0, "a", "198.51.100.7", "add"),
+		(tenant0, "TXT", "v=spf1 -all", "set"),
+		("www." + tenant0, "A", None, "remove"),
+		("new." + tenant1, "CNAME", "elsewhere.example.net.", "add"),
+	], env)
+	assert changed == { tenant0, tenant1 }
+
+	records = list(dns_update.get_custom_dns_config(env))
+	assert ("new." + tenant0, "A", "198.51.100.7") in records
+	assert [r for r in records if r[:2] == (tenant0, "TXT")] == [(tenant0, "TXT", "v=spf1 -all")]
+	assert not any(r[0] == "www." + tenant0 for r in records)
+	assert ("new." + tenant1, "CNAME", "elsewhere.example.net.") in records
+
+	# Making the same changes again changes nothing.
+	assert dns_update.set_custom_dns_records([
+		("new." + tenant0, "A", "198.51.100.7", "add"),
+		(tenant0, "TXT", "v=spf1 -all", "set"),
+	], env) == set()
+
+def test_custom_dns_batch_all_or_nothing(env, custom_dns):
+	with open(custom_dns) as f:
+		before = f.read()
+	tenant0 = benchmark_fixtures.tenant_domain(0)
+	for bad_change in [
+		("elsewhere.example.net", "A", "198.51.100.7", "add"),
+		("new." + tenant0, "A", "2001:db8::7", "add"),
+		("new." + tenant0, "NS", "ns.example.net.", "add"),
+		("new." + tenant0, "A", "198.51.100.7", "replace"),
+	]:
+		with pytest.raises(ValueError):
+			dns_update.set_custom_dns_records([("ok." + tenant0, "A", "198.51.100.8", "add"), bad_change], env)
+		with open(custom_dns) as f:
+			assert f.read() == before
+
+def test_custom_dns_batch_secondary_nameserver(env, custom_dns):
+	# Every zone has the secondary nameserver's NS record.
+	assert dns_update.set_custom_dns_records([
+		("_secondary_nameserver", "A", "ns2.example.net", "set"),
+		("new." + benchmark_fixtures.tenant_domain(0), "A", "198.51.100.7", "add"),
+	], env) is None
+	assert dns_update.get_secondary_dns(dns_update.get_custom_dns_config(env)) == "ns2.example.net"
+
+def test_normalize_custom_dns_record(env, custom_dns):
+	tenant0 = benchmark_fixtures.tenant_domain(0)
+	assert dns_update.normalize_custom_dns_record(" new." + tenant0 + " ", " 198.51.100.7\n") == ("new." + tenant0, "198.51.100.7")
+	assert dns_update.normalize_custom_dns_record("bücher." + tenant0, "v=spf1 -all ") == ("xn--bcher-kva." + tenant0, "v=spf1 -all")
+	assert dns_update.normalize_custom_dns_record(tenant0, None) == (tenant0, None)
+	with pytest.raises(ValueError):
+		dns_update.normalize_custom_dns_record("bücher.." + tenant0, "198.51.100.7")
+
+	assert dns_update.normalize_custom_dns_record(tenant0, "v=spf1 –all") == (tenant0, "v=spf1 all")
+
+	# A normalized name goes in its zone.
+	qname, value = dns_update.normalize_custom_dns_record("bücher." + tenant0, "198.51.100.7")
+	assert dns_update.set_custom_dns_records([(qname, "A", value, "add")], env) == { tenant0 }
+	assert ("xn--bcher-kva." + tenant0, "A", "198.51.100.7") in dns_update.get_custom_dns_config(env)
@@ -0,0 +1,72 @@
+# Tests of the DNS cache that the status checks share within each run.
+#
+# python3 -m pytest tests
+
+import threading, time, asyncio, inspect
+
+import status_checks
+
+def test_runs_have_their_own_dns_cache(monkeypatch):
+	lookups = []
+	def resolve_dns(qname, rtype):
+		lookups.append((str(qname), rtype))
+		return ("192.0.2.1", time.time() + 300)
+	monkeypatch.setattr(status_checks, "resolve_dns", resolve_dns)
+
+	# A run (e.g. a background refresh) is part way through when another
+	# run starts. Starting the new run doesn't empty the first one's cache
+	# or mix up their counts.
+	background = status_checks.DnsCache()
+	started, resume = threading.Event(), threading.Event()
+	answers = []
+	def background_check(output):
+		answers.append(status_checks.query_dns("box.example.com", "A"))
+		started.set()
+		resume.wait(10)
+		answers.append(status_checks.query_dns("box.example.com", "A"))
+	thread = threading.Thread(target=status_checks.run_with_dns_cache, args=(background, background_check, None))
+	thread.start()
+	assert started.wait(10)
+
+	foreground = status_checks.DnsCache()
+	status_checks.run_with_dns_cache(foreground, lambda output : answers.append(status_checks.query_dns("box.example.com", "A")), None)
+	resume.set()
+	thread.join(10)
+
+	assert answers == ["192.0.2.1"] * 3
+	assert lookups == [("box.example.com.", "A")] * 2
+	assert background.stats == { "queries": 1, "cached": 1, "shared": 0, "timeouts": 0 }
+	assert foreground.stats == { "queries": 1, "cached": 0, "shared": 0, "timeouts": 0 }
+	assert foreground.format_stats().startswith("1 lookups:")
+
+def test_dns_cache_outside_a_run(monkeypatch):
+	monkeypatch.setattr(status_checks, "resolve_dns", lambda qname, rtype : (None, time.time() + 60))
+	monkeypatch.setattr(status_checks, "_default_dns_cache", status_checks.DnsCache())
+	assert status_checks.query_dns("nothing.example.com", "MX") == "[Not Set]"
+	assert status_checks.query_dns("nothing.example.com", "MX", None) is None
+	assert status_checks._default_dns_cache.stats["cached"] == 1
+
+def test_checks_run_on_the_event_loop(monkeypatch):
+	# The checks' generator-based coroutines still work on versions of
+	# Python whose asyncio only accepts native coroutines.
+	monkeypatch.setattr(status_checks, "resolve_dns", lambda qname, rtype : ("192.0.2.1", time.time() + 300))
+	def check(output):
+		output.print_ok("Checked.")
+		return status_checks.query_dns("box.example.com", "A")
+	def slow_check(output):
+		time.sleep(0.5)
+
+	@status_checks.coroutine
+	def run_checks(executor):
+		semaphore = asyncio.Semaphore(2)
+		dns_cache = status_checks.DnsCache()
+		first = yield from status_checks.ensure_future(status_checks.run_check(check, 5, executor, semaphore, dns_cache))
+		rest = yield from asyncio.gather(*[status_checks.run_check(c, 0.1, executor, semaphore, dns_cache) for c in (check, slow_check)])
+		return [first] + rest, dns_cache.stats
+	if hasattr(inspect, "iscoroutinefunction"):
+		assert inspect.iscoroutinefunction(run_checks)
+
+	results, stats = status_checks.run_in_event_loop(run_checks)
+	assert [result for result, output in results] == ["192.0.2.1", "192.0.2.1", status_checks.CHECK_TIMED_OUT]
+	assert len(results[0][1].buf) == 1
+	assert stats["queries"] == 1 and stats["cached"] == 1
@@ -0,0 +1,137 @@
+# Tests of the compressed copies of static files that web_update.py makes.
+#
+# python3 -m pytest tests
+
+import os, os.path, gzip
+
+import pytest
+
+import web_update
+
+CONTENT = b"<p>Hello, world!</p>\n" * 100
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+	monkeypatch.setattr(web_update, "PRECOMPRESS_MANIFEST", str(tmp_path / "cache/precompressed_files.json"))
+	os.makedirs(str(tmp_path / "www/default"))
+	return { "STORAGE_ROOT": str(tmp_path) }
+
+def write(env, fn, content=CONTENT, mtime=None):
+	path = os.path.join(env["STORAGE_ROOT"], "www/default", fn)
+	with open(path, "wb") as f:
+		f.write(content)
+	if mtime is not None:
+		os.utime(path, (mtime, mtime))
+	return path
+
+def read(path):
+	with open(path, "rb") as f:
+		return f.read()
+
+def precompress(env):
+	return web_update.precompress_web_roots(env)[:2]
+
+def test_copies_made_and_updated(env):
+	path = write(env, "index.html")
+	write(env, "small.css", b"p { }")
+	write(env, "image.png")
+	assert precompress(env) == (1, 0)
+	assert gzip.decompress(read(path + ".gz")) == CONTENT
+	assert not os.path.exists(os.path.join(os.path.dirname(path), "small.css.gz"))
+	assert not os.path.exists(os.path.join(os.path.dirname(path), "image.png.gz"))
+
+	# Nothing changed, so nothing is done.
+	assert precompress(env) == (0, 0)
+
+	# A changed file gets a new copy.
+	write(env, "index.html", CONTENT + b"<p>More.</p>\n", mtime=1000000000)
+	assert precompress(env) == (1, 0)
+	assert gzip.decompress(read(path + ".gz")) == CONTENT + b"<p>More.</p>\n"
+
+	# Our copy is removed when its file becomes too small or is deleted.
+	write(env, "index.html", b"<p>Short.</p>")
+	assert precompress(env) == (0, 0)
+	assert not os.path.exists(path + ".gz")
+	write(env, "index.html")
+	assert precompress(env) == (1, 0)
+	os.unlink(path)
+	precompress(env)
+	assert not os.path.exists(path + ".gz")
+
+def test_user_gz_files_left_alone(env):
+	# An orphaned .gz file, a .gz file next to a small file, a .gz file
+	# next to a file with a different mtime, and a .tar.gz file.
+	orphan = write(env, "orphan.css.gz", b"mine")
+	small = write(env, "small.css", b"p { }")
+	write(env, "small.css.gz", b"mine too")
+	big = write(env, "big.js", mtime=1000000000)
+	write(env, "big.js.gz", b"also mine")
+	tarball = write(env, "site.tar.gz", b"a tarball")
+
+	for i in range(2):
+		assert precompress(env) == (0, 0)
+		assert read(orphan) == b"mine"
+		assert read(small + ".gz") == b"mine too"
+		assert read(big + ".gz") == b"also mine"
+		assert read(tarball) == b"a tarball"
+		write(env, "big.js", CONTENT + b"// changed\n")
+
+def test_replaced_copy_becomes_the_users(env):
+	# Once the user replaces one of our copies, it's theirs.
+	path = write(env, "style.css")
+	assert precompress(env) == (1, 0)
+	write(env, "style.css.gz", b"mine now")
+	write(env, "style.css", CONTENT + b"/* changed */\n", mtime=1000000000)
+	assert precompress(env) == (0, 0)
+	assert read(path + ".gz") == b"mine now"
+	os.unlink(path)
+	assert precompress(env) == (0, 0)
+	assert read(path + ".gz") == b"mine now"
+
+def test_symlinks_skipped(env, tmp_path):
+	outside = tmp_path / "outside.html"
+	outside.write_bytes(CONTENT)
+	link = os.path.join(env["STORAGE_ROOT"], "www/default/link.html")
+	os.symlink(str(outside), link)
+	os.symlink(str(tmp_path), os.path.join(env["STORAGE_ROOT"], "www/default/linked-dir"))
+	assert precompress(env) == (0, 0)
+	assert not os.path.exists(link + ".gz")
+	assert not os.path.exists(str(outside) + ".gz")
+
+def test_bad_upstreams_skipped(env):
+	# A mistake in www/custom.yaml leaves out just what it affects, rather
+	# than breaking everything that reads the file.
+	with open(os.path.join(env["STORAGE_ROOT"], "www/custom.yaml"), "w") as f:
+		f.write(
+			"_upstreams:\n"
+			"  app:\n"
+			"    servers: [127.0.0.1:8080]\n"
+			"    cache: 10m\n"
+			"  broken:\n"
+			"    servers: []\n"
+			"  bad name!: { servers: [127.0.0.1:8081] }\n"
+			"example.com:\n"
+			"  proxies:\n"
+			"    /api: { upstream: app }\n"
+			"    /old: { upstream: broken }\n"
+			"    /bad-path: { upstream: app, path: 'no-slash' }\n"
+			"    /url: http://127.0.0.1:8082\n"
+		)
+	settings = web_update.get_web_custom_settings(env)
+	assert sorted(settings.upstreams) == ["app"]
+	assert sorted(settings["example.com"]["proxies"]) == ["/api", "/url"]
+	assert len(settings.problems) == 4
+	assert "Upstream broken needs one or more servers." in settings.problems
+	assert any("/old" in problem for problem in settings.problems)
+
+	conf = web_update.make_proxy_config("/api", settings["example.com"]["proxies"]["/api"], settings.upstreams)
+	assert "proxy_pass http://miab_upstream_app;" in conf
+	assert "miab_upstream_broken" not in web_update.make_upstreams_config(settings.upstreams)
+
+def test_upstreams_not_a_mapping(env):
+	with open(os.path.join(env["STORAGE_ROOT"], "www/custom.yaml"), "w") as f:
+		f.write("_upstreams: [app]\nexample.com:\n  proxies:\n    /api: { upstream: app }\n")
+	settings = web_update.get_web_custom_settings(env)
+	assert settings.upstreams == { }
+	assert settings["example.com"]["proxies"] == { }
+	assert len(settings.problems) == 2